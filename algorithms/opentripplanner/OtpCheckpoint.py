@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Author: Mario Königbauer (mkoenigb@gmx.de)
+(C) 2022 - today by Mario Koenigbauer
+License: GNU General Public License v3.0
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Append-only checkpoint file (JSON Lines) for long running OpenTripPlanner algorithms.
+# The first line holds the request relevant parameters of the run, every following line the pruned router response
+# of one finished source feature. A rerun with the same parameters reads the responses from the file instead of
+# requesting them again, so the output is identical to an uninterrupted run.
+
+import json
+import os
+
+class OtpCheckpoint():
+    """
+    Usage:
+        checkpoint = OtpCheckpoint(path, parameters) # raises ValueError if the file belongs to a run with other parameters
+        if feature.id() in checkpoint: data = checkpoint.get(feature.id())
+        else: checkpoint.add(feature.id(), OtpCheckpoint.prune(data, OtpCheckpoint.ROUTES_KEYS))
+        checkpoint.close()
+    """
+    VERSION = 1
+    SYNC_INTERVAL = 1000 # fsync every x records; every record is flushed to the os immediately anyway
+
+    # Keys of the OTP plan response the algorithms actually read. None keeps the value, a list applies its spec to every item.
+    PLACE_KEYS = {'lat': None, 'lon': None, 'stopId': None, 'stopCode': None, 'name': None}
+    ERROR_KEYS = {'id': None, 'msg': None, 'message': None, 'noPath': None}
+    ITINERARY_KEYS = {'startTime': None, 'endTime': None, 'duration': None, 'transitTime': None, 'waitingTime': None, 'walkTime': None, 'walkDistance': None, 'transfers': None}
+    LEG_KEYS = {'startTime': None, 'departureDelay': None, 'endTime': None, 'arrivalDelay': None, 'duration': None, 'distance': None, 'mode': None,
+                'from': dict(PLACE_KEYS, departure = None), 'to': dict(PLACE_KEYS, arrival = None), 'legGeometry': {'points': None}}
+    TRAVELTIME_KEYS = {'plan': {'from': PLACE_KEYS, 'to': PLACE_KEYS, 'itineraries': [ITINERARY_KEYS]}, 'error': ERROR_KEYS}
+    ROUTES_KEYS = {'plan': {'from': PLACE_KEYS, 'to': PLACE_KEYS, 'itineraries': [dict(ITINERARY_KEYS, legs = [LEG_KEYS])]}, 'error': ERROR_KEYS}
+
+    def __init__(self, path, parameters):
+        self.path = path
+        self.parameters = json.loads(json.dumps(parameters)) # normalize e.g. tuples to lists for comparison
+        self.offsets = {}
+        self.resumed = 0
+        self.unsynced = 0
+        header = None
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                offset = 0
+                for line in f:
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError: # e.g. last line only partially written on a crash
+                        record = None
+                    if header is None:
+                        header = record
+                        if not isinstance(header, dict) or header.get('version') != self.VERSION:
+                            raise ValueError('File ' + str(path) + ' is not a ProcessX OTP checkpoint file')
+                        if header.get('parameters') != self.parameters:
+                            raise ValueError('Checkpoint file ' + str(path) + ' was created with different parameters; choose another file or delete it to start from scratch')
+                    elif isinstance(record, dict) and 'fid' in record:
+                        self.offsets[record['fid']] = offset
+                    offset += len(line)
+        self.reader = open(path, 'rb') if header is not None else None
+        self.writer = open(path, 'ab')
+        if header is None:
+            self.write({'version': self.VERSION, 'parameters': self.parameters})
+        elif self.writer.tell() > 0 and not self.ends_with_newline():
+            self.writer.write(b'\n') # terminate a partially written line, so the next record starts on its own line
+
+    def ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def __contains__(self, fid):
+        return fid in self.offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def get(self, fid):
+        self.reader.seek(self.offsets[fid])
+        self.resumed += 1
+        return json.loads(self.reader.readline().decode('utf-8'))['data']
+
+    def add(self, fid, data):
+        self.write({'fid': fid, 'data': data})
+
+    def write(self, record):
+        self.writer.write(json.dumps(record, separators = (',', ':')).encode('utf-8') + b'\n')
+        self.writer.flush()
+        self.unsynced += 1
+        if self.unsynced >= self.SYNC_INTERVAL:
+            os.fsync(self.writer.fileno())
+            self.unsynced = 0
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.writer.close()
+
+    @staticmethod
+    def prune(data, keys):
+        # reduce a decoded json response to the given keys to keep the checkpoint file small
+        if keys is None:
+            return data
+        if isinstance(keys, list):
+            if not isinstance(data, list):
+                return data
+            return [OtpCheckpoint.prune(item, keys[0]) for item in data]
+        if not isinstance(data, dict):
+            return data
+        return {k: OtpCheckpoint.prune(data[k], v) for k, v in keys.items() if k in data}
\ No newline at end of file
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Author: Mario Königbauer (mkoenigb@gmx.de)
+(C) 2022 - today by Mario Koenigbauer
+License: GNU General Public License v3.0
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Shared HTTP client for all OpenTripPlanner algorithms.
+# Provides connect/read timeouts, bounded exponential backoff retries on 5xx responses and connection failures,
+# a token bucket rate limiter and per-run request statistics. It only depends on the python standard library.
+
+import http.client
+import urllib.parse
+import urllib.request
+import socket
+import random
+import time
+import json
+import math
+
+class OtpRequestStatistics():
+    """Collects latencies, retries and failures of all requests sent during one run of an algorithm."""
+
+    def __init__(self):
+        self.requests = 0 # logical requests, e.g. one per route
+        self.attempts = 0 # http requests actually sent, including retries
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.latencies = [] # seconds per attempt which received a response
+        self.wait_time = 0.0 # seconds spent in rate limiter and backoff
+        self.start_time = time.monotonic()
+
+    def percentile(self, p):
+        # nearest-rank percentile; returns None if no latency has been recorded
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        rank = int(math.ceil(p / 100.0 * len(latencies)))
+        return latencies[min(max(rank, 1), len(latencies)) - 1]
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start_time
+        lines = ['OTP requests: ' + str(self.requests) + ' (' + str(self.successes) + ' succeeded, ' + str(self.failures) + ' failed) with ' + str(self.attempts) + ' attempts and ' + str(self.retries) + ' retries in ' + str(round(elapsed, 1)) + ' s']
+        if self.latencies:
+            lines.append('OTP latency in ms: p50 = ' + str(round(self.percentile(50) * 1000)) +
+                         ', p90 = ' + str(round(self.percentile(90) * 1000)) +
+                         ', p99 = ' + str(round(self.percentile(99) * 1000)) +
+                         ', max = ' + str(round(max(self.latencies) * 1000)))
+        if self.wait_time > 0:
+            lines.append('OTP waiting time for rate limit and backoff: ' + str(round(self.wait_time, 1)) + ' s')
+        return lines
+
+class OtpTokenBucket():
+    """Token bucket rate limiter. A rate of 0 or less means unlimited."""
+
+    def __init__(self, rate, capacity = None):
+        self.rate = float(rate) if rate else 0.0
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.timestamp = time.monotonic()
+
+    def wait_time(self):
+        # returns the seconds to wait until the next token is available and takes it if available
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class OtpHttpClient():
+    """
+    Sends GET requests to an OTP instance and returns the decoded json response.
+    Connections are kept alive and reused per host. Transient errors (5xx, connection resets, timeouts) are retried
+    with exponential backoff and jitter; all other errors, e.g. unknown hosts or certificate errors, are returned immediately.
+    """
+    RETRY_STATUS = (500, 502, 503, 504)
+    RETRY_EXCEPTIONS = (socket.timeout, TimeoutError, ConnectionError, http.client.HTTPException) # HTTPException covers broken responses like IncompleteRead, BadStatusLine or LineTooLong
+
+    ERROR_REQUEST = 'Error: Requesting the route failed'
+    ERROR_RESPONSE = 'Error: No response received'
+    ERROR_READ = 'Error: Cannot read response data'
+    ERROR_CANCELED = 'Error: Request canceled'
+
+    def __init__(self, connect_timeout = 10, read_timeout = 120, max_retries = 5, rate_limit = 0, backoff_base = 1.0, backoff_max = 60.0, feedback = None):
+        self.connect_timeout = connect_timeout if connect_timeout and connect_timeout > 0 else None
+        self.read_timeout = read_timeout if read_timeout and read_timeout > 0 else None
+        self.max_retries = max(int(max_retries), 0)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = OtpTokenBucket(rate_limit)
+        self.feedback = feedback
+        self.statistics = OtpRequestStatistics()
+        self.connections = {}
+        self.proxies = urllib.request.getproxies()
+
+    def is_canceled(self):
+        return self.feedback is not None and self.feedback.isCanceled()
+
+    def sleep(self, seconds):
+        # sleep in small steps to stay responsive to the cancel button; returns False if canceled
+        self.statistics.wait_time += seconds
+        end = time.monotonic() + seconds
+        while True:
+            if self.is_canceled():
+                return False
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(remaining, 0.1))
+
+    def backoff(self, attempt, retry_after = None):
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        delay = delay * (0.5 + random.random() / 2) # jitter, so parallel clients do not hit the router in lockstep
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def get_connection(self, scheme, netloc):
+        key = (scheme, netloc)
+        conn = self.connections.get(key)
+        if conn is None:
+            connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            proxy = self.proxies.get(scheme)
+            host = netloc.rsplit('@', 1)[-1]
+            if proxy and not urllib.request.proxy_bypass(host.split(':')[0]):
+                proxy_netloc = urllib.parse.urlsplit(proxy).netloc or proxy
+                conn = connection_class(proxy_netloc, timeout = self.connect_timeout)
+                if scheme == 'https':
+                    conn.set_tunnel(host)
+                conn.otp_proxy = True
+            else:
+                conn = connection_class(host, timeout = self.connect_timeout)
+                conn.otp_proxy = False
+            self.connections[key] = conn
+        if conn.sock is None:
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout) # connect timeout is only used for connecting
+        return conn
+
+    def close_connection(self, scheme, netloc):
+        conn = self.connections.pop((scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+
+    def close(self):
+        for conn in self.connections.values():
+            conn.close()
+        self.connections = {}
+
+    def send(self, url, headers):
+        # send a single request and return the response and its body
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.netloc:
+            raise ValueError('Invalid URL: ' + str(url))
+        try: # a connection which failed in any way is dropped, so the next attempt starts with a new one
+            conn = self.get_connection(parts.scheme, parts.netloc)
+            if conn.otp_proxy and parts.scheme == 'http':
+                path = url
+            else:
+                path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+            conn.request('GET', path, headers = headers)
+            response = conn.getresponse()
+            body = response.read()
+        except:
+            self.close_connection(parts.scheme, parts.netloc)
+            raise
+        if response.will_close:
+            self.close_connection(parts.scheme, parts.netloc)
+        return response, body
+
+    def request_json(self, url, headers = None):
+        """
+        Returns a tuple (data, error). data is the decoded json response or None, error is None on success
+        or one of the error strings also written to the Route_Error fields of the OTP algorithms.
+        """
+        headers = headers or {}
+        self.statistics.requests += 1
+        attempt = 0
+        while True:
+            if self.is_canceled():
+                return None, self.ERROR_CANCELED
+            wait = self.rate_limiter.wait_time()
+            while wait > 0:
+                if not self.sleep(wait):
+                    return None, self.ERROR_CANCELED
+                wait = self.rate_limiter.wait_time()
+
+            retry_after = None
+            immediate = False
+            parts = urllib.parse.urlsplit(url)
+            conn = self.connections.get((parts.scheme, parts.netloc))
+            reused = conn is not None and conn.sock is not None
+            self.statistics.attempts += 1
+            start = time.monotonic()
+            try:
+                response, body = self.send(url, headers)
+            except (ValueError, http.client.InvalidURL) as e:
+                self.statistics.failures += 1
+                self.report('OTP request failed: ' + str(e) + ' (' + url + ')')
+                return None, self.ERROR_REQUEST
+            except self.RETRY_EXCEPTIONS as e:
+                error = self.ERROR_RESPONSE
+                reason = type(e).__name__ + ': ' + str(e)
+                # a kept-alive connection may have been closed by the server in the meantime, so reconnect at once
+                immediate = reused and attempt == 0 and isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError))
+            except OSError as e: # e.g. unknown host (socket.gaierror), certificate errors (ssl.SSLError) or no route to host: retrying does not help
+                self.statistics.failures += 1
+                self.report('OTP request failed: ' + type(e).__name__ + ': ' + str(e) + ' (' + url + ')')
+                return None, self.ERROR_REQUEST
+            else:
+                self.statistics.latencies.append(time.monotonic() - start)
+                if response.status in self.RETRY_STATUS:
+                    error = self.ERROR_RESPONSE
+                    reason = 'HTTP ' + str(response.status) + ' ' + str(response.reason)
+                    try:
+                        retry_after = float(response.getheader('Retry-After'))
+                    except (TypeError, ValueError):
+                        retry_after = None
+                else:
+                    try:
+                        encoding = response.headers.get_content_charset('utf-8')
+                        data = json.loads(body.decode(encoding))
+                    except (ValueError, LookupError):
+                        self.statistics.failures += 1
+                        self.report('OTP response could not be read: HTTP ' + str(response.status) + ' ' + str(response.reason) + ' (' + url + ')')
+                        return None, self.ERROR_READ
+                    self.statistics.successes += 1
+                    return data, None
+
+            if attempt >= self.max_retries:
+                self.statistics.failures += 1
+                self.report('OTP request failed after ' + str(attempt + 1) + ' attempts: ' + reason + ' (' + url + ')')
+                return None, error
+            attempt += 1
+            self.statistics.retries += 1
+            if not immediate and not self.sleep(self.backoff(attempt - 1, retry_after)):
+                return None, self.ERROR_CANCELED
+
+    def report(self, message):
+        if self.feedback is not None:
+            self.feedback.pushWarning(message)
+
+    def report_statistics(self):
+        if self.feedback is not None:
+            for line in self.statistics.summary():
+                self.feedback.pushInfo(line)
\ No newline at end of file
@@ -22,7 +22,7 @@ License: GNU General Public License v3.0
 from PyQt5.QtCore import QCoreApplication, QVariant, QDate, QTime, QDateTime, Qt
 from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes, QgsCoordinateReferenceSystem, QgsDateTimeFieldFormatter,
                        QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
+                       QgsProcessingParameterDefinition, QgsProcessingParameterFeatureSink, QgsProcessingParameterFileDestination, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
 from osgeo import ogr
 from datetime import *
 import os.path
@@ -30,6 +30,8 @@ import os
 import urllib.request
 import urllib
 import json
+from .OtpHttpClient import OtpHttpClient
+from .OtpCheckpoint import OtpCheckpoint
 
 class OtpTraveltime(QgsProcessingAlgorithm):
     
@@ -45,6 +47,11 @@ class OtpTraveltime(QgsProcessingAlgorithm):
     OPTIMIZE = 'OPTIMIZE'
     ADDITIONAL_PARAMS = 'ADDITIONAL_PARAMS'
     ITERINARIES = 'ITERINARIES'
+    CONNECT_TIMEOUT = 'CONNECT_TIMEOUT'
+    READ_TIMEOUT = 'READ_TIMEOUT'
+    MAX_RETRIES = 'MAX_RETRIES'
+    RATE_LIMIT = 'RATE_LIMIT'
+    CHECKPOINT = 'CHECKPOINT'
     OUTPUT = 'OUTPUT'
 
     def initAlgorithm(self, config=None):
@@ -87,6 +94,27 @@ class OtpTraveltime(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterNumber(
                 self.ITERINARIES, self.tr('Number of Iterinaries'),type=QgsProcessingParameterNumber.Integer,defaultValue=1,minValue=1))
+        ### Request settings ###
+        parameter_connect_timeout = QgsProcessingParameterNumber(
+                self.CONNECT_TIMEOUT, self.tr('Connect timeout in seconds (0 means no timeout)'), type=QgsProcessingParameterNumber.Double, defaultValue=10, minValue=0)
+        parameter_connect_timeout.setFlags(parameter_connect_timeout.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_connect_timeout)
+        parameter_read_timeout = QgsProcessingParameterNumber(
+                self.READ_TIMEOUT, self.tr('Read timeout in seconds (0 means no timeout)'), type=QgsProcessingParameterNumber.Double, defaultValue=120, minValue=0)
+        parameter_read_timeout.setFlags(parameter_read_timeout.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_read_timeout)
+        parameter_max_retries = QgsProcessingParameterNumber(
+                self.MAX_RETRIES, self.tr('Maximum number of retries per request on server errors (5xx), timeouts and connection failures'), type=QgsProcessingParameterNumber.Integer, defaultValue=5, minValue=0)
+        parameter_max_retries.setFlags(parameter_max_retries.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_max_retries)
+        parameter_rate_limit = QgsProcessingParameterNumber(
+                self.RATE_LIMIT, self.tr('Maximum number of requests per second (0 means unlimited)'), type=QgsProcessingParameterNumber.Double, defaultValue=0, minValue=0)
+        parameter_rate_limit.setFlags(parameter_rate_limit.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_rate_limit)
+        parameter_checkpoint = QgsProcessingParameterFileDestination(
+                self.CHECKPOINT, self.tr('Checkpoint file to resume an interrupted run with the same parameters (already routed features are read from this file instead of requesting them again)'), fileFilter='JSON Lines (*.jsonl)', optional=True, createByDefault=False)
+        parameter_checkpoint.setFlags(parameter_checkpoint.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_checkpoint)
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT, self.tr('OTP Traveltime'))) # Output
@@ -112,6 +140,31 @@ class OtpTraveltime(QgsProcessingAlgorithm):
         
         additional_params = self.parameterAsString(parameters, self.ADDITIONAL_PARAMS, context)
         iterinaries = self.parameterAsInt(parameters, self.ITERINARIES, context)
+        connect_timeout = self.parameterAsDouble(parameters, self.CONNECT_TIMEOUT, context)
+        read_timeout = self.parameterAsDouble(parameters, self.READ_TIMEOUT, context)
+        max_retries = self.parameterAsInt(parameters, self.MAX_RETRIES, context)
+        rate_limit = self.parameterAsDouble(parameters, self.RATE_LIMIT, context)
+        otp_client = OtpHttpClient(connect_timeout=connect_timeout, read_timeout=read_timeout, max_retries=max_retries, rate_limit=rate_limit, feedback=feedback)
+        checkpoint_path = self.parameterAsFileOutput(parameters, self.CHECKPOINT, context)
+        checkpoint = None
+        if checkpoint_path:
+            checkpoint_parameters = { # everything the router responses depend on
+                'algorithm': self.name(),
+                'source': source_layer.source(),
+                'fields': [startlat_field, startlon_field, endlat_field, endlon_field, date_field, time_field],
+                'server_url': server_url,
+                'mode': travelmode,
+                'optimize': traveloptimize,
+                'additional_params': additional_params,
+                'iterinaries': iterinaries
+            }
+            try:
+                checkpoint = OtpCheckpoint(checkpoint_path, checkpoint_parameters)
+            except ValueError as e:
+                feedback.reportError(str(e), fatalError=True)
+                return {}
+            if len(checkpoint) > 0:
+                feedback.pushInfo('Resuming from checkpoint: ' + str(len(checkpoint)) + ' features have already been routed and will not be requested again')
         
         total = 100.0 / source_layer.featureCount() if source_layer.featureCount() else 0 # Initialize progress for progressbar
         
@@ -211,39 +264,35 @@ class OtpTraveltime(QgsProcessingAlgorithm):
             route_errormessage = None
             route_errornopath = None
 
-            try: # Try to request route
-                route_request = urllib.request.Request(route_url, headers=route_headers)
-                try: # Try to receive response
-                    route_response = urllib.request.urlopen(route_request)
-                    try: # Try to read response data
-                        response_data = route_response.read()
-                        encoding = route_response.info().get_content_charset('utf-8')
-                        route_data = json.loads(response_data.decode(encoding))
-                        try: # Check if response says Error
-                            route_error = 'Error: No Route'
-                            route_error_bool = True
-                            route_errorid = route_data['error']['id']
-                            route_errordescription = route_data['error']['msg']
-                            try: # not every error delivers this
-                                route_errormessage = route_data['error']['message']
-                            except:
-                                pass
-                            try: # not every error delivers this
-                                route_errornopath = route_data['error']['noPath']
-                            except:
-                                pass
-                        except:
-                            route_error = 'Success'
-                            route_error_bool = False
+            if checkpoint is not None and source_feature.id() in checkpoint: # already routed in an earlier run
+                route_data = checkpoint.get(source_feature.id())
+                route_request_error = None
+            else:
+                route_data, route_request_error = otp_client.request_json(route_url, headers=route_headers)
+                if feedback.isCanceled(): # Do not write a feature for a request interrupted by the cancel button
+                    break
+                if checkpoint is not None and route_request_error is None: # failed requests are not stored, so they are requested again on resume
+                    checkpoint.add(source_feature.id(), OtpCheckpoint.prune(route_data, OtpCheckpoint.TRAVELTIME_KEYS))
+            if route_request_error is not None:
+                route_error = route_request_error
+                route_error_bool = True
+            else:
+                try: # Check if response says Error
+                    route_error = 'Error: No Route'
+                    route_error_bool = True
+                    route_errorid = route_data['error']['id']
+                    route_errordescription = route_data['error']['msg']
+                    try: # not every error delivers this
+                        route_errormessage = route_data['error']['message']
                     except:
-                        route_error = 'Error: Cannot read response data'
-                        route_error_bool = True
+                        pass
+                    try: # not every error delivers this
+                        route_errornopath = route_data['error']['noPath']
+                    except:
+                        pass
                 except:
-                    route_error = 'Error: No response received'
-                    route_error_bool = True
-            except:
-                route_error = 'Error: Requesting the route failed'
-                route_error_bool = True
+                    route_error = 'Success'
+                    route_error_bool = False
             
             #print(route_error)
             try:
@@ -393,6 +442,12 @@ class OtpTraveltime(QgsProcessingAlgorithm):
             
             feedback.setProgress(int(current * total)) # Set Progress in Progressbar
 
+        otp_client.close()
+        otp_client.report_statistics()
+        if checkpoint is not None:
+            checkpoint.close()
+            feedback.pushInfo(str(checkpoint.resumed) + ' features have been resumed from checkpoint ' + checkpoint_path)
+            return {self.OUTPUT: dest_id, self.CHECKPOINT: checkpoint_path}
         return {self.OUTPUT: dest_id} # Return result of algorithm
 
 
@@ -22,7 +22,7 @@ License: GNU General Public License v3.0
 from PyQt5.QtCore import QCoreApplication, QVariant, QDate, QTime, QDateTime, Qt
 from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes, QgsCoordinateReferenceSystem, QgsDateTimeFieldFormatter,
                        QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm,
-                       QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
+                       QgsProcessingParameterDefinition, QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
 from osgeo import ogr
 from datetime import *
 import os.path
@@ -30,6 +30,7 @@ import os
 import urllib.request
 import urllib
 import json
+from .OtpHttpClient import OtpHttpClient
 
 class OtpTraveltimeComparison(QgsProcessingAlgorithm):
     
@@ -48,6 +49,10 @@ class OtpTraveltimeComparison(QgsProcessingAlgorithm):
     OPTIMIZE_B = 'OPTIMIZE_B'
     ADDITIONAL_PARAMS_B = 'ADDITIONAL_PARAMS_B'
     ITERINARIES = 'ITERINARIES'
+    CONNECT_TIMEOUT = 'CONNECT_TIMEOUT'
+    READ_TIMEOUT = 'READ_TIMEOUT'
+    MAX_RETRIES = 'MAX_RETRIES'
+    RATE_LIMIT = 'RATE_LIMIT'
     OUTPUT = 'OUTPUT'
 
     def initAlgorithm(self, config=None):
@@ -101,6 +106,23 @@ class OtpTraveltimeComparison(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterNumber(
                 self.ITERINARIES, self.tr('Number of Iterinaries (currently only possible with 1)'),type=QgsProcessingParameterNumber.Integer,defaultValue=1,minValue=1,maxValue=1))
+        ### Request settings ###
+        parameter_connect_timeout = QgsProcessingParameterNumber(
+                self.CONNECT_TIMEOUT, self.tr('Connect timeout in seconds (0 means no timeout)'), type=QgsProcessingParameterNumber.Double, defaultValue=10, minValue=0)
+        parameter_connect_timeout.setFlags(parameter_connect_timeout.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_connect_timeout)
+        parameter_read_timeout = QgsProcessingParameterNumber(
+                self.READ_TIMEOUT, self.tr('Read timeout in seconds (0 means no timeout)'), type=QgsProcessingParameterNumber.Double, defaultValue=120, minValue=0)
+        parameter_read_timeout.setFlags(parameter_read_timeout.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_read_timeout)
+        parameter_max_retries = QgsProcessingParameterNumber(
+                self.MAX_RETRIES, self.tr('Maximum number of retries per request on server errors (5xx), timeouts and connection failures'), type=QgsProcessingParameterNumber.Integer, defaultValue=5, minValue=0)
+        parameter_max_retries.setFlags(parameter_max_retries.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_max_retries)
+        parameter_rate_limit = QgsProcessingParameterNumber(
+                self.RATE_LIMIT, self.tr('Maximum number of requests per second (0 means unlimited)'), type=QgsProcessingParameterNumber.Double, defaultValue=0, minValue=0)
+        parameter_rate_limit.setFlags(parameter_rate_limit.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_rate_limit)
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT, self.tr('OTP TraveltimeComparison'))) # Output
@@ -130,6 +152,11 @@ class OtpTraveltimeComparison(QgsProcessingAlgorithm):
         additional_params_a = self.parameterAsString(parameters, self.ADDITIONAL_PARAMS_A, context)
         additional_params_b = self.parameterAsString(parameters, self.ADDITIONAL_PARAMS_B, context)
         iterinaries = self.parameterAsInt(parameters, self.ITERINARIES, context)
+        connect_timeout = self.parameterAsDouble(parameters, self.CONNECT_TIMEOUT, context)
+        read_timeout = self.parameterAsDouble(parameters, self.READ_TIMEOUT, context)
+        max_retries = self.parameterAsInt(parameters, self.MAX_RETRIES, context)
+        rate_limit = self.parameterAsDouble(parameters, self.RATE_LIMIT, context)
+        otp_client = OtpHttpClient(connect_timeout=connect_timeout, read_timeout=read_timeout, max_retries=max_retries, rate_limit=rate_limit, feedback=feedback)
         
         total = 100.0 / source_layer.featureCount() if source_layer.featureCount() else 0 # Initialize progress for progressbar
         
@@ -241,39 +268,27 @@ class OtpTraveltimeComparison(QgsProcessingAlgorithm):
             route_b_errormessage = None
             route_b_errornopath = None
             
-            try: # Try to request route a
-                route_a_request = urllib.request.Request(route_a_url, headers=route_headers)
-                try: # Try to receive response
-                    route_a_response = urllib.request.urlopen(route_a_request)
-                    try: # Try to read response data
-                        response_a_data = route_a_response.read()
-                        encoding_a = route_a_response.info().get_content_charset('utf-8')
-                        route_a_data = json.loads(response_a_data.decode(encoding_a))
-                        try: # Check if response says Error
-                            route_a_error = 'Error: No Route'
-                            route_a_error_bool = True
-                            route_a_errorid = route_a_data['error']['id']
-                            route_a_errordescription = route_a_data['error']['msg']
-                            try: # not every error delivers this
-                                route_a_errormessage = route_a_data['error']['message']
-                            except:
-                                pass
-                            try: # not every error delivers this
-                                route_a_errornopath = route_a_data['error']['noPath']
-                            except:
-                                pass
-                        except:
-                            route_a_error = 'Success'
-                            route_a_error_bool = False
+            route_a_data, route_a_request_error = otp_client.request_json(route_a_url, headers=route_headers)
+            if route_a_request_error is not None:
+                route_a_error = route_a_request_error
+                route_a_error_bool = True
+            else:
+                try: # Check if response says Error
+                    route_a_error = 'Error: No Route'
+                    route_a_error_bool = True
+                    route_a_errorid = route_a_data['error']['id']
+                    route_a_errordescription = route_a_data['error']['msg']
+                    try: # not every error delivers this
+                        route_a_errormessage = route_a_data['error']['message']
                     except:
-                        route_a_error = 'Error: Cannot read response data'
-                        route_a_error_bool = True
+                        pass
+                    try: # not every error delivers this
+                        route_a_errornopath = route_a_data['error']['noPath']
+                    except:
+                        pass
                 except:
-                    route_a_error = 'Error: No response received'
-                    route_a_error_bool = True
-            except:
-                route_a_error = 'Error: Requesting the route failed'
-                route_a_error_bool = True
+                    route_a_error = 'Success'
+                    route_a_error_bool = False
             
             try:
                 if not route_a_data['plan']['itineraries']: # check if response is empty
@@ -283,39 +298,29 @@ class OtpTraveltimeComparison(QgsProcessingAlgorithm):
                 pass
             
             
-            try: # Try to request route b
-                route_b_request = urllib.request.Request(route_b_url, headers=route_headers)
-                try: # Try to receive response
-                    route_b_response = urllib.request.urlopen(route_b_request)
-                    try: # Try to read response data
-                        response_b_data = route_b_response.read()
-                        encoding_b = route_b_response.info().get_content_charset('utf-8')
-                        route_b_data = json.loads(response_b_data.decode(encoding_b))
-                        try: # Check if response says Error
-                            route_b_error = 'Error: No Route'
-                            route_b_error_bool = True
-                            route_b_errorid = route_b_data['error']['id']
-                            route_b_errordescription = route_b_data['error']['msg']
-                            try: # not every error delivers this
-                                route_b_errormessage = route_b_data['error']['message']
-                            except:
-                                pass
-                            try: # not every error delivers this
-                                route_b_errornopath = route_b_data['error']['noPath']
-                            except:
-                                pass
-                        except:
-                            route_b_error = 'Success'
-                            route_b_error_bool = False
+            route_b_data, route_b_request_error = otp_client.request_json(route_b_url, headers=route_headers)
+            if feedback.isCanceled(): # Do not write a feature for a request interrupted by the cancel button
+                break
+            if route_b_request_error is not None:
+                route_b_error = route_b_request_error
+                route_b_error_bool = True
+            else:
+                try: # Check if response says Error
+                    route_b_error = 'Error: No Route'
+                    route_b_error_bool = True
+                    route_b_errorid = route_b_data['error']['id']
+                    route_b_errordescription = route_b_data['error']['msg']
+                    try: # not every error delivers this
+                        route_b_errormessage = route_b_data['error']['message']
                     except:
-                        route_b_error = 'Error: Cannot read response data'
-                        route_b_error_bool = True
+                        pass
+                    try: # not every error delivers this
+                        route_b_errornopath = route_b_data['error']['noPath']
+                    except:
+                        pass
                 except:
-                    route_b_error = 'Error: No response received'
-                    route_b_error_bool = True
-            except:
-                route_b_error = 'Error: Requesting the route failed'
-                route_b_error_bool = True
+                    route_b_error = 'Success'
+                    route_b_error_bool = False
             
             try:
                 if not route_b_data['plan']['itineraries']: # check if response is empty
@@ -459,6 +464,8 @@ class OtpTraveltimeComparison(QgsProcessingAlgorithm):
             
             feedback.setProgress(int(current * total)) # Set Progress in Progressbar
 
+        otp_client.close()
+        otp_client.report_statistics()
         return {self.OUTPUT: dest_id} # Return result of algorithm
 
 
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Author: Mario Königbauer (mkoenigb@gmx.de)
+(C) 2022 - today by Mario Koenigbauer
+License: GNU General Public License v3.0
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Linear referencing on the vertex arrays of a linestring.
+# The cumulative lengths of the vertices are computed once, afterwards positions along the line are found by bisection
+# and interpolated arithmetically, without creating any geometries. Points are projected onto the line with the help
+# of a uniform grid of its segments, which is built on the first projection. This module intentionally does not depend
+# on QGIS, so it can be used by worker processes.
+
+import bisect
+import math
+import struct
+
+class LinearReference():
+    """
+    Linear referencing along one linestring given as a list of parallel coordinate lists, e.g. [x, y] or [x, y, z, m].
+    Distances are measured in 2D on x and y; all other coordinates are interpolated linearly by distance.
+    """
+    GRID_MIN_SEGMENTS = 32 # shorter lines are searched segment by segment
+
+    def __init__(self, coordinates):
+        self.coordinates = coordinates
+        xs, ys = coordinates[0], coordinates[1]
+        cumulative = [0.0] * len(xs)
+        for i in range(1, len(xs)):
+            cumulative[i] = cumulative[i - 1] + math.hypot(xs[i] - xs[i - 1], ys[i] - ys[i - 1])
+        self.cumulative = cumulative
+        self.length = cumulative[-1] if cumulative else 0.0
+        self.grid = None
+
+    def segment_at(self, distance, start = 0):
+        """Returns the index i of the segment from vertex i to i + 1 containing the distance, searching from segment start on."""
+        return max(min(bisect.bisect_right(self.cumulative, distance, start) - 1, len(self.cumulative) - 2), 0)
+
+    def vertex_at(self, distance, segment = None):
+        """Returns the interpolated coordinates (one value per coordinate list) at the distance, which is clamped to the line."""
+        i = self.segment_at(distance) if segment is None else segment
+        d0 = self.cumulative[i]
+        d1 = self.cumulative[i + 1]
+        t = min(max((distance - d0) / (d1 - d0), 0.0), 1.0) if d1 > d0 else 0.0
+        return tuple(c[i] + (c[i + 1] - c[i]) * t for c in self.coordinates)
+
+    def vertices_at(self, distances):
+        """Returns the interpolated coordinates at every distance of the ascending list distances in one pass along the line."""
+        vertices = []
+        segment = 0
+        for distance in distances:
+            segment = self.segment_at(distance, segment)
+            vertices.append(self.vertex_at(distance, segment))
+        return vertices
+
+    def distances_at(self, values, dimension = -1):
+        """
+        Returns the distances at which the coordinate list coordinates[dimension] (e.g. m) reaches the ascending values in
+        one pass along the line, or None for values outside of its range. The coordinate should not decrease along the line.
+        """
+        c = self.coordinates[dimension]
+        distances = []
+        i = 0
+        for value in values:
+            while i < len(c) - 2 and c[i + 1] < value:
+                i += 1
+            if len(c) < 2 or not c[i] <= value <= c[i + 1]:
+                distances.append(None)
+                continue
+            t = (value - c[i]) / (c[i + 1] - c[i]) if c[i + 1] > c[i] else 0.0
+            distances.append(self.cumulative[i] + (self.cumulative[i + 1] - self.cumulative[i]) * t)
+        return distances
+
+    def substring(self, start, end, segment = 0):
+        """
+        Returns the part of the line between the distances start and end as a list of coordinate lists and the index of
+        the segment containing end. segment is the index of a segment at or before start to speed up the search.
+        """
+        i = self.segment_at(start, segment)
+        j = self.segment_at(end, i)
+        vertices = [self.vertex_at(start, i)]
+        vertices.extend(tuple(c[k] for c in self.coordinates) for k in range(i + 1, j + 1) if start < self.cumulative[k] < end)
+        vertices.append(self.vertex_at(end, j))
+        return [list(c) for c in zip(*vertices)], j
+
+    def substrings(self, breaks):
+        """Yields the substrings between consecutive distances of the ascending list breaks in one pass along the line."""
+        segment = 0
+        for start, end in zip(breaks, breaks[1:]):
+            coordinates, segment = self.substring(start, end, segment)
+            yield coordinates
+
+    def segment_projection(self, i, x, y):
+        """Returns (squared distance, t) of the point (x, y) to segment i, with t from 0 to 1 being the position of the closest point on the segment."""
+        xs, ys = self.coordinates[0], self.coordinates[1]
+        ax, ay = xs[i], ys[i]
+        dx, dy = xs[i + 1] - ax, ys[i + 1] - ay
+        l2 = dx * dx + dy * dy
+        t = min(max(((x - ax) * dx + (y - ay) * dy) / l2, 0.0), 1.0) if l2 > 0 else 0.0
+        fx, fy = ax + dx * t - x, ay + dy * t - y
+        return fx * fx + fy * fy, t
+
+    def build_grid(self):
+        # uniform grid of cells with about the mean segment length as size, each holding the segments crossing its bbox
+        xs, ys = self.coordinates[0], self.coordinates[1]
+        n = len(xs) - 1
+        x_min, y_min = min(xs), min(ys)
+        width, height = max(xs) - x_min, max(ys) - y_min
+        cell = max(self.length / n, math.sqrt(width * height / (4 * n))) or 1.0
+        nx, ny = int(width / cell) + 1, int(height / cell) + 1
+        cells = {}
+        for i in range(n):
+            i0, i1 = sorted((int((xs[i] - x_min) / cell), int((xs[i + 1] - x_min) / cell)))
+            j0, j1 = sorted((int((ys[i] - y_min) / cell), int((ys[i + 1] - y_min) / cell)))
+            for ci in range(i0, min(i1, nx - 1) + 1):
+                for cj in range(j0, min(j1, ny - 1) + 1):
+                    cells.setdefault((ci, cj), []).append(i)
+        self.grid = (x_min, y_min, cell, nx, ny, cells)
+
+    def closest_segment(self, x, y):
+        # (squared distance, segment, t) of the closest segment; on equal distances the first segment wins, like in GEOS
+        n = len(self.cumulative) - 1
+        if n < self.GRID_MIN_SEGMENTS:
+            best = None
+            for i in range(n):
+                d2, t = self.segment_projection(i, x, y)
+                if best is None or d2 < best[0]:
+                    best = (d2, i, t)
+            return best
+        if self.grid is None:
+            self.build_grid()
+        x_min, y_min, cell, nx, ny, cells = self.grid
+        ci = min(max(int((x - x_min) // cell), 0), nx - 1)
+        cj = min(max(int((y - y_min) // cell), 0), ny - 1)
+        best = None
+        seen = set()
+        r = 0
+        while True:
+            # search the ring of cells at distance r around the cell of the point
+            if r == 0:
+                ring = [(ci, cj)]
+            else:
+                ring = [(i, j) for i in range(ci - r, ci + r + 1) for j in (cj - r, cj + r)]
+                ring.extend((i, j) for j in range(cj - r + 1, cj + r) for i in (ci - r, ci + r))
+            for key in ring:
+                for i in cells.get(key, ()):
+                    if i in seen:
+                        continue
+                    seen.add(i)
+                    d2, t = self.segment_projection(i, x, y)
+                    if best is None or d2 < best[0] or (d2 == best[0] and i < best[1]):
+                        best = (d2, i, t)
+            # segments in cells outside the searched square are at least bound away from the point
+            bound = math.inf
+            if ci - r > 0:
+                bound = min(bound, x - (x_min + (ci - r) * cell))
+            if ci + r < nx - 1:
+                bound = min(bound, x_min + (ci + r + 1) * cell - x)
+            if cj - r > 0:
+                bound = min(bound, y - (y_min + (cj - r) * cell))
+            if cj + r < ny - 1:
+                bound = min(bound, y_min + (cj + r + 1) * cell - y)
+            if bound == math.inf or (best is not None and best[0] < bound * bound):
+                return best
+            r += 1
+
+    def project(self, x, y):
+        """
+        Returns (distance along the line, segment, t, squared distance) of the point on the line closest to (x, y), with
+        t from 0 to 1 being the position on the segment. The distance equals QgsGeometry.lineLocatePoint.
+        """
+        if len(self.cumulative) < 2:
+            if not self.cumulative:
+                return None
+            return 0.0, 0, 0.0, (self.coordinates[0][0] - x) ** 2 + (self.coordinates[1][0] - y) ** 2
+        d2, i, t = self.closest_segment(x, y)
+        return self.cumulative[i] + (self.cumulative[i + 1] - self.cumulative[i]) * t, i, t, d2
+
+    def project_points(self, points):
+        """Returns project(x, y) for every (x, y) of points."""
+        return [self.project(x, y) for x, y in points]
+
+    def position(self, segment, t):
+        """Returns the interpolated coordinates at position t from 0 to 1 on the segment."""
+        if len(self.cumulative) < 2:
+            return tuple(c[0] for c in self.coordinates)
+        return tuple(c[segment] + (c[segment + 1] - c[segment]) * t for c in self.coordinates)
+
+    def segment_angle(self, i):
+        """Returns the angle of segment i in radians clockwise from north, like QgsGeometryUtils.lineAngle."""
+        xs, ys = self.coordinates[0], self.coordinates[1]
+        return math.atan2(xs[i + 1] - xs[i], ys[i + 1] - ys[i]) % (2 * math.pi)
+
+    def angle_at(self, segment, t):
+        """
+        Returns the angle of the line in radians clockwise from north at position t of the segment. At inner vertices
+        (and at the start and end of closed lines) it is the average angle of the adjacent segments, like
+        QgsGeometry.interpolateAngle.
+        """
+        n = len(self.cumulative) - 1
+        if n < 1:
+            return 0.0
+        if 0.0 < t < 1.0:
+            return self.segment_angle(segment)
+        vertex = segment if t == 0.0 else segment + 1
+        closed = n > 1 and all(c[0] == c[-1] for c in self.coordinates[:2])
+        if 0 < vertex < n:
+            return average_angle(self.segment_angle(vertex - 1), self.segment_angle(vertex))
+        if closed:
+            return average_angle(self.segment_angle(n - 1), self.segment_angle(0))
+        return self.segment_angle(0 if vertex == 0 else n - 1)
+
+def average_angle(a1, a2):
+    """Returns the angle bisecting the smaller turn from angle a1 to angle a2 (radians), like QgsGeometryUtils.averageAngle."""
+    clockwise = (a2 - a1) % (2 * math.pi)
+    if clockwise <= 2 * math.pi - clockwise:
+        return (a1 + clockwise / 2) % (2 * math.pi)
+    return (a1 - (2 * math.pi - clockwise) / 2) % (2 * math.pi)
+
+class MultiLinearReference():
+    """
+    Linear referencing along all parts of a (multi) linestring, each part given as a list of coordinate lists like for
+    LinearReference. Distances continue from part to part, like in QgsGeometry.lineLocatePoint and interpolate.
+    """
+    def __init__(self, parts, has_z = False, has_m = False):
+        self.parts = [LinearReference(coordinates) for coordinates in parts]
+        self.has_z = has_z
+        self.has_m = has_m
+        self.offsets = [] # distance at the start of each part
+        self.first_vertices = [] # vertex number (as used by QgsGeometry) of the first vertex of each part
+        length = 0.0
+        vertices = 0
+        for part in self.parts:
+            self.offsets.append(length)
+            self.first_vertices.append(vertices)
+            length += part.length
+            vertices += len(part.cumulative)
+        self.length = length
+
+    def project(self, x, y):
+        """
+        Returns (distance along the line, part, segment, t, squared distance) of the point on the line closest to (x, y);
+        on equal distances the first part wins. Returns None for a line without vertices.
+        """
+        best = None
+        for p, part in enumerate(self.parts):
+            projection = part.project(x, y)
+            if projection is not None and (best is None or projection[3] < best[4]):
+                best = (self.offsets[p] + projection[0], p, projection[1], projection[2], projection[3])
+        return best
+
+    def project_points(self, points):
+        """Returns project(x, y) for every (x, y) of points."""
+        return [self.project(x, y) for x, y in points]
+
+    def vertex_after(self, part, segment):
+        """Returns the vertex number of the end vertex of the segment, i.e. where a vertex inserted on the segment belongs."""
+        return self.first_vertices[part] + segment + 1
+
+    def position_xyzm(self, part, segment, t):
+        """Returns the interpolated (x, y, z, m) at position t of the segment of the part; z and m are nan if missing."""
+        values = list(self.parts[part].position(segment, t))
+        return (values[0], values[1], values[2] if self.has_z else math.nan, values[-1] if self.has_m else math.nan)
+
+    def angle_at(self, part, segment, t):
+        """Returns the angle of the line in radians clockwise from north at position t of the segment of the part."""
+        return self.parts[part].angle_at(segment, t)
+
+def wkb_linear_reference(wkb):
+    """
+    Returns a MultiLinearReference of a LineString or MultiLineString given as WKB (e.g. bytes(QgsGeometry.asWkb())),
+    or None for other geometry types. Curves have to be segmentized before.
+    """
+    parts = []
+    def read_header(offset):
+        endian = '<' if wkb[offset] == 1 else '>'
+        code = struct.unpack_from(endian + 'I', wkb, offset + 1)[0]
+        has_z = bool(code & 0x80000000) or (code & 0xffff) // 1000 in (1, 3)
+        has_m = bool(code & 0x40000000) or (code & 0xffff) // 1000 in (2, 3)
+        return endian, (code & 0xffff) % 1000, has_z, has_m
+    def read_linestring(offset, endian, dimensions):
+        count = struct.unpack_from(endian + 'I', wkb, offset)[0]
+        values = struct.unpack_from(endian + str(count * dimensions) + 'd', wkb, offset + 4)
+        parts.append([list(values[d::dimensions]) for d in range(dimensions)])
+        return offset + 4 + count * dimensions * 8
+    try:
+        endian, base_type, has_z, has_m = read_header(0)
+        dimensions = 2 + has_z + has_m
+        if base_type == 2:
+            read_linestring(5, endian, dimensions)
+        elif base_type == 5:
+            offset = 9
+            for i in range(struct.unpack_from(endian + 'I', wkb, 5)[0]):
+                part_endian, part_type, part_z, part_m = read_header(offset)
+                if part_type != 2:
+                    return None
+                offset = read_linestring(offset + 5, part_endian, 2 + part_z + part_m)
+        else:
+            return None
+    except (struct.error, IndexError):
+        return None
+    return MultiLinearReference(parts, has_z, has_m)
\ No newline at end of file
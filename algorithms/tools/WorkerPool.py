@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Author: Mario Königbauer (mkoenigb@gmx.de)
+(C) 2022 - today by Mario Koenigbauer
+License: GNU General Public License v3.0
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Process pool for processing algorithms which split their work into independent tasks.
+# Inside QGIS sys.executable is usually the QGIS binary, so worker processes are spawned with the python interpreter
+# QGIS ships with. Worker functions must be defined on module level in modules which do not import QGIS, as the
+# workers have no QGIS environment. If no interpreter is found or the pool breaks, tasks are run in this process.
+
+import os
+import sys
+import collections
+import multiprocessing
+import multiprocessing.spawn
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+def python_executable():
+    # returns the path to a python interpreter usable for worker processes or None
+    executable = sys.executable or ''
+    if os.path.basename(executable).lower().startswith('python'):
+        return executable
+    if sys.platform == 'win32':
+        candidates = [os.path.join(sys.exec_prefix, 'pythonw.exe'), os.path.join(sys.exec_prefix, 'python.exe')]
+    else:
+        version = str(sys.version_info.major) + '.' + str(sys.version_info.minor)
+        candidates = [os.path.join(sys.exec_prefix, 'bin', 'python' + version), os.path.join(sys.exec_prefix, 'bin', 'python3'), os.path.join(sys.exec_prefix, 'bin', 'python')]
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+class WorkerPool():
+    """
+    Usage:
+        with WorkerPool(n_workers, feedback) as pool:
+            for result in pool.imap(module_level_function, tasks):
+                ...
+    imap yields the results in the order of the tasks and keeps at most max_pending tasks in flight, so memory use
+    is bounded by the size of max_pending results regardless of the number of tasks. With n_workers <= 1 all tasks
+    run in the current process.
+    """
+
+    def __init__(self, n_workers, feedback = None, max_pending = None):
+        self.n_workers = max(int(n_workers or 1), 1)
+        self.feedback = feedback
+        self.max_pending = max_pending or self.n_workers * 2
+        self.executor = None
+        self.previous_executable = None
+        if self.n_workers > 1:
+            self.start()
+
+    def start(self):
+        executable = python_executable()
+        if executable is None:
+            self.report('No python interpreter found for worker processes; continuing without parallel processing')
+            return
+        try:
+            self.previous_executable = multiprocessing.spawn.get_executable()
+            multiprocessing.spawn.set_executable(executable)
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers = self.n_workers, mp_context = multiprocessing.get_context('spawn'))
+        except (OSError, ValueError, ImportError) as e:
+            self.report('Could not start worker processes (' + str(e) + '); continuing without parallel processing')
+            self.restore_executable()
+            self.executor = None
+
+    def is_canceled(self):
+        return self.feedback is not None and self.feedback.isCanceled()
+
+    def report(self, message):
+        if self.feedback is not None:
+            self.feedback.pushWarning(message)
+
+    def imap(self, function, tasks):
+        tasks = iter(tasks)
+        end = object()
+        pending = collections.deque()
+        while True:
+            while self.executor is not None and len(pending) < self.max_pending and not self.is_canceled():
+                task = next(tasks, end)
+                if task is end:
+                    break
+                try:
+                    pending.append((task, self.executor.submit(function, task)))
+                except (BrokenProcessPool, RuntimeError) as e:
+                    pending.append((task, None))
+                    self.fallback(e)
+            if self.is_canceled():
+                return
+            if pending:
+                task, future = pending.popleft()
+                if future is not None:
+                    try:
+                        yield future.result()
+                        continue
+                    except (BrokenProcessPool, concurrent.futures.CancelledError) as e: # cancelled by the shutdown of a broken pool
+                        self.fallback(e)
+                yield function(task) # not submitted or lost by a broken pool: run it here to keep the order
+            elif self.executor is None: # serial processing
+                task = next(tasks, end)
+                if task is end:
+                    return
+                yield function(task)
+            else:
+                return
+
+    def fallback(self, error):
+        if self.executor is not None:
+            self.report('Worker processes stopped unexpectedly (' + str(error) + '); continuing without parallel processing')
+            self.close()
+
+    def restore_executable(self):
+        if self.previous_executable is not None:
+            multiprocessing.spawn.set_executable(self.previous_executable)
+            self.previous_executable = None
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait = True, cancel_futures = True)
+            self.executor = None
+        self.restore_executable()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
\ No newline at end of file
@@ -14,11 +14,12 @@ License: GNU General Public License v3.0
  ***************************************************************************/
 """
 
-import operator, processing
+import operator, processing, math
 from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPointXY, QgsWkbTypes,
+from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPoint, QgsPointXY, QgsRectangle, QgsWkbTypes,
                        QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsExpressionContext, QgsExpressionContextUtils, QgsProcessingParameterDefinition,
                        QgsProcessingParameterVectorLayer, QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterDistance, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterExpression, QgsProcessingParameterNumber, QgsProcessingParameterString, QgsProcessingParameterBoolean)
+from ..tools.LinearReferencing import wkb_linear_reference
 
 class DensifyLinesWithNearestPointsByCondition(QgsProcessingAlgorithm):
     SOURCE_LYR = 'SOURCE_LYR'
@@ -267,8 +268,15 @@ class DensifyLinesWithNearestPointsByCondition(QgsProcessingAlgorithm):
             
             max_dist_expression_context.setFeature(line_feat)
             max_dist_expression_result = max_dist_expression.evaluate(max_dist_expression_context)
-            nearest_point_ids = points_layer_idx.nearestNeighbor(line_geom,-1,max_dist_expression_result)
-            for nearest_point_id in nearest_point_ids:
+            line_reference = self.line_reference(line_geom)
+            if line_reference is not None and isinstance(max_dist_expression_result, (int, float)) and max_dist_expression_result > 0:
+                # the index is queried along the line instead of with the whole line, whose bbox may cover most of the points
+                nearest_candidates = self.points_near_line(points_layer_idx, line_reference, max_dist_expression_result)
+            else:
+                nearest_candidates = [(nearest_point_id, None, None) for nearest_point_id in points_layer_idx.nearestNeighbor(line_geom,-1,max_dist_expression_result)]
+            nearest_points = []
+            projections = []
+            for nearest_point_id, nearest_point, projection in nearest_candidates:
                 if feedback.isCanceled():
                     break
                 if comparisons:
@@ -278,16 +286,27 @@ class DensifyLinesWithNearestPointsByCondition(QgsProcessingAlgorithm):
                         pass
                     else:
                         continue
-                nearest_point_geom = points_layer_idx.geometry(nearest_point_id)
-                dist_along_line = line_geom.lineLocatePoint(nearest_point_geom)
-                point_on_line = line_geom.interpolate(dist_along_line)
-                vertex_after_id = line_geom.constGet().closestSegment(point_on_line.vertices().next(),10)[2]
-                vertex_after_nr_old = line_geom.vertexNrFromVertexId(vertex_after_id)
-                vertex_after_nr_new = line_geom.vertexNrFromVertexId(vertex_after_id)
-                try:
-                    vertices_dict[dist_along_line] = [nearest_point_geom,point_on_line,vertex_after_nr_old,vertex_after_nr_new]
-                except:
-                    pass
+                nearest_points.append(points_layer_idx.geometry(nearest_point_id).vertexAt(0) if nearest_point is None else nearest_point)
+                projections.append(projection)
+            
+            if nearest_points and QgsWkbTypes.isCurvedType(line_geom.wkbType()):
+                # vertex numbers of the segmentized line reference do not match the curved geometry the vertices are inserted into
+                for nearest_point in nearest_points:
+                    dist_along_line = line_geom.lineLocatePoint(QgsGeometry(nearest_point.clone()))
+                    point_on_line = line_geom.interpolate(dist_along_line).vertexAt(0)
+                    vertex_after_id = line_geom.constGet().closestSegment(point_on_line,10)[2]
+                    vertex_after_nr = line_geom.vertexNrFromVertexId(vertex_after_id)
+                    vertices_dict[dist_along_line] = [nearest_point,point_on_line,vertex_after_nr,vertex_after_nr]
+            elif line_reference is not None and nearest_points:
+                # points which were not projected while gathering them are projected in one batch instead of locating,
+                # interpolating and searching the segment per point
+                unprojected = [i for i, projection in enumerate(projections) if projection is None]
+                for i, projection in zip(unprojected, line_reference.project_points([(nearest_points[i].x(), nearest_points[i].y()) for i in unprojected])):
+                    projections[i] = projection
+                for nearest_point, (dist_along_line, part, segment, t, dist2) in zip(nearest_points, projections):
+                    point_on_line = QgsPoint(*line_reference.position_xyzm(part, segment, t))
+                    vertex_after_nr = line_reference.vertex_after(part, segment)
+                    vertices_dict[dist_along_line] = [nearest_point,point_on_line,vertex_after_nr,vertex_after_nr]
                     
             vertices_dict = dict(sorted(vertices_dict.items()))
             for i, (k, v) in enumerate(vertices_dict.items()):
@@ -295,9 +314,9 @@ class DensifyLinesWithNearestPointsByCondition(QgsProcessingAlgorithm):
                     break
                 v[3] += i
                 if method == 0:
-                    new_geom.insertVertex(v[0].vertices().next(),v[3])
+                    new_geom.insertVertex(v[0],v[3])
                 else:
-                    new_geom.insertVertex(v[1].vertices().next(),v[3])
+                    new_geom.insertVertex(v[1],v[3])
             if avoid_duplicate_nodes:
                 new_geom.removeDuplicateNodes(10,True)
             
@@ -313,6 +332,48 @@ class DensifyLinesWithNearestPointsByCondition(QgsProcessingAlgorithm):
             
         return {self.OUTPUT: dest_id}
 
+    def line_reference(self, geom):
+        # linear reference on the vertex arrays of a (multi) linestring, None if it has no vertices; curves are segmentized before
+        if geom.isEmpty():
+            return None
+        if QgsWkbTypes.isCurvedType(geom.wkbType()):
+            geom = QgsGeometry(geom.constGet().segmentize())
+        return wkb_linear_reference(bytes(geom.asWkb()))
+
+    def points_near_line(self, points_layer_idx, line_reference, max_dist):
+        # (id, point, projection onto the line) of the points within max_dist of the line, nearest first like nearestNeighbor.
+        # The index is queried with the bboxes of chunks of consecutive segments, each expanded by max_dist and not much
+        # larger than it; diagonal segments are cut into pieces first, so their bboxes do not cover far more than the
+        # segment. The deduplicated candidates are then filtered by their exact distance to the line.
+        candidate_ids = set()
+        for part in line_reference.parts:
+            xs, ys = part.coordinates[0], part.coordinates[1]
+            if not xs:
+                continue
+            x_min = x_max = previous_x = xs[0]
+            y_min = y_max = previous_y = ys[0]
+            for i in range(1, len(xs)):
+                dx, dy = xs[i] - xs[i - 1], ys[i] - ys[i - 1]
+                pieces = max(math.ceil(min(abs(dx), abs(dy)) / (2 * max_dist)), 1) if max_dist > 0 else 1
+                for piece in range(1, pieces + 1):
+                    x, y = (xs[i], ys[i]) if piece == pieces else (xs[i - 1] + dx * piece / pieces, ys[i - 1] + dy * piece / pieces)
+                    if max(x_max, x) - min(x_min, x) + max(y_max, y) - min(y_min, y) > 2 * max_dist:
+                        candidate_ids.update(points_layer_idx.intersects(QgsRectangle(x_min - max_dist, y_min - max_dist, x_max + max_dist, y_max + max_dist)))
+                        x_min = x_max = previous_x
+                        y_min = y_max = previous_y
+                    x_min, x_max = min(x_min, x), max(x_max, x)
+                    y_min, y_max = min(y_min, y), max(y_max, y)
+                    previous_x, previous_y = x, y
+            candidate_ids.update(points_layer_idx.intersects(QgsRectangle(x_min - max_dist, y_min - max_dist, x_max + max_dist, y_max + max_dist)))
+        points = []
+        for point_id in candidate_ids:
+            point = points_layer_idx.geometry(point_id).vertexAt(0)
+            projection = line_reference.project(point.x(), point.y())
+            if projection is not None and projection[4] <= max_dist * max_dist:
+                points.append((point_id, point, projection))
+        points.sort(key = lambda candidate: (candidate[2][4], candidate[0]))
+        return points
+
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
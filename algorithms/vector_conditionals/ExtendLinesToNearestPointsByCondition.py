@@ -14,7 +14,7 @@ License: GNU General Public License v3.0
  ***************************************************************************/
 """
 
-import operator, processing
+import operator, processing, bisect
 from PyQt5.QtCore import QCoreApplication, QVariant
 from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPoint, QgsWkbTypes,
                        QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsExpressionContext, QgsExpressionContextUtils, QgsProcessingParameterDefinition,
@@ -288,8 +288,8 @@ class ExtendLinesToNearestPointsByCondition(QgsProcessingAlgorithm):
                 points_compare_expression_result2 = points_compare_expression2.evaluate(points_compare_expression_context2)
                 points_layer_dict2[points_feat.id()] = points_compare_expression_result2
                 feedback.setProgress(int(current * total))
-        if extend_multiple == 1: # clear skip list for layer
-            points_skip = []
+        if extend_multiple == 1: # clear skip set for layer
+            points_skip = set()
             
         source_orderby_request = QgsFeatureRequest()
         if source_orderby_expression not in (QgsExpression(''),QgsExpression(None)):
@@ -308,8 +308,8 @@ class ExtendLinesToNearestPointsByCondition(QgsProcessingAlgorithm):
         for line_feat in source_layer_vl.getFeatures(source_orderby_request):
             if feedback.isCanceled():
                 break
-            if extend_multiple == 2: # clear skip list for feature
-                points_skip = []
+            if extend_multiple == 2: # clear skip set for feature
+                points_skip = set()
             current += 1
             line_geom = line_feat.geometry()
             new_geom = QgsGeometry(line_geom.constGet().clone())
@@ -339,23 +339,21 @@ class ExtendLinesToNearestPointsByCondition(QgsProcessingAlgorithm):
             if 1 in extend_method: # geom endpoint
                 vertices_list_iterate.append(line_geom.constGet().nCoordinates() - 1)
                 vertices_list_end_geom.append(line_geom.constGet().nCoordinates() - 1)
+            # the start and end vertices of the parts follow from the vertex counts of the parts, without visiting every vertex
+            part_first_vertices = []
             vertex_id_counter = 0
-            if 3 in extend_method or 2 in extend_method:
-                for line_part_id, line_part in enumerate(line_geom.parts()):
-                    if feedback.isCanceled():
-                        break
-                    for line_part_vertex_id, line_part_vertex in enumerate(line_part.vertices()):
-                        if feedback.isCanceled():
-                            break
-                        if 2 in extend_method: # part startpoint
-                            if line_part_vertex_id == 0:
-                                vertices_list_iterate.append(vertex_id_counter)
-                                vertices_list_start_part.append(vertex_id_counter)
-                        if 3 in extend_method: # part endpoint
-                            if line_part_vertex_id == line_geom.constGet().vertexCount(line_part_id,0) - 1:
-                                vertices_list_iterate.append(vertex_id_counter)
-                                vertices_list_end_part.append(vertex_id_counter)
-                        vertex_id_counter += 1
+            for line_part_id in range(n_parts_line_geom):
+                n_vertices_part = line_geom.constGet().vertexCount(line_part_id,0)
+                if n_vertices_part == 0:
+                    continue
+                part_first_vertices.append(vertex_id_counter)
+                if 2 in extend_method: # part startpoint
+                    vertices_list_iterate.append(vertex_id_counter)
+                    vertices_list_start_part.append(vertex_id_counter)
+                if 3 in extend_method: # part endpoint
+                    vertices_list_iterate.append(vertex_id_counter + n_vertices_part - 1)
+                    vertices_list_end_part.append(vertex_id_counter + n_vertices_part - 1)
+                vertex_id_counter += n_vertices_part
             vertices_list_iterate = list(set(vertices_list_iterate))
             vertices_list_iterate.sort(reverse=True)
             try:
@@ -367,11 +365,17 @@ class ExtendLinesToNearestPointsByCondition(QgsProcessingAlgorithm):
             except:
                 pass
             
+            skip_part_id = None
             for vertex_id in vertices_list_iterate:
                 if feedback.isCanceled():
                     break
+                if extend_multiple == 3: # clear skip set for part
+                    vertex_part_id = bisect.bisect_right(part_first_vertices, vertex_id)
+                    if vertex_part_id != skip_part_id:
+                        skip_part_id = vertex_part_id
+                        points_skip = set()
                 vertex_point = line_geom.vertexAt(vertex_id)
-                vertex_point_geom = QgsGeometry.fromWkt(vertex_point.asWkt())
+                vertex_point_geom = QgsGeometry(vertex_point.clone())
                 nearest_neighbors = points_layer_idx.nearestNeighbor(vertex_point_geom, neighbors=n_neighbors, maxDistance=extend_dist_expression_result)
                 if not extend_multiple == 0:
                     nearest_neighbors = [x for x in nearest_neighbors if x not in points_skip]
@@ -384,12 +388,12 @@ class ExtendLinesToNearestPointsByCondition(QgsProcessingAlgorithm):
                         points_compare_expression_result2 = points_layer_dict2[nearest_neighbor_id]
                         if concat_op(op(source_compare_expression_result, points_compare_expression_result),op2(source_compare_expression_result2, points_compare_expression_result2)):
                             if not extend_multiple == 0:
-                                points_skip.append(nearest_neighbor_id)
+                                points_skip.add(nearest_neighbor_id)
                         else:
                             continue
                             
                     if not extend_multiple == 0:
-                        points_skip.append(nearest_neighbor_id)
+                        points_skip.add(nearest_neighbor_id)
                     if vertex_point_geom.distance(nearest_neighbor_geom) <= min_dist_expression_result: # do not extend if vertex already is on a point
                         break
                         
@@ -409,7 +413,7 @@ class ExtendLinesToNearestPointsByCondition(QgsProcessingAlgorithm):
                         test_geom = QgsGeometry.fromPolyline([new_geom.vertexAt(vertex_id),new_geom.vertexAt(vertex_id+1)])
                         if old_geom.crosses(test_geom):
                             if not extend_multiple == 0:
-                                points_skip.remove(nearest_neighbor_id)
+                                points_skip.discard(nearest_neighbor_id)
                             new_geom =  QgsGeometry(old_geom.constGet().clone()) # restore old geometry
                             continue
                     break # should actually be only one in list, but just to be sure :)
@@ -16,7 +16,7 @@ License: GNU General Public License v3.0
 
 import operator, processing
 from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPointXY, QgsWkbTypes,
+from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPointXY, QgsWkbTypes, QgsLineString, QgsMultiLineString,
                        QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsExpressionContext, QgsExpressionContextUtils, QgsProcessingParameterDefinition,
                        QgsProcessingParameterVectorLayer, QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterDistance, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterExpression, QgsProcessingParameterNumber, QgsProcessingParameterString, QgsProcessingParameterBoolean)
 
@@ -243,7 +243,7 @@ class SnapVerticesToNearestPointsByCondition(QgsProcessingAlgorithm):
                 points_layer_dict2[points_feat.id()] = points_compare_expression_result2
                 feedback.setProgress(int(current * total))
         if snap_multiple == 1: # clear skip list for layer
-            points_skip = []
+            points_skip = set()
             
         source_orderby_request = QgsFeatureRequest()
         if source_orderby_expression not in (QgsExpression(''),QgsExpression(None)):
@@ -251,96 +251,151 @@ class SnapVerticesToNearestPointsByCondition(QgsProcessingAlgorithm):
             source_orderby_request.setOrderBy(order_by)
         
         feedback.setProgressText('Start processing...')
-        # https://gis.stackexchange.com/questions/411126/modifying-specific-vertices-of-multilinestring-using-pyqgis
-        # https://gis.stackexchange.com/a/411157/107424
         source_compare_expression_context = QgsExpressionContext()
         source_compare_expression_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
         source_compare_expression_context2 = QgsExpressionContext()
         source_compare_expression_context2.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
+        points_xy = {} # point id -> (x, y), filled on first use
         for line_feat in source_layer_vl.getFeatures(source_orderby_request):
             if feedback.isCanceled():
                 break
             if snap_multiple == 2: # clear skip list for feature
-                points_skip = []    
+                points_skip = set()
             current += 1
             line_geom = line_feat.geometry()
-            new_geom = line_geom # to be modified
             line_vertex_id = 0
-            n_vertices_line_geom = len([v for i, v in enumerate(line_geom.vertices())]) # does not support len(), count() or whatever, so lets just do it complicated...
+            n_vertices_line_geom = line_geom.constGet().nCoordinates() if not line_geom.isNull() else 0
             if comparisons:
                 source_compare_expression_context.setFeature(line_feat)
                 source_compare_expression_result = source_compare_expression.evaluate(source_compare_expression_context)
                 source_compare_expression_context2.setFeature(line_feat)
                 source_compare_expression_result2 = source_compare_expression2.evaluate(source_compare_expression_context2)
-            for line_part_id, line_part in enumerate(line_geom.parts()):
+            conditions = {} # point id -> result of the conditions for this feature
+            snapped = {} # (x, y) of a vertex -> point id or None; only used if points can be used more than once
+            moves = [] # (part index, vertex id in part, vertex id in geometry, x, y) of all snapped vertices
+            for line_part_id, line_part in enumerate(line_geom.constParts()):
                 if feedback.isCanceled():
                     break
                 if snap_multiple == 3: # clear skip list for part
-                    points_skip = []
-                n_vertices_line_part = len([v for i, v in enumerate(line_part.vertices())])
-                for line_part_vertex_id, line_vertex in enumerate(line_part.vertices()):
+                    points_skip = set()
+                # the vertices to snap are taken from the coordinate arrays of the part, all other vertices are not touched
+                part_xs, part_ys = self.part_coordinates(line_part)
+                for line_part_vertex_id in self.snap_vertex_ids(snap_method, line_vertex_id, len(part_xs), n_vertices_line_geom):
                     if feedback.isCanceled():
                         break
-                    vertex_is_midpoint = True # easier than rewriting all conditions...
-                    doit = False # my lazy ass does not want to write that stuff 5 times...
-                    if line_vertex_id == 0:
-                        vertex_is_midpoint = False
-                        if 0 in snap_method:
-                            doit = True
-                    if line_vertex_id == (n_vertices_line_geom - 1):
-                        vertex_is_midpoint = False
-                        if 1 in snap_method:
-                            doit = True
-                    if line_part_vertex_id == 0:
-                        vertex_is_midpoint = False
-                        if 2 in snap_method:
-                            doit = True
-                    if line_part_vertex_id == (n_vertices_line_part - 1):
-                        vertex_is_midpoint = False
-                        if 3 in snap_method:
-                            doit = True
-                    if vertex_is_midpoint is True:
-                        if 4 in snap_method:
-                            doit = True
-                    
-                    if doit:
-                        nearest_neighbors = points_layer_idx.nearestNeighbor(QgsPointXY(line_vertex), neighbors=n_neighbors, maxDistance=snap_dist)
-                        if not snap_multiple == 0:
-                            nearest_neighbors = [x for x in nearest_neighbors if x not in points_skip]
-                        for nearest_neighbor_id in nearest_neighbors:
+                    vertex_xy = (part_xs[line_part_vertex_id], part_ys[line_part_vertex_id])
+                    if snap_multiple == 0 and vertex_xy in snapped:
+                        nearest_neighbor_id = snapped[vertex_xy]
+                    else:
+                        nearest_neighbor_id = None
+                        for candidate_id in self.nearest_neighbors(points_layer_idx, QgsPointXY(*vertex_xy), snap_dist, comparisons):
                             if feedback.isCanceled():
                                 break
+                            if snap_multiple != 0 and candidate_id in points_skip:
+                                if comparisons:
+                                    continue
+                                break # without conditions only the nearest point is a candidate
                             if comparisons:
-                                points_compare_expression_result = points_layer_dict[nearest_neighbor_id]
-                                points_compare_expression_result2 = points_layer_dict2[nearest_neighbor_id]
-                                if concat_op(op(source_compare_expression_result, points_compare_expression_result),op2(source_compare_expression_result2, points_compare_expression_result2)):
-                                    nearest_neighbor_geom = points_layer_idx.geometry(nearest_neighbor_id)
-                                    new_geom.moveVertex(nearest_neighbor_geom.asPoint().x(),nearest_neighbor_geom.asPoint().y(), line_vertex_id)
-                                    if not snap_multiple == 0:
-                                        points_skip.append(nearest_neighbor_id)
-                                    break # stop testing after first match
-                                else:
+                                if candidate_id not in conditions:
+                                    conditions[candidate_id] = concat_op(op(source_compare_expression_result, points_layer_dict[candidate_id]),op2(source_compare_expression_result2, points_layer_dict2[candidate_id]))
+                                if not conditions[candidate_id]:
                                     continue
-                            else:
-                                nearest_neighbor_geom = points_layer_idx.geometry(nearest_neighbor_id)
-                                new_geom.moveVertex(nearest_neighbor_geom.asPoint().x(),nearest_neighbor_geom.asPoint().y(), line_vertex_id)
-                                if not snap_multiple == 0:
-                                    points_skip.append(nearest_neighbor_id)
-                                break # should actually be only one in list, but just to be sure :)
-                    line_vertex_id += 1 # line_part_vertex_id is not the same!
+                            nearest_neighbor_id = candidate_id
+                            break # stop testing after first match
+                        if snap_multiple == 0:
+                            snapped[vertex_xy] = nearest_neighbor_id
+                    if nearest_neighbor_id is not None:
+                        if nearest_neighbor_id not in points_xy:
+                            nearest_neighbor_point = points_layer_idx.geometry(nearest_neighbor_id).asPoint()
+                            points_xy[nearest_neighbor_id] = (nearest_neighbor_point.x(), nearest_neighbor_point.y())
+                        moves.append((line_part_id, line_part_vertex_id, line_vertex_id + line_part_vertex_id) + points_xy[nearest_neighbor_id])
+                        if snap_multiple != 0:
+                            points_skip.add(nearest_neighbor_id)
+                line_vertex_id += len(part_xs) # line_part_vertex_id is not the same!
                     
             new_feat = QgsFeature(output_layer_fields)
-            attridx = 0
-            for attr in line_feat.attributes():
-                new_feat[attridx] = attr
-                attridx += 1
-            new_feat.setGeometry(new_geom)
+            new_feat.setAttributes(line_feat.attributes())
+            new_feat.setGeometry(self.moved_geometry(line_geom, moves))
             
             sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
             feedback.setProgress(int(current * total))
             
         return {self.OUTPUT: dest_id}
 
+    def part_coordinates(self, part):
+        # (x values, y values) of all vertices of a part
+        if isinstance(part, QgsLineString):
+            return part.xVector(), part.yVector()
+        vertices = [(vertex.x(), vertex.y()) for vertex in part.vertices()]
+        return [vertex[0] for vertex in vertices], [vertex[1] for vertex in vertices]
+
+    def snap_vertex_ids(self, snap_method, first_vertex_id, n_vertices_part, n_vertices_geom):
+        # ascending ids of the vertices of a part to snap; first_vertex_id is the id of the first vertex of the part in the whole geometry
+        last = n_vertices_part - 1
+        def end_vertex_is_snapped(part_vertex_id):
+            vertex_id = first_vertex_id + part_vertex_id
+            return ((vertex_id == 0 and 0 in snap_method) or (vertex_id == n_vertices_geom - 1 and 1 in snap_method) or
+                    (part_vertex_id == 0 and 2 in snap_method) or (part_vertex_id == last and 3 in snap_method))
+        vertex_ids = []
+        if n_vertices_part == 0:
+            return vertex_ids
+        if end_vertex_is_snapped(0):
+            vertex_ids.append(0)
+        if 4 in snap_method: # all vertices between the first and the last vertex of the part
+            vertex_ids.extend(range(1, last))
+        if last > 0 and end_vertex_is_snapped(last):
+            vertex_ids.append(last)
+        return vertex_ids
+
+    def nearest_neighbors(self, index, point, max_dist, all_candidates):
+        # yields the ids of the nearest points in ascending distance; only the nearest one is requested from the index
+        # unless all_candidates is set, then the number of requested neighbors grows until the index has no more points
+        if not all_candidates:
+            yield from index.nearestNeighbor(point, neighbors = 1, maxDistance = max_dist)[:1]
+            return
+        yielded = set()
+        n_neighbors = 8
+        while True:
+            nearest_neighbors = index.nearestNeighbor(point, neighbors = n_neighbors, maxDistance = max_dist)
+            for neighbor_id in nearest_neighbors:
+                if neighbor_id not in yielded:
+                    yielded.add(neighbor_id)
+                    yield neighbor_id
+            if len(nearest_neighbors) < n_neighbors:
+                return
+            n_neighbors *= 4
+
+    def moved_geometry(self, geom, moves):
+        # returns geom with the vertices moved as listed in moves; line parts are rebuilt once from their modified coordinate arrays
+        if not moves:
+            return geom
+        parts = [part for part in geom.constParts()]
+        if not all(isinstance(part, QgsLineString) for part in parts):
+            new_geom = QgsGeometry(geom)
+            for line_part_id, line_part_vertex_id, line_vertex_id, x, y in moves:
+                new_geom.moveVertex(x, y, line_vertex_id)
+            return new_geom
+        part_moves = {}
+        for line_part_id, line_part_vertex_id, line_vertex_id, x, y in moves:
+            part_moves.setdefault(line_part_id, []).append((line_part_vertex_id, x, y))
+        new_parts = []
+        for line_part_id, part in enumerate(parts):
+            if line_part_id not in part_moves:
+                new_parts.append(part.clone())
+                continue
+            xs = part.xVector()
+            ys = part.yVector()
+            for line_part_vertex_id, x, y in part_moves[line_part_id]:
+                xs[line_part_vertex_id] = x
+                ys[line_part_vertex_id] = y
+            new_parts.append(QgsLineString(xs, ys, part.zVector() if part.is3D() else [], part.mVector() if part.isMeasure() else []))
+        if not geom.isMultipart():
+            return QgsGeometry(new_parts[0])
+        new_multiline = QgsMultiLineString()
+        for new_part in new_parts:
+            new_multiline.addGeometry(new_part)
+        return QgsGeometry(new_multiline)
+
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
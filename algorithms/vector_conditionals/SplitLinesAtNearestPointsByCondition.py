@@ -16,9 +16,10 @@ License: GNU General Public License v3.0
 
 import operator, processing
 from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPointXY, QgsWkbTypes, 
+from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPoint, QgsPointXY, QgsWkbTypes, QgsLineString, QgsMultiLineString,
                        QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsExpressionContext, QgsExpressionContextUtils, QgsProcessingParameterDefinition,
                        QgsProcessingParameterVectorLayer, QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterDistance, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterExpression, QgsProcessingParameterNumber, QgsProcessingParameterString, QgsProcessingParameterBoolean)
+from ..tools.LinearReferencing import wkb_linear_reference
 
 class SplitLinesAtNearestPointsByCondition(QgsProcessingAlgorithm):
     SOURCE_LYR = 'SOURCE_LYR'
@@ -280,6 +281,7 @@ class SplitLinesAtNearestPointsByCondition(QgsProcessingAlgorithm):
             max_dist_expression_context.setFeature(line_feat)
             max_dist_expression_result = max_dist_expression.evaluate(max_dist_expression_context)
             nearest_point_ids = points_layer_idx.nearestNeighbor(line_geom,-1,max_dist_expression_result)
+            nearest_points = []
             for nearest_point_id in nearest_point_ids:
                 if feedback.isCanceled():
                     break
@@ -290,35 +292,40 @@ class SplitLinesAtNearestPointsByCondition(QgsProcessingAlgorithm):
                         pass
                     else:
                         continue
-                nearest_point_geom = points_layer_idx.geometry(nearest_point_id)
-                dist_along_line = line_geom.lineLocatePoint(nearest_point_geom)
-                point_on_line = line_geom.interpolate(dist_along_line)
-                vertex_after_id = line_geom.constGet().closestSegment(point_on_line.vertices().next(),10)[2]
-                vertex_after_nr_old = line_geom.vertexNrFromVertexId(vertex_after_id)
-                vertex_after_nr_new = line_geom.vertexNrFromVertexId(vertex_after_id)
-                try:
-                    vertices_dict[dist_along_line] = [nearest_point_geom,point_on_line,vertex_after_nr_old,vertex_after_nr_new]
-                except:
-                    pass
+                nearest_points.append(points_layer_idx.geometry(nearest_point_id).vertexAt(0))
+            
+            line_reference = self.line_reference(line_geom) if nearest_points else None
+            if line_reference is not None:
+                # all points are projected onto the line in one batch instead of locating, interpolating and searching the segment per point
+                projections = line_reference.project_points([(point.x(), point.y()) for point in nearest_points])
+                for nearest_point, (dist_along_line, part, segment, t, dist2) in zip(nearest_points, projections):
+                    point_on_line = QgsPoint(*line_reference.position_xyzm(part, segment, t))
+                    vertex_after_nr = line_reference.vertex_after(part, segment)
+                    vertices_dict[dist_along_line] = [nearest_point,point_on_line,vertex_after_nr,vertex_after_nr]
             
             # densify the geometry with the nearest points, sorted by distance from start
             vertices_dict = dict(sorted(vertices_dict.items()))
             from_to_list = []
             densified_geom = line_feat.geometry()
+            if QgsWkbTypes.isCurvedType(densified_geom.wkbType()):
+                # inserting, counting and slicing the vertices all use the vertex numbers of the segmentized line, like the line reference
+                densified_geom = QgsGeometry(densified_geom.constGet().segmentize())
             for i, (k, v) in enumerate(vertices_dict.items()):
                 if feedback.isCanceled():
                     break
                 v[3] += i
                 if method == 0:
-                    densified_geom.insertVertex(v[0].vertices().next(),v[3])
+                    densified_geom.insertVertex(v[0],v[3])
                 else:
-                    densified_geom.insertVertex(v[1].vertices().next(),v[3])
+                    densified_geom.insertVertex(v[1],v[3])
                 from_to_list.append(v[3])
                 
             max_vert = densified_geom.constGet().nCoordinates() - 1
             from_to_list.append(0)
             from_to_list.append(max_vert)
             from_to_list.sort()
+            # the vertex arrays of the parts are read once, the new lines are sliced from them
+            densified_parts = self.part_arrays(densified_geom)
             
             # create the new lines from start vertices to their end vertices
             for from_to_index, from_to_value in enumerate(from_to_list):
@@ -330,26 +337,8 @@ class SplitLinesAtNearestPointsByCondition(QgsProcessingAlgorithm):
                 try:
                     to_vert = from_to_list[from_to_index+1]
                 except IndexError:
-                    to_vert = densified_geom.constGet().nCoordinates() - 1
-                # create a deep copy so we can safely modify the geometry
-                new_geom = QgsGeometry(densified_geom.constGet().clone())
-                keep_vert_index = list(range(from_vert,to_vert+1))
-                vertices_deleted = 0
-                del_vert = 0
-                for vert_index in range(0,densified_geom.constGet().nCoordinates()):
-                    if feedback.isCanceled():
-                        break
-                    if vert_index in keep_vert_index:
-                        del_vert += 1
-                        continue
-                    # if the second last vertex of a part gets deleted, two vertices are deleted at the same time
-                    # because there is no response about this, we need to somehow figure out when that happened
-                    del_diff = densified_geom.constGet().nCoordinates() - (new_geom.constGet().nCoordinates() + vertices_deleted)
-                    if del_diff > 0:
-                        vertices_deleted += 1
-                        continue
-                    new_geom.deleteVertex(del_vert)
-                    vertices_deleted += 1
+                    to_vert = max_vert
+                new_geom = self.slice_geometry(densified_parts, from_vert, to_vert, densified_geom.isMultipart())
                     
                 if drop_length_expression_result < 0:
                     pass
@@ -397,6 +386,40 @@ class SplitLinesAtNearestPointsByCondition(QgsProcessingAlgorithm):
             
         return {self.OUTPUT: dest_id}
 
+    def line_reference(self, geom):
+        # linear reference on the vertex arrays of a (multi) linestring, None if it has no vertices; curves are segmentized before
+        if geom.isEmpty():
+            return None
+        if QgsWkbTypes.isCurvedType(geom.wkbType()):
+            geom = QgsGeometry(geom.constGet().segmentize())
+        return wkb_linear_reference(bytes(geom.asWkb()))
+
+    def part_arrays(self, geom):
+        # (vertex number of the first vertex, x, y, z or None, m or None) for every part of a linear geometry; curves
+        # must be segmentized before, otherwise the vertex numbers would not match those of the geometry
+        part_arrays = []
+        first_vert = 0
+        for part in geom.constParts():
+            part_arrays.append((first_vert, part.xVector(), part.yVector(), part.zVector() if part.is3D() else None, part.mVector() if part.isMeasure() else None))
+            first_vert += part.numPoints()
+        return part_arrays
+
+    def slice_geometry(self, part_arrays, from_vert, to_vert, multipart):
+        # the line between the vertex numbers from_vert and to_vert; parts keeping less than two vertices are left out
+        lines = []
+        for first_vert, xs, ys, zs, ms in part_arrays:
+            start = max(from_vert - first_vert, 0)
+            end = min(to_vert - first_vert, len(xs) - 1) + 1
+            if end - start < 2:
+                continue
+            lines.append(QgsLineString(xs[start:end], ys[start:end], zs[start:end] if zs is not None else [], ms[start:end] if ms is not None else []))
+        if not multipart:
+            return QgsGeometry(lines[0]) if lines else QgsGeometry()
+        new_multiline = QgsMultiLineString()
+        for line in lines:
+            new_multiline.addGeometry(line)
+        return QgsGeometry(new_multiline)
+
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -14,12 +14,14 @@ License: GNU General Public License v3.0
  ***************************************************************************/
 """
 
-import operator, processing, math
+import operator, processing, math, re
 from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFields, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometryEngine, QgsGeometry, QgsPointXY, QgsPoint, QgsRectangle, QgsWkbTypes, 
-                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsExpressionContext, QgsExpressionContextUtils,
+from qgis.core import (QgsField, QgsFields, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometryEngine, QgsGeometry, QgsPointXY, QgsPoint, QgsRectangle, QgsWkbTypes, QgsCoordinateTransform, 
+                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsExpressionContext, QgsExpressionContextUtils, QgsProcessingParameterDefinition,
                        QgsProcessingParameterFeatureSink, QgsProcessingParameterBoolean, QgsProcessingParameterField, QgsProcessingParameterExtent, QgsProcessingParameterDistance, QgsProcessingParameterFeatureSource, 
                        QgsProcessingParameterEnum, QgsProcessingParameterExpression, QgsProcessingParameterNumber, QgsProcessingParameterString)
+from .NestedGridCells import nested_grid_band
+from ..tools.WorkerPool import WorkerPool
 
 class CreateNestedGrid(QgsProcessingAlgorithm):
     EXTENT = 'EXTENT'
@@ -31,6 +33,8 @@ class CreateNestedGrid(QgsProcessingAlgorithm):
     XFACTOR = 'XFACTOR'
     YFACTOR = 'YFACTOR'
     STARTWITHPARENT = 'STARTWITHPARENT'
+    MASK = 'MASK'
+    WORKERS = 'WORKERS'
     OUTPUT = 'OUTPUT'
     
     # Source: https://stackoverflow.com/a/12334507 (modified)
@@ -45,18 +49,14 @@ class CreateNestedGrid(QgsProcessingAlgorithm):
             del result[-1]
         return result
     
-    # Source: https://stackoverflow.com/a/42176641/8947209
-    def num_to_char(self, n):
-        if n < 1:
-            raise ValueError("Number must be positive")
-        result = ""
-        while True:
-            if n > 26:
-                n, r = divmod(n - 1, 26)
-                result = chr(r + ord('A')) + result
-            else:
-                return chr(n + ord('A') - 1) + result
-        
+    def mask_test(self, mask_engine, x_left, y_top, width, height, deepest):
+        # returns 0 if the cell is outside the mask, 1 if it intersects the mask and 2 if it is completely within the mask
+        cell_geom = QgsGeometry.fromRect(QgsRectangle(x_left, y_top - height, x_left + width, y_top))
+        if not mask_engine.intersects(cell_geom.constGet()):
+            return 0
+        if deepest or not mask_engine.contains(cell_geom.constGet()): # no need to know whether the deepest cells are within, they have no childs
+            return 1
+        return 2
         
     def initAlgorithm(self, config=None):
         
@@ -87,6 +87,13 @@ class CreateNestedGrid(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterNumber(
                 self.YFACTOR, self.tr('Y-Factor: Number of childcells per parentcell in Y direction'), minValue = 1, maxValue = 9999, defaultValue = 2, type = QgsProcessingParameterNumber.Integer))
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.MASK, self.tr('Mask: only create cells intersecting these polygons (childcells are only created within parentcells intersecting the mask)'), [QgsProcessing.TypeVectorPolygon], optional = True))
+        parameter_workers = QgsProcessingParameterNumber(
+                self.WORKERS, self.tr('Number of worker processes creating the cells in parallel (1 means no parallel processing)'), minValue = 1, maxValue = 256, defaultValue = 1, type = QgsProcessingParameterNumber.Integer)
+        parameter_workers.setFlags(parameter_workers.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_workers)
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT, self.tr('Grid')))
@@ -103,6 +110,8 @@ class CreateNestedGrid(QgsProcessingAlgorithm):
         xfactor = self.parameterAsDouble(parameters, self.XFACTOR, context)
         yfactor = self.parameterAsDouble(parameters, self.YFACTOR, context)
         startwithparent = self.parameterAsBool(parameters, self.STARTWITHPARENT, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+        mask_source = self.parameterAsSource(parameters, self.MASK, context)
         polygonsides = {
             0: 4, # Rectangle
             1: 6 # Hexagon
@@ -168,105 +177,93 @@ class CreateNestedGrid(QgsProcessingAlgorithm):
                 cells_per_subgrid[i] = childcells_per_parentcell * n_parentgrids_t
                 xcells_per_subgrid[i] = int(xfactor**(i-1) * n_parentgrids_x)
                 ycells_per_subgrid[i] = int(yfactor**(i-1) * n_parentgrids_y)
+            
+            mask_status = {}
+            if mask_source is not None:
+                mask_transform = QgsCoordinateTransform(mask_source.sourceCrs(), extent_crs, context.transformContext())
+                mask_geoms = []
+                for mask_feat in mask_source.getFeatures():
+                    if feedback.isCanceled():
+                        break
+                    mask_geom = mask_feat.geometry()
+                    if mask_geom.isNull() or mask_geom.isEmpty():
+                        continue
+                    mask_geom.transform(mask_transform)
+                    mask_geoms.append(mask_geom)
+                if feedback.isCanceled():
+                    return {}
+                mask_geom = QgsGeometry.unaryUnion(mask_geoms) if mask_geoms else QgsGeometry()
+                if mask_geom.isNull() or mask_geom.isEmpty():
+                    feedback.reportError('The mask layer contains no valid geometries!', fatalError = True)
+                    return {}
+                mask_engine = QgsGeometry.createGeometryEngine(mask_geom.constGet())
+                mask_engine.prepareGeometry()
+                # Status per cell and subgrid: 0 = outside mask, 1 = intersects mask, 2 = completely within mask.
+                # Only childcells of intersecting parentcells are tested, childcells of parentcells within the mask are taken without testing.
+                for subgrid in range(1,subgrids+1):
+                    if feedback.isCanceled():
+                        break
+                    feedback.setProgressText('Testing cells of subgrid #' + str(subgrid) + ' against mask...')
+                    n_x = xcells_per_subgrid[subgrid]
+                    n_y = ycells_per_subgrid[subgrid]
+                    cell_width = xspacing / xfactor**(subgrid-1)
+                    cell_height = yspacing / yfactor**(subgrid-1)
+                    deepest = subgrid == subgrids
+                    status = bytearray(n_x * n_y)
+                    if subgrid == 1:
+                        for row in range(n_y):
+                            for column in range(n_x):
+                                status[row * n_x + column] = self.mask_test(mask_engine, extent_rect.xMinimum() + column * cell_width, extent_rect.yMaximum() - row * cell_height, cell_width, cell_height, deepest)
+                    else:
+                        parent_status = mask_status[subgrid-1]
+                        parent_n_x = xcells_per_subgrid[subgrid-1]
+                        fx = int(xfactor)
+                        fy = int(yfactor)
+                        for match in re.finditer(b'[^\x00]', parent_status): # skips all parentcells outside the mask at once
+                            if feedback.isCanceled():
+                                break
+                            parent_row, parent_column = divmod(match.start(), parent_n_x)
+                            for row in range(parent_row * fy, parent_row * fy + fy):
+                                if parent_status[match.start()] == 2:
+                                    status[row * n_x + parent_column * fx:row * n_x + parent_column * fx + fx] = b'\x02' * fx
+                                    continue
+                                for column in range(parent_column * fx, parent_column * fx + fx):
+                                    status[row * n_x + column] = self.mask_test(mask_engine, extent_rect.xMinimum() + column * cell_width, extent_rect.yMaximum() - row * cell_height, cell_width, cell_height, deepest)
+                    mask_status[subgrid] = status
+                    cells_per_subgrid[subgrid] = len(status) - status.count(0)
+                n_totalcells = sum(cells_per_subgrid.values())
+            
             if n_totalcells > 1000000:
-                feedback.pushWarning('Settings will create ' + str(n_parentgrids_t) + ' parent-gridcells and ' + str(n_totalcells-n_parentgrids_t) + ' child-gridcells for ' + str(subgrids-1) + ' childgrids (= ' + str(n_totalcells) + ' gridcells in total)')
+                feedback.pushWarning('Settings will create ' + str(cells_per_subgrid[1]) + ' parent-gridcells and ' + str(n_totalcells-cells_per_subgrid[1]) + ' child-gridcells for ' + str(subgrids-1) + ' childgrids (= ' + str(n_totalcells) + ' gridcells in total)')
                 feedback.pushWarning('This may take a while!')
                 feedback.pushWarning('Consider choosing a smaller extent, fewer subgrids, a greater spacing or a lower x/y factor')
             else:
-                feedback.setProgressText('Settings will create ' + str(n_parentgrids_t) + ' parent-gridcells and ' + str(n_totalcells-n_parentgrids_t) + ' child-gridcells for ' + str(subgrids-1) + ' childgrids (= ' + str(n_totalcells) + ' gridcells in total)')
+                feedback.setProgressText('Settings will create ' + str(cells_per_subgrid[1]) + ' parent-gridcells and ' + str(n_totalcells-cells_per_subgrid[1]) + ' child-gridcells for ' + str(subgrids-1) + ' childgrids (= ' + str(n_totalcells) + ' gridcells in total)')
                 
             total = 100.0 / n_totalcells if n_totalcells > 0 else 0
             current = 0
             
+            # Every subgrid is split into bands of rows. A band is fully described by its subgrid, its rows and the fid of
+            # the first cell of the subgrid, so bands can be created independently by worker processes. They are written
+            # in fid order and only a few bands are held in memory at once, regardless of the total number of cells.
+            band_cells = 20000
+            tasks = []
             fid = 1
             for subgrid in iterationrange:
-                if feedback.isCanceled():
-                    break
-                if subgrid == 1:
-                    feedback.setProgressText('Creating ' + str(cells_per_subgrid[subgrid]) + ' cells for Parentgrid #' + str(subgrid) + '...')
-                else:
-                    feedback.setProgressText('Creating ' + str(cells_per_subgrid[subgrid]) + ' cells for Subgrid #' + str(subgrid) + '...')
-                p_x_id = 1
-                p_y_id = 1
-                c_x_id = 1
-                c_y_id = 1
-                parentcellindicator_x = 1
-                parentcellindicator_y = 1
-                
-                start_pointxy = QgsPointXY(extent_rect.xMinimum(),extent_rect.yMaximum())
-                point_topleft_pxy = start_pointxy
-                
-                for currenty in range(1,ycells_per_subgrid[subgrid]+1):
-                    if feedback.isCanceled():
-                        break
-                    # reset x on start of each y row:
-                    point_topleft_pxy = QgsPointXY(start_pointxy.x(),point_topleft_pxy.y())
-                    
-                    for currentx in range(1,xcells_per_subgrid[subgrid]+1):
-                        if feedback.isCanceled():
-                            break
-                        point_topright_pxy = point_topleft_pxy.project(step_x,90)
-                        point_lowerright_pxy = point_topright_pxy.project(step_y,180)
-                        point_lowerleft_pxy = point_lowerright_pxy.project(step_x,270)
-                        grid_geom = [point_topleft_pxy,
-                                     point_topright_pxy,
-                                     point_lowerright_pxy,
-                                     point_lowerleft_pxy,
-                                     point_topleft_pxy]
-                        grid_geom = QgsGeometry.fromPolygonXY([grid_geom])
-                        new_feat = QgsFeature(output_layer_fields)
-                        new_feat.setGeometry(grid_geom)
-                        new_feat['x_cent'] = grid_geom.centroid().asPoint().x()
-                        new_feat['y_cent'] = grid_geom.centroid().asPoint().y()
-                        new_feat['v_coords'] = ';'.join([str(vert.x())+','+str(vert.y()) for vert in grid_geom.vertices()])
-                        new_feat['x_space'] = step_x
-                        new_feat['y_space'] = step_y
-                        new_feat['fid'] = fid
-                        uid = str(subgrid).zfill(len(str(subgrids)))
-                        if 0 in letters:
-                            new_feat['p_x_id'] = self.num_to_char(p_x_id)
-                            new_feat['c_x_id'] = self.num_to_char(c_x_id)
-                            uid = uid + '_' + self.num_to_char(p_x_id) + '_' + self.num_to_char(c_x_id)
-                        else:
-                            new_feat['p_x_id'] = p_x_id
-                            new_feat['c_x_id'] = c_x_id
-                            uid = uid + '_' + str(p_x_id) + '_' + str(c_x_id)
-                        if 1 in letters:
-                            new_feat['p_y_id'] = self.num_to_char(p_y_id)
-                            new_feat['c_y_id'] = self.num_to_char(c_y_id)
-                            uid = uid + '_' + self.num_to_char(p_y_id) + '_' + self.num_to_char(c_y_id)
-                        else:
-                            new_feat['p_y_id'] = p_y_id
-                            new_feat['c_y_id'] = c_y_id
-                            uid = uid + '_' + str(p_y_id) + '_' + str(c_y_id)
-                        new_feat['s_id'] = subgrid
-                        new_feat['uid'] = uid
-                    
-                        sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
-                        fid += 1
-                    
-                        current += 1
-                        feedback.setProgress(int(current * total))
-                    
-                        #next x:
-                        point_topleft_pxy = QgsPointXY(point_topleft_pxy.x()+step_x,point_topleft_pxy.y())
-                        if xfactor**(subgrid-1) == parentcellindicator_x:
-                            p_x_id += 1
-                            parentcellindicator_x = 0
-                        parentcellindicator_x += 1
-                        c_x_id += 1
-                    
-                    #next y (reset x):
-                    point_topleft_pxy = QgsPointXY(start_pointxy.x(),point_topleft_pxy.y() - step_y)
-                    parentcellindicator_x = 1
-                    p_x_id = 1
-                    c_x_id = 1
-                    if yfactor**(subgrid-1) == parentcellindicator_y:
-                        p_y_id += 1
-                        parentcellindicator_y = 0
-                    parentcellindicator_y += 1
-                    c_y_id += 1
-                        
+                n_x = xcells_per_subgrid[subgrid]
+                n_y = ycells_per_subgrid[subgrid]
+                rows_per_band = max(1, band_cells // n_x) if n_x > 0 else 1
+                for row_start in range(0, n_y, rows_per_band):
+                    row_end = min(row_start + rows_per_band, n_y)
+                    band_mask = None
+                    if subgrid in mask_status:
+                        band_mask = bytes(mask_status[subgrid][row_start * n_x:row_end * n_x])
+                        if band_mask.count(0) == len(band_mask): # band lies completely outside the mask
+                            continue
+                    tasks.append((subgrid, subgrids, fid, extent_rect.xMinimum(), extent_rect.yMaximum(), step_x, step_y,
+                                  n_x, n_y, xfactor**(subgrid-1), yfactor**(subgrid-1), 0 in letters, 1 in letters,
+                                  row_start, row_end, band_mask))
+                fid += n_x * n_y
                 #next subgrid:
                 if startwithparent:
                     step_x = step_x / xfactor
@@ -274,6 +271,29 @@ class CreateNestedGrid(QgsProcessingAlgorithm):
                 else:
                     step_x = step_x * xfactor
                     step_y = step_y * yfactor
+            
+            current_subgrid = None
+            with WorkerPool(workers, feedback) as pool:
+                for subgrid, row_start, cells in pool.imap(nested_grid_band, tasks):
+                    if feedback.isCanceled():
+                        break
+                    if subgrid != current_subgrid:
+                        current_subgrid = subgrid
+                        if subgrid == 1:
+                            feedback.setProgressText('Creating ' + str(cells_per_subgrid[subgrid]) + ' cells for Parentgrid #' + str(subgrid) + '...')
+                        else:
+                            feedback.setProgressText('Creating ' + str(cells_per_subgrid[subgrid]) + ' cells for Subgrid #' + str(subgrid) + '...')
+                    batch = []
+                    for wkb, attrs in cells:
+                        grid_geom = QgsGeometry()
+                        grid_geom.fromWkb(wkb)
+                        new_feat = QgsFeature(output_layer_fields)
+                        new_feat.setGeometry(grid_geom)
+                        new_feat.setAttributes(attrs)
+                        batch.append(new_feat)
+                    sink.addFeatures(batch, QgsFeatureSink.FastInsert)
+                    current += len(batch)
+                    feedback.setProgress(int(current * total))
                 
         """
         elif gridtype == 1:
@@ -306,6 +326,7 @@ class CreateNestedGrid(QgsProcessingAlgorithm):
         return self.tr('This Algorithm creates a nested grid, where the gridsize is specified for the parentgrid. You may also choose how many cells a child shall have in x- and y-direction.'
                        '\n You can also choose giving one or both axis letters as ids instead of numbers. These letters follow the Excel-Style-Column-Naming.'
                        '\n Each childgrid also has the id of its parent it lies within assigned.'
+                       '\n Optionally a mask polygon layer can be given. Then only cells intersecting the mask are created; childcells are only tested and created within parentcells intersecting the mask, which saves a lot of time for irregular study areas. The ids of a cell are the same as without mask.'
                        '\n Meaning of the attributes:'
                        '\n - fid: unique feature id'
                        '\n - uid: unique id of a cell: s_id + _ + p_x_id + _ + c_x_id + _ + p_y_id + _ + c_y_id'
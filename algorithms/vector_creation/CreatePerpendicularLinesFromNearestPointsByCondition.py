@@ -13,11 +13,13 @@ License: GNU General Public License v3.0
  ***************************************************************************/
 """
 
-import processing, math, operator
+import processing, operator, collections
 from PyQt5.QtCore import QCoreApplication, QVariant
 from qgis.core import (QgsField, QgsFields, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPoint, QgsPointXY, QgsWkbTypes, QgsCoordinateReferenceSystem,
                        QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsExpressionContext, QgsExpressionContextUtils, QgsProcessingParameterDefinition, QgsProcessingParameterVectorLayer,
-                       QgsProcessingParameterFeatureSink, QgsProcessingParameterFeatureSource, QgsProcessingParameterExpression, QgsProcessingParameterEnum, QgsProcessingParameterBoolean)
+                       QgsProcessingParameterFeatureSink, QgsProcessingParameterFeatureSource, QgsProcessingParameterExpression, QgsProcessingParameterEnum, QgsProcessingParameterBoolean, QgsProcessingParameterNumber)
+from .PerpendicularLines import perpendicular_batch
+from ..tools.WorkerPool import WorkerPool
 
 class CreatePerpendicularLinesFromNearestPointsByCondition(QgsProcessingAlgorithm):
     SOURCE_LYR = 'SOURCE_LYR'
@@ -37,8 +39,12 @@ class CreatePerpendicularLinesFromNearestPointsByCondition(QgsProcessingAlgorith
     OPERATION = 'OPERATION'
     OPERATION2 = 'OPERATION2'
     CONCAT_OPERATION = 'CONCAT_OPERATION'
+    WORKERS = 'WORKERS'
     OUTPUT = 'OUTPUT'
 
+    BATCH_SIZE = 1000 # points per task of a worker process
+    CACHE_SIZE = 1024 # lines kept as WKB
+
     def initAlgorithm(self, config=None):
         self.addParameter(
             QgsProcessingParameterVectorLayer(
@@ -107,6 +113,11 @@ class CreatePerpendicularLinesFromNearestPointsByCondition(QgsProcessingAlgorith
         parameter_overlay_compare_expression2.setFlags(parameter_overlay_compare_expression2.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
         self.addParameter(parameter_overlay_compare_expression2)
         
+        parameter_workers = QgsProcessingParameterNumber(
+                self.WORKERS, self.tr('Number of worker processes creating the perpendicular lines in parallel (1 means no parallel processing)'), minValue = 1, maxValue = 256, defaultValue = 1, type = QgsProcessingParameterNumber.Integer)
+        parameter_workers.setFlags(parameter_workers.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_workers)
+        
         ### Output ###
         self.addParameter(
             QgsProcessingParameterFeatureSink(
@@ -129,6 +140,7 @@ class CreatePerpendicularLinesFromNearestPointsByCondition(QgsProcessingAlgorith
         source_orderby_expression = self.parameterAsExpression(parameters, self.SOURCE_LYR_ORDERBY, context)
         source_orderby_expression = QgsExpression(source_orderby_expression)
         first_match_only = self.parameterAsBool(parameters, self.FIRST_MATCH_ONLY, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
         
         source_filter_expression = self.parameterAsExpression(parameters, self.SOURCE_FILTER_EXPRESSION, context)
         source_filter_expression = QgsExpression(source_filter_expression)
@@ -285,120 +297,152 @@ class CreatePerpendicularLinesFromNearestPointsByCondition(QgsProcessingAlgorith
             source_orderby_request.setOrderBy(order_by)
         
         feedback.setProgressText('Start processing...')
-        overlay_skip = []
-        max_dist_expression_context = QgsExpressionContext()
-        max_dist_expression_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
-        max_neighbors_expression_context = QgsExpressionContext()
-        max_neighbors_expression_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
-        line_length_expression_context = QgsExpressionContext()
-        line_length_expression_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
-        if comparisons:
-            source_compare_expression_context = QgsExpressionContext()
-            source_compare_expression_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
-            source_compare_expression_context2 = QgsExpressionContext()
-            source_compare_expression_context2.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
-        for source_feat in source_layer_vl.getFeatures(source_orderby_request):
-            if feedback.isCanceled():
-                break
-            current += 1
-            max_dist_expression_context.setFeature(source_feat)
-            max_dist_expression_result = max_dist_expression.evaluate(max_dist_expression_context)
-            max_neighbors_expression_context.setFeature(source_feat)
-            max_neighbors_expression_result = max_neighbors_expression.evaluate(max_neighbors_expression_context)
-            line_length_expression_context.setFeature(source_feat)
-            line_length_expression_result = line_length_expression.evaluate(line_length_expression_context)
-            
-            expression_errors = []
-            try:
-                max_dist_expression_result = float(max_dist_expression_result)
-            except:
-                expression_errors.append(' an invalid maximum distance expression')
-            try:
-                max_neighbors_expression_result = int(max_neighbors_expression_result)
-            except:
-                expression_errors.append(' an invalid maximum neighbors expression')
-            try:
-                line_length_expression_result = float(line_length_expression_result)
-                if not line_length_expression_result > 0:
-                    expression_errors.append(' an invalid line length expression')
-            except:
-                expression_errors.append(' an invalid line length expression')
-            
-            if expression_errors:
-                expression_errors = list(dict.fromkeys(expression_errors))
-                feedback.pushWarning('Feature ' + str(source_feat.id()) + ' expressions evaluate to ' + ','.join(expression_errors) + '. Skipping feature.')
-                continue
-                
-            if comparisons:
-                source_compare_expression_context.setFeature(source_feat)
-                source_compare_expression_result = source_compare_expression.evaluate(source_compare_expression_context)
-                source_compare_expression_context2.setFeature(source_feat)
-                source_compare_expression_result2 = source_compare_expression2.evaluate(source_compare_expression_context2)
-            
-            if comparisons:
-                doit_counter = 0
-                nearest_lines = overlay_layer_idx.nearestNeighbor(source_feat.geometry(), neighbors = -1, maxDistance = max_dist_expression_result)
-            else:
-                nearest_lines = overlay_layer_idx.nearestNeighbor(source_feat.geometry(), neighbors = max_neighbors_expression_result, maxDistance = max_dist_expression_result)
-            
-            for nearest_line_id in nearest_lines:
+        # the points are matched to their lines here, in order, so first_match_only behaves as without parallel processing;
+        # the matches are sent in batches with the WKB of their lines to perpendicular_batch, which projects the points and
+        # creates the perpendicular lines (in parallel if workers > 1). The results come back in order and are written here.
+        pending_points = collections.deque()
+        line_wkbs = collections.OrderedDict()
+        overlay_skip = set()
+        source_expression_context = QgsExpressionContext()
+        source_expression_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
+        def point_batches():
+            nonlocal current
+            lines = {}
+            batch = []
+            for source_feat in source_layer_vl.getFeatures(source_orderby_request):
                 if feedback.isCanceled():
                     break
-                if nearest_line_id in overlay_skip:
-                    continue
+                current += 1
+                # all expressions of a point are evaluated in the same context
+                source_expression_context.setFeature(source_feat)
+                max_dist_expression_result = max_dist_expression.evaluate(source_expression_context)
+                max_neighbors_expression_result = max_neighbors_expression.evaluate(source_expression_context)
+                line_length_expression_result = line_length_expression.evaluate(source_expression_context)
+                
+                expression_errors = []
+                try:
+                    max_dist_expression_result = float(max_dist_expression_result)
+                except:
+                    expression_errors.append(' an invalid maximum distance expression')
+                try:
+                    max_neighbors_expression_result = int(max_neighbors_expression_result)
+                except:
+                    expression_errors.append(' an invalid maximum neighbors expression')
+                try:
+                    line_length_expression_result = float(line_length_expression_result)
+                    if not line_length_expression_result > 0:
+                        expression_errors.append(' an invalid line length expression')
+                except:
+                    expression_errors.append(' an invalid line length expression')
                 
-                doit = True
-                if comparisons:
-                    if doit_counter >= max_neighbors_expression_result:
-                        continue
-                    doit = False
-                    overlay_compare_expression_result = overlay_layer_dict[nearest_line_id]
-                    overlay_compare_expression_result2 = overlay_layer_dict2[nearest_line_id]
-                    if concat_op(op(source_compare_expression_result, overlay_compare_expression_result),op2(source_compare_expression_result2, overlay_compare_expression_result2)):
+                if expression_errors:
+                    expression_errors = list(dict.fromkeys(expression_errors))
+                    feedback.pushWarning('Feature ' + str(source_feat.id()) + ' expressions evaluate to ' + ','.join(expression_errors) + '. Skipping feature.')
+                    pending_points.append((source_feat, None, []))
+                    batch.append(None)
+                else:
+                    if comparisons:
+                        source_compare_expression_result = source_compare_expression.evaluate(source_expression_context)
+                        source_compare_expression_result2 = source_compare_expression2.evaluate(source_expression_context)
+                    
+                    if comparisons:
+                        doit_counter = 0
+                        nearest_lines = overlay_layer_idx.nearestNeighbor(source_feat.geometry(), neighbors = -1, maxDistance = max_dist_expression_result)
+                    else:
+                        nearest_lines = overlay_layer_idx.nearestNeighbor(source_feat.geometry(), neighbors = max_neighbors_expression_result, maxDistance = max_dist_expression_result)
+                    
+                    matched_lines = []
+                    for nearest_line_id in nearest_lines:
+                        if feedback.isCanceled():
+                            break
+                        if nearest_line_id in overlay_skip:
+                            continue
+                        
                         doit = True
-                        doit_counter += 1
+                        if comparisons:
+                            if doit_counter >= max_neighbors_expression_result:
+                                continue
+                            doit = False
+                            overlay_compare_expression_result = overlay_layer_dict[nearest_line_id]
+                            overlay_compare_expression_result2 = overlay_layer_dict2[nearest_line_id]
+                            if concat_op(op(source_compare_expression_result, overlay_compare_expression_result),op2(source_compare_expression_result2, overlay_compare_expression_result2)):
+                                doit = True
+                                doit_counter += 1
+                                
+                        if not doit:
+                            continue
                         
-                if not doit:
-                    continue
-                
-                if first_match_only:
-                    overlay_skip.append(nearest_line_id)
+                        if first_match_only:
+                            overlay_skip.add(nearest_line_id)
+                        
+                        line_wkb = self.cached(line_wkbs, nearest_line_id, lambda: self.line_wkb(overlay_layer_idx.geometry(nearest_line_id)))
+                        if line_wkb is None:
+                            continue
+                        lines[nearest_line_id] = line_wkb
+                        matched_lines.append(nearest_line_id)
                     
-                nearest_line_geom = overlay_layer_idx.geometry(nearest_line_id)
-                dist_along_line = nearest_line_geom.lineLocatePoint(source_feat.geometry())
-                interpolated_angle = nearest_line_geom.interpolateAngle(dist_along_line)
-                interpolated_angle_degree = math.degrees(interpolated_angle)
-                point_on_nearest_line = nearest_line_geom.interpolate(dist_along_line)
-                point_on_nearest_line_as_point = point_on_nearest_line.vertices().next()
-                inclination = point_on_nearest_line_as_point.inclination(source_feat.geometry().vertices().next())
-                use_inclination = 90
-                #if inclination90:
-                #    use_inclination = inclination
-                perpendicularLinePoint1 = point_on_nearest_line_as_point.project(line_length_expression_result,interpolated_angle_degree+90,use_inclination)
-                perpendicularLinePoint2 = point_on_nearest_line_as_point.project(line_length_expression_result,interpolated_angle_degree-90,use_inclination)
-                perpendicularLineGeom = QgsGeometry.fromPolyline([perpendicularLinePoint1,perpendicularLinePoint2])
-                
-                new_feat = QgsFeature(output_layer_fields)
-                attridx = 0
-                for attr in source_feat.attributes():
-                    new_feat[attridx] = attr
-                    attridx += 1
-                new_feat.setGeometry(perpendicularLineGeom)
-                new_feat[field_name_dict['source_point_feature_id_fieldname']] = source_feat.id()
-                new_feat[field_name_dict['source_point_wkt_fieldname']] = str(source_feat.geometry().asWkt())
-                new_feat[field_name_dict['cross_line_feature_id_fieldname']] = nearest_line_id
-                new_feat[field_name_dict['cross_line_intersection_point_wkt_fieldname']] = str(point_on_nearest_line.asWkt())
-                new_feat[field_name_dict['cross_line_intersection_point_distance_along_line_fieldname']] = dist_along_line
-                new_feat[field_name_dict['cross_line_interpolated_angle_fieldname']] = interpolated_angle_degree
-                new_feat[field_name_dict['distance_source_point_to_cross_line_fieldname']] = point_on_nearest_line_as_point.distance3D(source_feat.geometry().vertices().next())
-                new_feat[field_name_dict['inclination_source_point_to_cross_line_fieldname']] = inclination
-                
-                sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
-
-            feedback.setProgress(int(current * total))
+                    source_point = source_feat.geometry().vertexAt(0)
+                    pending_points.append((source_feat, source_point, matched_lines))
+                    batch.append((source_point.x(), source_point.y(), line_length_expression_result, matched_lines) if matched_lines else None)
+                if len(batch) >= self.BATCH_SIZE:
+                    yield lines, batch
+                    lines = {}
+                    batch = []
+            if batch:
+                yield lines, batch
+        
+        with WorkerPool(workers, feedback) as pool:
+            for results in pool.imap(perpendicular_batch, point_batches()):
+                new_feats = []
+                for perpendicular_lines in results:
+                    source_feat, source_point, matched_lines = pending_points.popleft()
+                    for nearest_line_id, perpendicular_line in zip(matched_lines, perpendicular_lines or []):
+                        if perpendicular_line is None:
+                            continue
+                        dist_along_line, interpolated_angle_degree, point_on_nearest_line_xyzm, perpendicular_line_wkb = perpendicular_line
+                        point_on_nearest_line_as_point = QgsPoint(*point_on_nearest_line_xyzm)
+                        perpendicularLineGeom = QgsGeometry()
+                        perpendicularLineGeom.fromWkb(perpendicular_line_wkb)
+                        
+                        new_feat = QgsFeature(output_layer_fields)
+                        attridx = 0
+                        for attr in source_feat.attributes():
+                            new_feat[attridx] = attr
+                            attridx += 1
+                        new_feat.setGeometry(perpendicularLineGeom)
+                        new_feat[field_name_dict['source_point_feature_id_fieldname']] = source_feat.id()
+                        new_feat[field_name_dict['source_point_wkt_fieldname']] = str(source_feat.geometry().asWkt())
+                        new_feat[field_name_dict['cross_line_feature_id_fieldname']] = nearest_line_id
+                        new_feat[field_name_dict['cross_line_intersection_point_wkt_fieldname']] = str(point_on_nearest_line_as_point.asWkt())
+                        new_feat[field_name_dict['cross_line_intersection_point_distance_along_line_fieldname']] = dist_along_line
+                        new_feat[field_name_dict['cross_line_interpolated_angle_fieldname']] = interpolated_angle_degree
+                        new_feat[field_name_dict['distance_source_point_to_cross_line_fieldname']] = point_on_nearest_line_as_point.distance3D(source_point)
+                        new_feat[field_name_dict['inclination_source_point_to_cross_line_fieldname']] = point_on_nearest_line_as_point.inclination(source_point)
+                        new_feats.append(new_feat)
+                    feedback.setProgress(int((current - len(pending_points)) * total))
+                sink.addFeatures(new_feats, QgsFeatureSink.FastInsert)
         
         return {self.OUTPUT: dest_id}
 
+    def line_wkb(self, geom):
+        # WKB of a (multi) linestring for perpendicular_batch, None if it has no vertices; curves are segmentized before
+        if geom.isEmpty():
+            return None
+        if QgsWkbTypes.isCurvedType(geom.wkbType()):
+            geom = QgsGeometry(geom.constGet().segmentize())
+        return bytes(geom.asWkb())
+
+    def cached(self, cache, key, build):
+        # least recently used cache on an OrderedDict: returns the cached value of key or stores and returns build()
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = build()
+        cache[key] = value
+        if len(cache) > self.CACHE_SIZE:
+            cache.popitem(last = False)
+        return value
+
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -429,4 +473,5 @@ class CreatePerpendicularLinesFromNearestPointsByCondition(QgsProcessingAlgorith
         ' If the expression evaluates to an invalid result, the feature will be skipped and no perpendicular line is created.'
         '\nAttribute informations containing feature id and wkt of the source-point, feature id of the nearest line, wkt of the intersection point,'
         ' the angle at the crossed line, the inclination and the distance from source-point to the crossed line are added to the result.'
+        '\nFor large layers the perpendicular lines can be created by several worker processes in parallel (advanced parameter); the result is the same as without.'
         )
\ No newline at end of file
@@ -31,7 +31,10 @@ class CreateTimepolygonsWithPointcount(QgsProcessingAlgorithm):
     END_DATETIME = 'END_DATETIME'
     INTERVALSEC = 'INTERVALSEC'
     COUNT_POINT_MULTIPLE_TIMES = 'COUNT_POINT_MULTIPLE_TIMES'
+    SKIP_EMPTY = 'SKIP_EMPTY'
+    OUTPUT_STRUCTURE = 'OUTPUT_STRUCTURE'
     OUTPUT = 'OUTPUT'
+    OUTPUT_TIMESERIES = 'OUTPUT_TIMESERIES'
 
     def initAlgorithm(self, config=None):
         
@@ -55,10 +58,21 @@ class CreateTimepolygonsWithPointcount(QgsProcessingAlgorithm):
                 self.INTERVALSEC, self.tr('Interval in Seconds (Expects a valid Integer)'), optional = False, defaultValue = 86400))
         self.addParameter(
             QgsProcessingParameterBoolean(
-                self.COUNT_POINT_MULTIPLE_TIMES, self.tr('Check if a point may be counted more than once (slowing down processing around 25%)')))
+                self.COUNT_POINT_MULTIPLE_TIMES, self.tr('Check if a point may be counted more than once')))
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+                self.SKIP_EMPTY, self.tr('Only output intervals containing points (sparse output)'), defaultValue = False))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OUTPUT_STRUCTURE, self.tr('Output structure'), ['Create one polygon per interval',
+                                                                     'Create each polygon once and write the intervals to a separate table'],
+                                                                     defaultValue = 0, allowMultiple = False))
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT, self.tr('TimePolygons with Pointcount')))
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT_TIMESERIES, self.tr('Pointcount per Interval (only used with separate table output structure)'), QgsProcessing.TypeVector, optional = True, createByDefault = False))
 
     def processAlgorithm(self, parameters, context, feedback):
         lyr_polygons = self.parameterAsLayer(parameters, self.POLYGON_LYR, context)
@@ -69,6 +83,8 @@ class CreateTimepolygonsWithPointcount(QgsProcessingAlgorithm):
         end_date = self.parameterAsDateTime(parameters, self.END_DATETIME, context)
         intervalsec = self.parameterAsInt(parameters, self.INTERVALSEC, context)
         count_point_multiple_times = self.parameterAsBool(parameters, self.COUNT_POINT_MULTIPLE_TIMES, context)
+        skip_empty = self.parameterAsBool(parameters, self.SKIP_EMPTY, context)
+        output_structure = self.parameterAsInt(parameters, self.OUTPUT_STRUCTURE, context)
         feedback.setProgressText('Prepare processing...')
         
         if lyr_polygons.sourceCrs() != lyr_points.sourceCrs():
@@ -77,62 +93,134 @@ class CreateTimepolygonsWithPointcount(QgsProcessingAlgorithm):
             lyr_points = reproj['OUTPUT']
         
         fields = lyr_polygons.fields()
-        fields.append(QgsField('from_datetime', QVariant.DateTime))
-        fields.append(QgsField('to_datetime', QVariant.DateTime))
-        fields.append(QgsField('pointcount', QVariant.Int, len=0))
+        timeseries_fields = QgsFields()
+        if output_structure == 0: # one polygon per interval
+            fields.append(QgsField('from_datetime', QVariant.DateTime))
+            fields.append(QgsField('to_datetime', QVariant.DateTime))
+            fields.append(QgsField('pointcount', QVariant.Int, len=0))
+        elif output_structure == 1: # polygons once, intervals in a separate table linked by polygon_id
+            fields.append(QgsField('polygon_id', QVariant.LongLong))
+            timeseries_fields.append(QgsField('polygon_id', QVariant.LongLong))
+            timeseries_fields.append(QgsField('from_datetime', QVariant.DateTime))
+            timeseries_fields.append(QgsField('to_datetime', QVariant.DateTime))
+            timeseries_fields.append(QgsField('pointcount', QVariant.Int, len=0))
         
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
                                                fields, lyr_polygons.wkbType(),
                                                lyr_polygons.sourceCrs())
+        timeseries_sink, timeseries_dest_id = None, None
+        if output_structure == 1:
+            (timeseries_sink, timeseries_dest_id) = self.parameterAsSink(parameters, self.OUTPUT_TIMESERIES, context,
+                                                                         timeseries_fields, QgsWkbTypes.NoGeometry,
+                                                                         lyr_polygons.sourceCrs())
+            if timeseries_sink is None:
+                feedback.reportError('You chose to write the intervals to a separate table but did not set an output for it!', fatalError = True)
+                return {}
         
         start_date = QDateTime.toPyDateTime(start_date)
         end_date = QDateTime.toPyDateTime(end_date)
         total_seconds = int((end_date - start_date).total_seconds())
+        if intervalsec < 1:
+            feedback.reportError('The interval must be at least one second!', fatalError = True)
+            return {}
+        required_iterations = len(range(0,total_seconds,intervalsec))
+        interval_microseconds = intervalsec * 1000000
         
         feedback.setProgressText('Building spatial index...')
-        idx_points = QgsSpatialIndex(lyr_points.getFeatures(), feedback=feedback)
+        polygons = [] # (feature id, geometry, attributes) in iteration order; the position in this list is used as id
+        polygon_engines = {}
+        idx_polygons = QgsSpatialIndex()
+        for polygon in lyr_polygons.getFeatures():
+            if feedback.isCanceled():
+                break
+            idx_polygons.addFeature(len(polygons), polygon.geometry().boundingBox())
+            polygons.append((polygon.id(), polygon.geometry(), polygon.attributes()))
         
-        required_iterations = math.ceil(total_seconds / intervalsec) 
-        total = 100.0 / (lyr_polygons.featureCount() * required_iterations) if lyr_polygons.featureCount() else 0
         current = 0
+        total = lyr_points.featureCount() + len(polygons) * required_iterations
+        total = 100.0 / total if total else 0
         
-        feedback.setProgressText('Start processing...')
+        feedback.setProgressText('Counting points...')
         point_time_expression_context = QgsExpressionContext()
         point_time_expression_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(lyr_points))
-        for current_interval in range(0,total_seconds,intervalsec): 
+        point_time_expression.prepare(point_time_expression_context)
+        point_request = QgsFeatureRequest()
+        point_request.setSubsetOfAttributes(point_time_expression.referencedColumns(), lyr_points.fields())
+        pointcounts = {} # (polygon position, interval): pointcount
+        for point in lyr_points.getFeatures(point_request):
+            current += 1
             if feedback.isCanceled():
                 break
-            current_start_datetime = start_date + timedelta(seconds = current_interval)
-            current_end_datetime = (start_date + timedelta(seconds = current_interval+intervalsec) - timedelta(seconds = 1))
-            for polygon in lyr_polygons.getFeatures():
-                current += 1
+            feedback.setProgress(int(current * total))
+            point_time_expression_context.setFeature(point)
+            point_time_expression_result = point_time_expression.evaluate(point_time_expression_context)
+            if isinstance(point_time_expression_result, QDateTime):
+                if not point_time_expression_result.isValid():
+                    continue
+                point_time_expression_result = point_time_expression_result.toPyDateTime()
+            if not isinstance(point_time_expression_result, datetime):
+                continue
+            # the interval follows from the time difference to the start; microseconds keep the arithmetic exact
+            point_time_delta = point_time_expression_result - start_date
+            point_time_offset = (point_time_delta.days * 86400 + point_time_delta.seconds) * 1000000 + point_time_delta.microseconds
+            interval, interval_offset = divmod(point_time_offset, interval_microseconds)
+            if interval < 0 or interval >= required_iterations:
+                continue
+            if interval_offset == 0 or interval_offset > interval_microseconds - 1000000: # greater than starttime and smaller or equal endtime
+                continue
+            point_geometry = point.geometry()
+            for polygon_position in sorted(idx_polygons.intersects(point_geometry.boundingBox())): # sorted to count a point for the first polygon only
+                polygon_engine = polygon_engines.get(polygon_position)
+                if polygon_engine is None:
+                    polygon_engine = QgsGeometry.createGeometryEngine(polygons[polygon_position][1].constGet())
+                    polygon_engine.prepareGeometry()
+                    polygon_engines[polygon_position] = polygon_engine
+                if polygon_engine.intersects(point_geometry.constGet()):
+                    pointcounts[(polygon_position, interval)] = pointcounts.get((polygon_position, interval), 0) + 1
+                    if not count_point_multiple_times:
+                        break
+        
+        feedback.setProgressText('Creating timepolygons...')
+        if output_structure == 1:
+            for polygon_id, polygon_geometry, polygon_attributes in polygons:
                 if feedback.isCanceled():
                     break
                 new_feat = QgsFeature(fields)
-                new_feat.setGeometry(polygon.geometry())
-                attridx = 0
-                for attr in polygon.attributes():
-                    new_feat[attridx] = attr
-                    attridx += 1
-                new_feat['from_datetime'] = current_start_datetime.strftime('%Y-%m-%d %H:%M:%S')
-                new_feat['to_datetime'] = current_end_datetime.strftime('%Y-%m-%d %H:%M:%S')
-                new_feat['pointcount'] = 0
-                for pointid in idx_points.intersects(polygon.geometry().boundingBox()):
-                    point = lyr_points.getFeature(pointid)
-                    if feedback.isCanceled():
-                        break
-                    point_time_expression_context.setFeature(point)
-                    point_time_expression_result = point_time_expression.evaluate(point_time_expression_context)
-                    if point_time_expression_result > current_start_datetime and point_time_expression_result <= current_end_datetime:
-                        if point.geometry().intersects(polygon.geometry()):
-                            new_feat['pointcount'] += 1
-                            if not count_point_multiple_times:
-                                idx_points.deleteFeature(point) # dont count a point twice, removing it from the index speeds up the code around 25%
-                        
+                new_feat.setGeometry(polygon_geometry)
+                new_feat.setAttributes(polygon_attributes + [polygon_id])
+                sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
+        
+        if skip_empty: # only (polygon, interval) pairs with points, in the same order as the full output
+            output_pairs = sorted(pointcounts.keys(), key = lambda pair: (pair[1], pair[0]))
+            current = 0
+            total = 100.0 / len(output_pairs) if output_pairs else 0
+        else:
+            output_pairs = ((polygon_position, interval) for interval in range(required_iterations) for polygon_position in range(len(polygons)))
+        last_interval = None
+        for polygon_position, interval in output_pairs:
+            current += 1
+            if feedback.isCanceled():
+                break
+            if interval != last_interval:
+                last_interval = interval
+                current_start_datetime = start_date + timedelta(seconds = interval * intervalsec)
+                current_end_datetime = (start_date + timedelta(seconds = (interval + 1) * intervalsec) - timedelta(seconds = 1))
+                current_start_datetime = current_start_datetime.strftime('%Y-%m-%d %H:%M:%S')
+                current_end_datetime = current_end_datetime.strftime('%Y-%m-%d %H:%M:%S')
+            polygon_id, polygon_geometry, polygon_attributes = polygons[polygon_position]
+            pointcount = pointcounts.get((polygon_position, interval), 0)
+            if output_structure == 0:
+                new_feat = QgsFeature(fields)
+                new_feat.setGeometry(polygon_geometry)
+                new_feat.setAttributes(polygon_attributes + [current_start_datetime, current_end_datetime, pointcount])
                 sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
-                feedback.setProgress(int(current * total))
+            elif output_structure == 1:
+                new_feat = QgsFeature(timeseries_fields)
+                new_feat.setAttributes([polygon_id, current_start_datetime, current_end_datetime, pointcount])
+                timeseries_sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
+            feedback.setProgress(int(current * total))
                 
-        return {self.OUTPUT: dest_id} # Return result of algorithm
+        return {self.OUTPUT: dest_id, self.OUTPUT_TIMESERIES: timeseries_dest_id} # Return result of algorithm
         
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -156,5 +244,8 @@ class CreateTimepolygonsWithPointcount(QgsProcessingAlgorithm):
         return self.tr('This Algorithm duplicates the polygons by the given interval input, '
                        'adds a from_datetime and to_datetime field to them '
                        'and counts the points intersecting with the polygon as '
-                       'if they are inbetween the timerange (greater than starttime and smaller or equal endtime)'
+                       'if they are inbetween the timerange (greater than starttime and smaller or equal endtime). '
+                       'Enable the sparse output to skip polygons without points in an interval. '
+                       'Alternatively the polygons can be written only once with a polygon_id field; '
+                       'the intervals and pointcounts are then written to a separate table without geometry, linked by the polygon_id'
                        )
\ No newline at end of file
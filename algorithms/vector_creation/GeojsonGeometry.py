@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Author: Mario Königbauer (mkoenigb@gmx.de)
+(C) 2022 - today by Mario Koenigbauer
+License: GNU General Public License v3.0
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# GeoJSON geometry parser for New Layer from GeoJSON String.
+# Decodes the GeoJSON with the json module and writes the coordinates of the geometry directly to WKB, which QGIS
+# reads without creating any features. This module intentionally does not depend on QGIS, so it can be used by
+# worker processes.
+
+import json
+import struct
+
+WKB_TYPES = {'Point': 1, 'LineString': 2, 'Polygon': 3, 'MultiPoint': 4, 'MultiLineString': 5, 'MultiPolygon': 6, 'GeometryCollection': 7}
+WKB_HEADER = struct.Struct('<BI')
+WKB_COUNT = struct.Struct('<I')
+NULL_GEOMETRY = b''
+
+def geometry_dimension(geometry):
+    # 3 if the first position of the geometry has a z value, otherwise 2
+    if geometry.get('type') == 'GeometryCollection':
+        for member in geometry.get('geometries') or []:
+            if geometry_dimension(member) == 3:
+                return 3
+        return 2
+    position = geometry.get('coordinates')
+    while isinstance(position, list) and position and isinstance(position[0], list):
+        position = position[0]
+    return 3 if isinstance(position, list) and len(position) > 2 else 2
+
+def positions_wkb(positions, dimension):
+    if dimension == 3:
+        values = [v for p in positions for v in (p[0], p[1], p[2] if len(p) > 2 else 0.0)]
+    else:
+        values = [v for p in positions for v in (p[0], p[1])]
+    return WKB_COUNT.pack(len(positions)) + struct.pack('<' + str(len(values)) + 'd', *values)
+
+def point_wkb(position, dimension):
+    code = WKB_TYPES['Point'] + (1000 if dimension == 3 else 0)
+    if not position: # empty point
+        position = [float('nan')] * dimension
+    elif dimension == 3 and len(position) < 3:
+        position = [position[0], position[1], 0.0]
+    return WKB_HEADER.pack(1, code) + struct.pack('<' + str(dimension) + 'd', *position[:dimension])
+
+def linestring_wkb(positions, dimension):
+    return WKB_HEADER.pack(1, WKB_TYPES['LineString'] + (1000 if dimension == 3 else 0)) + positions_wkb(positions, dimension)
+
+def polygon_wkb(rings, dimension):
+    return (WKB_HEADER.pack(1, WKB_TYPES['Polygon'] + (1000 if dimension == 3 else 0)) + WKB_COUNT.pack(len(rings)) +
+            b''.join(positions_wkb(ring, dimension) for ring in rings))
+
+def geometry_wkb(geometry, dimension):
+    """Returns the ISO WKB of a decoded GeoJSON geometry object. Raises KeyError for unknown geometry types."""
+    geometry_type = geometry['type']
+    code = WKB_TYPES[geometry_type] + (1000 if dimension == 3 else 0)
+    if geometry_type == 'GeometryCollection':
+        members = geometry['geometries']
+        return WKB_HEADER.pack(1, code) + WKB_COUNT.pack(len(members)) + b''.join(geometry_wkb(member, dimension) for member in members)
+    coordinates = geometry['coordinates']
+    if geometry_type == 'Point':
+        return point_wkb(coordinates, dimension)
+    if geometry_type == 'LineString':
+        return linestring_wkb(coordinates, dimension)
+    if geometry_type == 'Polygon':
+        return polygon_wkb(coordinates, dimension)
+    if geometry_type == 'MultiPoint':
+        parts = [point_wkb(part, dimension) for part in coordinates]
+    elif geometry_type == 'MultiLineString':
+        parts = [linestring_wkb(part, dimension) for part in coordinates]
+    else: # MultiPolygon
+        parts = [polygon_wkb(part, dimension) for part in coordinates]
+    return WKB_HEADER.pack(1, code) + WKB_COUNT.pack(len(parts)) + b''.join(parts)
+
+def geojson_feature(data):
+    """
+    Returns (geometry, properties) of a decoded GeoJSON geometry object, Feature or of the first Feature of a
+    FeatureCollection. geometry is None for a Feature without geometry. Raises ValueError for anything else.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Not a GeoJSON object')
+    if data.get('type') == 'FeatureCollection':
+        features = data.get('features')
+        if not isinstance(features, list) or not features or not isinstance(features[0], dict):
+            raise ValueError('Empty FeatureCollection')
+        data = features[0]
+    if data.get('type') == 'Feature':
+        if 'geometry' not in data:
+            raise ValueError('Feature without geometry member')
+        properties = data.get('properties')
+        geometry = data['geometry']
+        if geometry is not None and not isinstance(geometry, dict):
+            raise ValueError('Invalid geometry member')
+        return geometry, properties if isinstance(properties, dict) else {}
+    if data.get('type') not in WKB_TYPES:
+        raise ValueError('Unknown GeoJSON type')
+    return data, {}
+
+def geojson_to_wkb(text):
+    """
+    Returns the WKB of the geometry of a GeoJSON string: of a geometry object, of a Feature or of the first Feature
+    of a FeatureCollection. Returns NULL_GEOMETRY for a Feature without geometry and None if the string cannot be
+    handled here, e.g. because it is not valid JSON or contains an empty FeatureCollection.
+    """
+    try:
+        geometry = geojson_feature(json.loads(text))[0]
+        if geometry is None:
+            return NULL_GEOMETRY
+        return geometry_wkb(geometry, geometry_dimension(geometry))
+    except (KeyError, TypeError, IndexError, ValueError, AttributeError, struct.error, RecursionError):
+        return None
+
+def geojson_to_wkb_batch(texts):
+    """Worker function for parallel processing: returns geojson_to_wkb for every string of the list, None for other values."""
+    return [geojson_to_wkb(text) if isinstance(text, str) else None for text in texts]
+
+def infer_wkb_type(geometries):
+    """
+    Returns the WKB type code (as used by QgsWkbTypes) fitting all given decoded GeoJSON geometries: the common type,
+    the multi type if single and multi types of the same kind are mixed, or 0 (Unknown) if no common type exists.
+    """
+    base_types = set()
+    has_z = False
+    for geometry in geometries:
+        if not isinstance(geometry, dict) or geometry.get('type') not in WKB_TYPES:
+            continue
+        base_types.add(WKB_TYPES[geometry['type']])
+        has_z = has_z or geometry_dimension(geometry) == 3
+    if len(base_types) == 1:
+        wkb_type = base_types.pop()
+    elif base_types in ({1, 4}, {2, 5}, {3, 6}):
+        wkb_type = max(base_types)
+    else:
+        return 0
+    return wkb_type + 1000 if has_z else wkb_type
+
+def property_type(value):
+    # 'bool', 'int', 'float' or 'str' for a GeoJSON property value; None for null
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, int):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'str' # strings, arrays and objects
+
+def infer_property_types(properties_list):
+    """
+    Returns [(name, type)] of all properties of the given property dictionaries in order of their first appearance.
+    type is one of 'bool', 'int', 'float' or 'str'; properties with different types become 'float' if all are numbers, else 'str'.
+    """
+    property_types = {}
+    for properties in properties_list:
+        for name, value in properties.items():
+            value_type = property_type(value)
+            known_type = property_types.get(name)
+            if known_type is None or known_type == value_type:
+                property_types[name] = value_type or known_type
+            elif value_type is not None:
+                property_types[name] = 'float' if {known_type, value_type} == {'int', 'float'} else 'str'
+    return [(name, value_type or 'str') for name, value_type in property_types.items()]
+
+def property_value(value):
+    # arrays and objects are written as json strings
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators = (',', ':'), ensure_ascii = False)
+    return value
+
+def geojson_sequence_texts(f, chunk_size = 1048576):
+    """
+    Yields the texts of the records of a file opened in binary mode. If the file starts with a record separator
+    (0x1e) as GeoJSON text sequences (RFC 8142) do, the records are split at the separators and may span several
+    lines; otherwise every line is a record as in newline delimited GeoJSON. Texts may be empty or whitespace only.
+    """
+    if f.peek(1)[:1] != b'\x1e':
+        yield from f
+        return
+    rest = b''
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        texts = (rest + chunk).split(b'\x1e')
+        rest = texts.pop()
+        yield from texts
+    yield rest
+
+def geojson_sequence_records(lines, property_names):
+    """
+    Parses the records of a GeoJSON text sequence (RFC 8142) or newline delimited GeoJSON file as given by
+    geojson_sequence_texts. Returns one (wkb, attributes) tuple per record with the values of the given properties as
+    attributes, or None for records which are no valid GeoJSON. wkb is None if only the geometry is invalid and
+    NULL_GEOMETRY for features without geometry.
+    """
+    records = []
+    for line in lines:
+        try:
+            geometry, properties = geojson_feature(json.loads(line.strip(b'\x1e \t\r\n')))
+        except (ValueError, TypeError, UnicodeDecodeError, RecursionError):
+            records.append(None)
+            continue
+        attributes = [property_value(properties.get(name)) for name in property_names]
+        try:
+            wkb = NULL_GEOMETRY if geometry is None else geometry_wkb(geometry, geometry_dimension(geometry))
+        except (KeyError, TypeError, IndexError, ValueError, AttributeError, struct.error, RecursionError):
+            wkb = None
+        records.append((wkb, attributes))
+    return records
+
+def geojson_sequence_batch(task):
+    """Worker function for parallel processing: task is (records, property names), see geojson_sequence_records."""
+    return geojson_sequence_records(*task)
\ No newline at end of file
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Author: Mario Königbauer (mkoenigb@gmx.de)
+(C) 2022 - today by Mario Koenigbauer
+License: GNU General Public License v3.0
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+from PyQt5.QtCore import QCoreApplication, QVariant
+from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsGeometry, QgsFields, QgsWkbTypes,
+                       QgsFeatureSink, QgsProcessingAlgorithm, QgsProcessingParameterDefinition,
+                       QgsProcessingParameterFeatureSink, QgsProcessingParameterCrs, QgsProcessingParameterFile, QgsProcessingParameterEnum, QgsProcessingParameterNumber)
+import os, json, collections
+from .GeojsonGeometry import geojson_feature, geojson_sequence_texts, geojson_sequence_batch, infer_wkb_type, infer_property_types, NULL_GEOMETRY
+from ..tools.WorkerPool import WorkerPool
+
+class GeometryLayerFromGeojsonSequenceFile(QgsProcessingAlgorithm):
+    INPUT_FILE = 'INPUT_FILE'
+    GEOMETRYTYPE_ENUM = 'GEOMETRYTYPE_ENUM'
+    SAMPLE_SIZE = 'SAMPLE_SIZE'
+    CRS = 'CRS'
+    WORKERS = 'WORKERS'
+    OUTPUT = 'OUTPUT'
+
+    BATCH_SIZE = 5000 # records per task of a worker process
+    GEOMETRYTYPES = ['Infer from the first features','Point','LineString','Polygon','MultiPoint','MultiLineString','MultiPolygon','GeometryCollection']
+    FIELD_TYPES = {'bool': QVariant.Bool, 'int': QVariant.LongLong, 'float': QVariant.Double, 'str': QVariant.String}
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterFile(
+                self.INPUT_FILE, self.tr('GeoJSON sequence / newline delimited GeoJSON file'), fileFilter = 'GeoJSON sequence (*.geojsons *.geojsonl *.geojsonseq *.ndjson *.jsonl *.json);;All files (*.*)'))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.GEOMETRYTYPE_ENUM, self.tr('Geometry type of the target layer'), self.GEOMETRYTYPES, defaultValue = 0)) # indices 1-7 are the wkb types of QgsWkbTypes
+        parameter_sample_size = QgsProcessingParameterNumber(
+                self.SAMPLE_SIZE, self.tr('Number of features to read for inferring the geometry type and the fields'), minValue = 1, defaultValue = 1000, type = QgsProcessingParameterNumber.Integer)
+        parameter_sample_size.setFlags(parameter_sample_size.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_sample_size)
+        self.addParameter(
+            QgsProcessingParameterCrs(
+                self.CRS, self.tr('CRS of the target layer / of the GeoJSON content'),'EPSG:4326'))
+        parameter_workers = QgsProcessingParameterNumber(
+                self.WORKERS, self.tr('Number of worker processes parsing the GeoJSON in parallel (1 means no parallel processing)'), minValue = 1, maxValue = 256, defaultValue = 1, type = QgsProcessingParameterNumber.Integer)
+        parameter_workers.setFlags(parameter_workers.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_workers)
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.OUTPUT, self.tr('new_geojson_layer')))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        input_file = self.parameterAsFile(parameters, self.INPUT_FILE, context)
+        wkbgeometrytype = self.parameterAsInt(parameters, self.GEOMETRYTYPE_ENUM, context)
+        sample_size = self.parameterAsInt(parameters, self.SAMPLE_SIZE, context)
+        crsgeometry = self.parameterAsCrs(parameters, self.CRS, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+
+        if not os.path.isfile(input_file):
+            feedback.reportError('File not found: ' + str(input_file), fatalError = True)
+            return {}
+
+        feedback.setProgressText('Reading the first ' + str(sample_size) + ' features to set up the output layer...')
+        sample_geometries = []
+        sample_properties = []
+        with open(input_file, 'rb') as f:
+            for text in geojson_sequence_texts(f):
+                if len(sample_properties) >= sample_size or feedback.isCanceled():
+                    break
+                if not text.strip(b'\x1e \t\r\n'):
+                    continue
+                try:
+                    geometry, properties = geojson_feature(json.loads(text.strip(b'\x1e \t\r\n')))
+                except (ValueError, TypeError, UnicodeDecodeError, RecursionError):
+                    continue
+                sample_geometries.append(geometry)
+                sample_properties.append(properties)
+
+        if wkbgeometrytype == 0:
+            wkbgeometrytype = infer_wkb_type(sample_geometries)
+            feedback.pushInfo('Inferred geometry type: ' + QgsWkbTypes.displayString(wkbgeometrytype))
+        convert_to_multi = QgsWkbTypes.isMultiType(wkbgeometrytype)
+
+        property_names = []
+        fields = QgsFields()
+        for property_name, property_type in infer_property_types(sample_properties):
+            property_names.append(property_name)
+            fields.append(QgsField(property_name, self.FIELD_TYPES[property_type]))
+
+        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, fields, wkbgeometrytype, crsgeometry)
+
+        total = 100.0 / os.path.getsize(input_file) if os.path.getsize(input_file) else 0
+        invalid_records = 0
+        invalid_geometries = 0
+
+        feedback.setProgressText('Start processing...')
+        with open(input_file, 'rb') as f:
+            # the records are streamed in batches; WorkerPool keeps only a few batches in flight, so memory use is bounded
+            batch_sizes = collections.deque()
+            def record_batches():
+                batch = []
+                for text in geojson_sequence_texts(f):
+                    if feedback.isCanceled():
+                        break
+                    if not text.strip(b'\x1e \t\r\n'):
+                        continue
+                    batch.append(text)
+                    if len(batch) >= self.BATCH_SIZE:
+                        batch_sizes.append(f.tell())
+                        yield batch, property_names
+                        batch = []
+                if batch:
+                    batch_sizes.append(f.tell())
+                    yield batch, property_names
+
+            with WorkerPool(workers, feedback) as pool:
+                for records in pool.imap(geojson_sequence_batch, record_batches()):
+                    new_feats = []
+                    for record in records:
+                        if record is None:
+                            invalid_records += 1
+                            continue
+                        wkb, attributes = record
+                        new_feat = QgsFeature(fields)
+                        new_feat.setAttributes(attributes)
+                        if wkb is None:
+                            invalid_geometries += 1
+                        elif wkb != NULL_GEOMETRY:
+                            new_geom = QgsGeometry()
+                            new_geom.fromWkb(wkb)
+                            if convert_to_multi and not new_geom.isMultipart():
+                                new_geom.convertToMultiType()
+                            new_feat.setGeometry(new_geom)
+                        new_feats.append(new_feat)
+                    sink.addFeatures(new_feats, QgsFeatureSink.FastInsert)
+                    feedback.setProgress(int(batch_sizes.popleft() * total))
+
+        if invalid_records > 0:
+            feedback.pushWarning('Skipped ' + str(invalid_records) + ' records which are no valid GeoJSON')
+        if invalid_geometries > 0:
+            feedback.pushWarning(str(invalid_geometries) + ' features have an invalid or unsupported geometry and were added without geometry')
+
+        return {self.OUTPUT: dest_id}
+
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return GeometryLayerFromGeojsonSequenceFile()
+
+    def name(self):
+        return 'GeometryLayerFromGeojsonSequenceFile'
+
+    def displayName(self):
+        return self.tr('New Layer from GeoJSON Sequence File')
+
+    def group(self):
+        return self.tr(self.groupId())
+
+    def groupId(self):
+        return 'Vector - Creation'
+
+    def shortHelpString(self):
+        return self.tr('This Algorithm reads a GeoJSON text sequence (RFC 8142) or newline delimited GeoJSON file with one Feature or geometry per record and creates a new layer from it.\n'
+                       'If the file starts with a record separator (RS), the records are split at the separators and may span several lines, otherwise every line is a record.\n'
+                       'The file is streamed in batches and written directly to the output, so also files larger than the available memory can be read.\n'
+                       'The geometry type and the fields are inferred from the first features (advanced parameter), the geometry type can also be set manually. '
+                       'If single and multipart geometries of the same kind are mixed, the multipart type is used and single geometries are converted. '
+                       'Properties which do not appear in the first features are not added to the output; arrays and objects are written as JSON strings.\n'
+                       'For large files the GeoJSON can be parsed by several worker processes in parallel (advanced parameter).')
\ No newline at end of file
@@ -16,15 +16,22 @@ License: GNU General Public License v3.0
 
 from PyQt5.QtCore import QCoreApplication, QVariant
 from qgis.core import (QgsJsonUtils, QgsField, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsPoint, QgsFields, QgsWkbTypes,
-                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm,
+                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsProcessingParameterDefinition,
                        QgsProcessingParameterFeatureSink, QgsProcessingParameterGeometry, QgsProcessingParameterCrs, QgsProcessingParameterField, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterString, QgsProcessingParameterNumber)
+import collections, json
+from .GeojsonGeometry import geojson_to_wkb_batch, geojson_feature, infer_wkb_type, NULL_GEOMETRY
+from ..tools.WorkerPool import WorkerPool
 
 class GeometryLayerFromGeojsonStringField(QgsProcessingAlgorithm):
     SOURCE_LYR = 'SOURCE_LYR'
     GEOJSON_FIELD = 'GEOJSON_FIELD'
     GEOMETRYTYPE_ENUM = 'GEOMETRYTYPE_ENUM'
     CRS = 'CRS'
+    WORKERS = 'WORKERS'
     OUTPUT = 'OUTPUT'
+
+    BATCH_SIZE = 5000 # features per task of a worker process
+    SAMPLE_SIZE = 1000 # features read for inferring the geometry type
     
 
     def initAlgorithm(self, config=None):  
@@ -37,10 +44,14 @@ class GeometryLayerFromGeojsonStringField(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterEnum(
                 self.GEOMETRYTYPE_ENUM, self.tr('Geometry type of the target layer / of the GeoJSON content'),
-                ['Unknown','Point','LineString','Polygon','MultiPoint','MultiLineString','MultiPolygon','GeometryCollection','CircularString','CompoundCurve','CurvePolygon'],defaultValue=5)) # Only Works because these are ascending numerated in QGIS... NOT A GOOD SOLUTION!! But better than typing in a number by hand... see https://qgis.org/api/classQgsWkbTypes.html
+                ['Unknown','Point','LineString','Polygon','MultiPoint','MultiLineString','MultiPolygon','GeometryCollection','CircularString','CompoundCurve','CurvePolygon','Infer from the first features'],defaultValue=5)) # indices 0-10 equal the wkb types in QGIS, see https://qgis.org/api/classQgsWkbTypes.html; 11 infers the type from the GeoJSON
         self.addParameter(
             QgsProcessingParameterCrs(
                 self.CRS, self.tr('CRS of the target layer / of the GeoJSON content'),'EPSG:4326'))
+        parameter_workers = QgsProcessingParameterNumber(
+                self.WORKERS, self.tr('Number of worker processes parsing the GeoJSON in parallel (1 means no parallel processing)'), minValue = 1, maxValue = 256, defaultValue = 1, type = QgsProcessingParameterNumber.Integer)
+        parameter_workers.setFlags(parameter_workers.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_workers)
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT, self.tr('new_geojson_layer')))
@@ -50,27 +61,73 @@ class GeometryLayerFromGeojsonStringField(QgsProcessingAlgorithm):
         source_geojsonfield = self.parameterAsString(parameters, self.GEOJSON_FIELD, context)
         wkbgeometrytype_fromenum = self.parameterAsInt(parameters, self.GEOMETRYTYPE_ENUM, context)
         wkbgeometrytype = wkbgeometrytype_fromenum
+        infer_geometrytype = wkbgeometrytype_fromenum == 11
         crsgeometry = self.parameterAsCrs(parameters, self.CRS, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
         
         total = 100.0 / source_layer.featureCount() if source_layer.featureCount() else 0
         
         source_fields = source_layer.fields()
+        source_geojsonfield_idx = source_fields.indexFromName(source_geojsonfield)
+        
+        if infer_geometrytype:
+            sample_request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry).setSubsetOfAttributes([source_geojsonfield_idx]).setLimit(self.SAMPLE_SIZE)
+            sample_geometries = []
+            for feature in source_layer.getFeatures(sample_request):
+                try:
+                    sample_geometries.append(geojson_feature(json.loads(feature.attribute(source_geojsonfield_idx)))[0])
+                except (ValueError, TypeError, RecursionError):
+                    pass
+            wkbgeometrytype = infer_wkb_type(sample_geometries)
+            feedback.pushInfo('Inferred geometry type: ' + QgsWkbTypes.displayString(wkbgeometrytype))
+        convert_to_multi = infer_geometrytype and QgsWkbTypes.isMultiType(wkbgeometrytype)
         
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context, source_fields, wkbgeometrytype, crsgeometry)
                                                
-        for current, feature in enumerate(source_layer.getFeatures()):
-            if feedback.isCanceled():
-                break
-            # Thanks to https://gis.stackexchange.com/a/382615/107424
-            geoj = feature.attributes()[source_fields.indexFromName(source_geojsonfield)]
-            geojfeats = QgsJsonUtils.stringToFeatureList(geoj, QgsFields(), None)
-            if len(geojfeats) > 0:
-                new_geom = geojfeats[0].geometry()
-                new_feat = QgsFeature(feature)
-                new_feat.setGeometry(new_geom)
-                sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
-
-            feedback.setProgress(int(current * total))
+        # the features of each batch are kept here until the worker returns the geometries of the batch
+        pending_batches = collections.deque()
+        def geojson_batches():
+            batch = []
+            for feature in source_layer.getFeatures():
+                if feedback.isCanceled():
+                    break
+                batch.append(feature)
+                if len(batch) >= self.BATCH_SIZE:
+                    pending_batches.append(batch)
+                    yield [feat.attribute(source_geojsonfield_idx) for feat in batch]
+                    batch = []
+            if batch:
+                pending_batches.append(batch)
+                yield [feat.attribute(source_geojsonfield_idx) for feat in batch]
+        
+        current = 0
+        with WorkerPool(workers, feedback) as pool:
+            for wkbs in pool.imap(geojson_to_wkb_batch, geojson_batches()):
+                batch = pending_batches.popleft()
+                new_feats = []
+                for feature, wkb in zip(batch, wkbs):
+                    current += 1
+                    geoj = feature.attribute(source_geojsonfield_idx)
+                    if not isinstance(geoj, str):
+                        continue
+                    if wkb is None: # not handled by the fast parser, let QGIS try it
+                        # Thanks to https://gis.stackexchange.com/a/382615/107424
+                        geojfeats = QgsJsonUtils.stringToFeatureList(geoj, QgsFields(), None)
+                        if len(geojfeats) == 0:
+                            continue
+                        new_geom = geojfeats[0].geometry()
+                    elif wkb == NULL_GEOMETRY:
+                        new_geom = QgsGeometry()
+                    else:
+                        new_geom = QgsGeometry()
+                        new_geom.fromWkb(wkb)
+                    if convert_to_multi and not new_geom.isNull() and not new_geom.isMultipart():
+                        new_geom.convertToMultiType()
+                    new_feat = QgsFeature(feature)
+                    new_feat.setGeometry(new_geom)
+                    new_feats.append(new_feat)
+                sink.addFeatures(new_feats, QgsFeatureSink.FastInsert)
+                feedback.setProgress(int(current * total))
 
         return {self.OUTPUT: dest_id}
 
@@ -95,4 +152,7 @@ class GeometryLayerFromGeojsonStringField(QgsProcessingAlgorithm):
         return 'Vector - Creation'
 
     def shortHelpString(self):
-        return self.tr('This Algorithm takes a source layer containing a GeoJSON as a String in a field and creates a copy of this layer with the geometry of this GeoJSON field')
\ No newline at end of file
+        return self.tr('This Algorithm takes a source layer containing a GeoJSON as a String in a field and creates a copy of this layer with the geometry of this GeoJSON field.\n'
+                       'The field may contain a GeoJSON geometry, a Feature or a FeatureCollection; of the latter the geometry of the first feature is used.\n'
+                       'The geometry type can be inferred from the first ' + str(self.SAMPLE_SIZE) + ' features; single geometries are then converted to multipart if single and multipart geometries are mixed.\n'
+                       'For large tables the GeoJSON can be parsed by several worker processes in parallel (advanced parameter).')
\ No newline at end of file
@@ -16,7 +16,7 @@ License: GNU General Public License v3.0
 
 import processing
 from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFields, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPoint, QgsWkbTypes, QgsLineString,
+from qgis.core import (QgsField, QgsFields, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPoint, QgsPointXY, QgsRectangle, QgsWkbTypes, QgsLineString,
                        QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsExpressionContext, QgsExpressionContextUtils, QgsProcessingParameterDefinition,
                        QgsProcessingParameterFeatureSink, QgsProcessingParameterField, QgsProcessingParameterDistance, QgsProcessingParameterFeatureSource, QgsProcessingParameterEnum, QgsProcessingParameterExpression, QgsProcessingParameterNumber, QgsProcessingParameterString, QgsProcessingParameterBoolean)
 
@@ -72,7 +72,7 @@ class NearestPointsToPath(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterBoolean(
                 self.ALLOW_SELF_CROSSING, self.tr('Allow self-crossing of a result path? '
-                                                  '\nUnchecking this option can exponentially slow down the algorithm!'
+                                                  '\nUnchecking this option slows down the algorithm!'
                                                   '\nIf not allowed, a new feature is created when there is no self-cross-avoiding-point available'), defaultValue = True))
         self.addParameter(
             QgsProcessingParameterFeatureSink(
@@ -156,28 +156,39 @@ class NearestPointsToPath(QgsProcessingAlgorithm):
         max_str_len = 0
         
         feedback.setProgressText('Building spatial index...')
-        source_layer_idx = QgsSpatialIndex(source_layer.getFeatures(), flags=QgsSpatialIndex.FlagStoreFeatureGeometries, feedback=feedback)
-        
-        if groupby_expr or add_custom_ids:
-            feedback.setProgressText('Evaluating Group-By Expression...')
-            source_layer_dict = {}
-            source_layer_custom_ids = {}
-            source_groupby_expression_context = QgsExpressionContext()
-            source_groupby_expression_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
-            source_custom_id_context = QgsExpressionContext()
-            source_custom_id_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
-            for source_feat in source_layer.getFeatures():
+        # one index per group, so neighbors of other groups are never returned; visited points are deleted from their index
+        source_layer_points = {}
+        source_layer_groups = {}
+        source_layer_custom_ids = {}
+        group_indexes = {}
+        source_groupby_expression_context = QgsExpressionContext()
+        source_groupby_expression_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
+        source_custom_id_context = QgsExpressionContext()
+        source_custom_id_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
+        for source_feat in source_layer.getFeatures():
+            if feedback.isCanceled():
+                break
+            if groupby_expr:
                 current += 1
-                if feedback.isCanceled():
-                    break
                 source_groupby_expression_context.setFeature(source_feat)
                 source_groupby_expression_result = source_groupby_expression.evaluate(source_groupby_expression_context)
-                source_layer_dict[source_feat.id()] = source_groupby_expression_result 
+                source_layer_groups[source_feat.id()] = source_groupby_expression_result
+                group_key = self.group_key(source_groupby_expression_result)
+                feedback.setProgress(int(current * total))
+            else:
+                group_key = None
+            if add_custom_ids:
                 source_custom_id_context.setFeature(source_feat)
                 source_custom_id_result = source_custom_id.evaluate(source_custom_id_context)
                 source_layer_custom_ids[source_feat.id()] = str(source_custom_id_result)
-                feedback.setProgress(int(current * total))
-        points_skip = []
+            if source_feat.geometry().isNull() or source_feat.geometry().isEmpty():
+                continue
+            source_point = source_feat.geometry().vertices().next()
+            source_layer_points[source_feat.id()] = (source_point, group_key)
+            if group_key not in group_indexes:
+                group_indexes[group_key] = QgsSpatialIndex()
+            group_indexes[group_key].addFeature(source_feat.id(), QgsRectangle(source_point.x(), source_point.y(), source_point.x(), source_point.y()))
+        points_skip = set()
         path_group_id = 1
         
         source_orderby_request = QgsFeatureRequest()
@@ -191,8 +202,10 @@ class NearestPointsToPath(QgsProcessingAlgorithm):
                 break
             if source_feat.id() in points_skip:
                 continue
+            if source_feat.id() not in source_layer_points: # no geometry
+                continue
             
-            new_geom = [source_feat.geometry().vertices().next()] #[source_feat.geometry().centroid().asPoint()]
+            new_geom = [source_layer_points[source_feat.id()][0]] #[source_feat.geometry().centroid().asPoint()]
             new_begin = source_feat.id()
             new_end = source_feat.id()
             if add_path_fids:
@@ -205,13 +218,15 @@ class NearestPointsToPath(QgsProcessingAlgorithm):
                 new_begin_cid = source_layer_custom_ids[source_feat.id()]
                 new_end_cid = source_layer_custom_ids[source_feat.id()]
             if groupby_expr:
-                group = source_layer_dict[source_feat.id()]
+                group = source_layer_groups[source_feat.id()]
             else:
                 group = source_feat.id()
-            search_from_point_geom = source_feat.geometry()
-            search_from_point_id = source_feat.id()
+            group_idx = group_indexes[source_layer_points[source_feat.id()][1]]
             no_further_matches = False
-            points_skip.append(source_feat.id())
+            self.delete_point(group_idx, source_feat.id(), new_geom[0])
+            points_skip.add(source_feat.id())
+            if not allow_self_crossing:
+                path_segments_idx = QgsSpatialIndex() # segment i connects new_geom[i] and new_geom[i+1]
             
             for i in range(0,source_layer_feature_count + 1):
                 if feedback.isCanceled():
@@ -220,24 +235,15 @@ class NearestPointsToPath(QgsProcessingAlgorithm):
                     break
                 if len(new_geom) >= max_points:
                     break
-                nearest_neighbors = source_layer_idx.nearestNeighbor(search_from_point_geom, neighbors = -1, maxDistance = max_dist)
-                nearest_neighbors.remove(search_from_point_id)
-                for j, neighbor_id in enumerate(nearest_neighbors):
+                for neighbor_id in self.nearest_neighbors(group_idx, new_geom[-1], max_dist, not allow_self_crossing):
                     if feedback.isCanceled():
                         break
-                    if neighbor_id in points_skip:
-                        continue
-                    if groupby_expr:
-                        if not group == source_layer_dict[neighbor_id]:
-                            continue
-                    neighbor_geom = source_layer_idx.geometry(neighbor_id)
+                    neighbor_point = source_layer_points[neighbor_id][0]
                     if not allow_self_crossing:
-                        current_geom = QgsGeometry.fromPolyline(new_geom)
-                        planned_geom = QgsGeometry.fromPolyline([new_geom[-1],neighbor_geom.vertices().next()])
-                        if current_geom.crosses(planned_geom):
+                        if self.crosses_path(new_geom, path_segments_idx, neighbor_point):
                             continue
                     if add_path_dists:
-                        new_dists.append(str(round(neighbor_geom.vertices().next().distance3D(new_geom[-1].vertices().next()),6)))
+                        new_dists.append(str(round(neighbor_point.distance3D(new_geom[-1]),6)))
                         #new_dists.append(str(round(neighbor_geom.distance(QgsGeometry.fromPointXY(new_geom[-1])),6))) # distance does not support z anyways...
                     if add_path_fids:
                         new_path.append(str(neighbor_id))
@@ -246,10 +252,11 @@ class NearestPointsToPath(QgsProcessingAlgorithm):
                     new_end = neighbor_id
                     if add_custom_ids:
                         new_end_cid = source_layer_custom_ids[neighbor_id]
-                    new_geom.append(neighbor_geom.vertices().next())
-                    search_from_point_geom = neighbor_geom
-                    search_from_point_id = neighbor_id
-                    points_skip.append(neighbor_id)
+                    new_geom.append(neighbor_point)
+                    if not allow_self_crossing:
+                        path_segments_idx.addFeature(len(new_geom) - 2, self.segment_rectangle(new_geom[-2], new_geom[-1]))
+                    self.delete_point(group_idx, neighbor_id, neighbor_point)
+                    points_skip.add(neighbor_id)
                     current += 1
                     feedback.setProgress(int(current * total))
                     break
@@ -260,7 +267,7 @@ class NearestPointsToPath(QgsProcessingAlgorithm):
                 invalid_paths += 1
                 if handle_invalid == 0: # will likely create invalid geometry, but should the feature be skipped instead?
                     if len(new_geom) < 2:
-                        new_geom.append(source_feat.geometry().vertices().next()) # add a second vertex
+                        new_geom.append(new_geom[0]) # add a second vertex
                 elif handle_invalid == 1:
                     continue
                     
@@ -296,6 +303,100 @@ class NearestPointsToPath(QgsProcessingAlgorithm):
             '\nConsider re-running the algorithm and turn off options for adding semicolon-separated fields.')
         return {self.OUTPUT: dest_id}
 
+    def group_key(self, value):
+        # hashable key of a group-by expression result; values which cannot be hashed are grouped by their string
+        if isinstance(value, QVariant): # NULL
+            return None if value.isNull() else self.group_key(value.value())
+        try:
+            hash(value)
+        except TypeError:
+            return str(value)
+        return value
+
+    def delete_point(self, index, point_id, point):
+        point_feat = QgsFeature(point_id)
+        point_feat.setGeometry(QgsGeometry(point.clone()))
+        index.deleteFeature(point_feat)
+
+    def segment_rectangle(self, point_a, point_b):
+        return QgsRectangle(min(point_a.x(), point_b.x()), min(point_a.y(), point_b.y()), max(point_a.x(), point_b.x()), max(point_a.y(), point_b.y()))
+
+    def segment_intersection(self, ax, ay, bx, by, cx, cy, dx, dy):
+        # intersection of the 2D segments a-b and c-d: None, the intersection point as (x, y) or True if they overlap along a line
+        abx, aby = bx - ax, by - ay
+        cdx, cdy = dx - cx, dy - cy
+        denominator = abx * cdy - aby * cdx
+        if denominator == 0: # parallel, collinear or c-d has no length
+            if (cx - ax) * aby - (cy - ay) * abx != 0 or (dx - ax) * aby - (dy - ay) * abx != 0:
+                return None
+            ab_length2 = abx * abx + aby * aby
+            t_c = ((cx - ax) * abx + (cy - ay) * aby) / ab_length2
+            t_d = ((dx - ax) * abx + (dy - ay) * aby) / ab_length2
+            t_min = max(min(t_c, t_d), 0.0)
+            t_max = min(max(t_c, t_d), 1.0)
+            if t_min > t_max:
+                return None
+            if t_min < t_max:
+                return True
+            t = t_min
+            if t not in (0, 1): # collinear segments touching at a vertex of c-d
+                return (cx, cy) if t == t_c else (dx, dy)
+        else:
+            t = ((cx - ax) * cdy - (cy - ay) * cdx) / denominator
+            u = ((cx - ax) * aby - (cy - ay) * abx) / denominator
+            if t < 0 or t > 1 or u < 0 or u > 1:
+                return None
+            if t not in (0, 1): # use the exact vertex, so shared vertices are recognized
+                if u == 0:
+                    return (cx, cy)
+                if u == 1:
+                    return (dx, dy)
+        if t == 0:
+            return (ax, ay)
+        if t == 1:
+            return (bx, by)
+        return (ax + t * abx, ay + t * aby)
+
+    def crosses_path(self, path, path_segments_idx, point):
+        # same result as QgsGeometry.fromPolyline(path).crosses(QgsGeometry.fromPolyline([path[-1], point])), but only the
+        # segments of the path near the new segment are tested: the interiors of both lines have to meet in points only
+        ax, ay, bx, by = path[-1].x(), path[-1].y(), point.x(), point.y()
+        if (ax, ay) == (bx, by):
+            return False
+        path_start = (path[0].x(), path[0].y())
+        if path_start == (ax, ay): # a closed path has no boundary
+            path_start = None
+        crosses = False
+        for segment_id in path_segments_idx.intersects(self.segment_rectangle(path[-1], point)):
+            point_c, point_d = path[segment_id], path[segment_id + 1]
+            intersection = self.segment_intersection(ax, ay, bx, by, point_c.x(), point_c.y(), point_d.x(), point_d.y())
+            if intersection is None:
+                continue
+            if intersection is True: # overlapping lines do not cross
+                return False
+            if intersection not in ((ax, ay), (bx, by), path_start):
+                crosses = True
+        return crosses
+
+    def nearest_neighbors(self, index, point, max_dist, all_candidates):
+        # yields the ids of the nearest points in ascending distance; only the nearest one is requested from the index
+        # unless all_candidates is set, then the number of requested neighbors grows until the index has no more points
+        point = QgsPointXY(point)
+        if not all_candidates:
+            yield from index.nearestNeighbor(point, neighbors = 1, maxDistance = max_dist)[:1]
+            return
+        yielded = set()
+        n_neighbors = 8
+        while True:
+            nearest_neighbors = index.nearestNeighbor(point, neighbors = n_neighbors, maxDistance = max_dist)
+            for neighbor_id in nearest_neighbors:
+                if neighbor_id not in yielded:
+                    yielded.add(neighbor_id)
+                    yield neighbor_id
+            if len(nearest_neighbors) < n_neighbors:
+                return
+            n_neighbors *= 4
+
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -326,7 +427,7 @@ class NearestPointsToPath(QgsProcessingAlgorithm):
         ' Also, fields with the number of vertices and the total length are added.'
         '\nAdditionally you may choose whether array-like-string fields of the vertices feature ids and the distances between them shall be added.'
         ' Be aware that these array-like fields may cause an overflow, if you expect large groups or the inputlayer is pretty big. <b>USE THIS WITH CAUTION</b>, since it can cause QGIS to crash, especiall when you open the attribute table of the resultlayer.'
-        '\nThe setting to avoid self-crossing of paths is extremely computationally expensive.'
+        '\nThe setting to avoid self-crossing of paths is computationally more expensive, although each new segment is only tested against the nearby segments of the path.'
         ' It avoids self-crossing of a single feature/path in the result, but it does not prevent different result-features/paths from crossing each other.'
         ' If the algorithm cannot find a nearby point where creating a path would cross the already existing path, it will close the current feature/path and start with the next one.'
         )
\ No newline at end of file
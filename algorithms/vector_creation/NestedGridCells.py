@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Author: Mario Königbauer (mkoenigb@gmx.de)
+(C) 2022 - today by Mario Koenigbauer
+License: GNU General Public License v3.0
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Cell generator for Create Nested Grid.
+# Corners, centroids and ids of a cell are computed directly from its row and column index, so no geometry
+# operations are needed. This module intentionally does not depend on QGIS.
+
+import struct
+
+# Polygon with one ring of five vertices in little endian WKB
+POLYGON_WKB = struct.Struct('<BIII10d')
+
+# Source: https://stackoverflow.com/a/42176641/8947209
+def num_to_char(n):
+    if n < 1:
+        raise ValueError("Number must be positive")
+    result = ""
+    while True:
+        if n > 26:
+            n, r = divmod(n - 1, 26)
+            result = chr(r + ord('A')) + result
+        else:
+            return chr(n + ord('A') - 1) + result
+
+def nested_grid_cells(subgrid, subgrids, first_fid, x_min, y_max, step_x, step_y, n_x, n_y, cells_per_parent_x, cells_per_parent_y, letters_x, letters_y, row_start = 0, row_end = None, mask = None):
+    """
+    Yields (wkb, attributes) for every cell of one subgrid, row by row from top to bottom and left to right.
+    The attributes are ordered like the output fields of Create Nested Grid. Rows can be limited by row_start
+    and row_end (exclusive); fids are always computed from the row and column index: first_fid + row * n_x + column.
+    mask is an optional bytes object with one value per cell of the rows row_start to row_end; cells with 0 are skipped
+    but still count for the fids, so a cell has the same ids with and without mask.
+    """
+    if row_end is None:
+        row_end = n_y
+    uid_prefix = str(subgrid).zfill(len(str(subgrids)))
+
+    # everything depending on the column only is computed once per subgrid
+    columns = []
+    for column in range(n_x):
+        x_left = x_min + column * step_x
+        x_right = x_min + (column + 1) * step_x
+        p_x_id = int(column // cells_per_parent_x) + 1
+        c_x_id = column + 1
+        if letters_x:
+            p_x_id = num_to_char(p_x_id)
+            c_x_id = num_to_char(c_x_id)
+        columns.append((x_left, x_right, x_left + step_x / 2, p_x_id, c_x_id, '_' + str(p_x_id) + '_' + str(c_x_id), str(x_left), str(x_right)))
+
+    for row in range(row_start, row_end):
+        y_top = y_max - row * step_y
+        y_bottom = y_max - (row + 1) * step_y
+        y_cent = y_top - step_y / 2
+        p_y_id = int(row // cells_per_parent_y) + 1
+        c_y_id = row + 1
+        if letters_y:
+            p_y_id = num_to_char(p_y_id)
+            c_y_id = num_to_char(c_y_id)
+        uid_y = '_' + str(p_y_id) + '_' + str(c_y_id)
+        y_top_str = str(y_top)
+        y_bottom_str = str(y_bottom)
+        row_fid = first_fid + row * n_x
+        mask_offset = (row - row_start) * n_x
+        for column, (x_left, x_right, x_cent, p_x_id, c_x_id, uid_x, x_left_str, x_right_str) in enumerate(columns):
+            if mask is not None and mask[mask_offset + column] == 0:
+                continue
+            wkb = POLYGON_WKB.pack(1, 3, 1, 5, x_left, y_top, x_right, y_top, x_right, y_bottom, x_left, y_bottom, x_left, y_top)
+            v_coords = (x_left_str + ',' + y_top_str + ';' + x_right_str + ',' + y_top_str + ';' + x_right_str + ',' + y_bottom_str + ';' +
+                        x_left_str + ',' + y_bottom_str + ';' + x_left_str + ',' + y_top_str)
+            yield wkb, [row_fid + column, uid_prefix + uid_x + uid_y, subgrid, p_x_id, p_y_id, c_x_id, c_y_id, x_cent, y_cent, v_coords, step_x, step_y]
+
+def nested_grid_band(task):
+    """
+    Worker function for parallel processing: returns (subgrid, first row, cells) for a band of rows of one subgrid.
+    task is the argument tuple of nested_grid_cells including row_start, row_end and mask.
+    """
+    return task[0], task[13], list(nested_grid_cells(*task))
\ No newline at end of file
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Author: Mario Königbauer (mkoenigb@gmx.de)
+(C) 2022 - today by Mario Koenigbauer
+License: GNU General Public License v3.0
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Perpendicular line construction for Create Perpendicular Lines from Nearest Points.
+# The points are projected onto the vertex arrays of the lines (read from WKB) and the perpendicular lines are written
+# directly to WKB. This module intentionally does not depend on QGIS, so it can be used by worker processes.
+
+import math
+import struct
+from ..tools.LinearReferencing import wkb_linear_reference
+
+def linestring_wkb(points, has_z, has_m):
+    """Returns the ISO WKB of a LineString through the given (x, y, z, m) points; z and m are only written if has_z and has_m."""
+    values = []
+    for x, y, z, m in points:
+        values.extend((x, y))
+        if has_z:
+            values.append(z)
+        if has_m:
+            values.append(m)
+    code = 2 + (1000 if has_z else 0) + (2000 if has_m else 0)
+    return struct.pack('<BII', 1, code, len(points)) + struct.pack('<' + str(len(values)) + 'd', *values)
+
+def perpendicular_line(line_reference, x, y, length):
+    """
+    Returns (distance along the line, angle of the line in degrees, (x, y, z, m) of the closest point on the line, WKB)
+    of the line of the given length on each side, crossing the line perpendicularly at the point closest to (x, y).
+    The values equal QgsGeometry.lineLocatePoint, interpolateAngle, interpolate and QgsPoint.project. Returns None
+    for a line without vertices.
+    """
+    projection = line_reference.project(x, y)
+    if projection is None:
+        return None
+    dist_along_line, part, segment, t, dist2 = projection
+    angle_degree = math.degrees(line_reference.angle_at(part, segment, t))
+    foot = line_reference.position_xyzm(part, segment, t)
+    ends = []
+    for azimuth in (angle_degree + 90, angle_degree - 90):
+        ends.append((foot[0] + length * math.sin(math.radians(azimuth)), foot[1] + length * math.cos(math.radians(azimuth)), foot[2], foot[3]))
+    return dist_along_line, angle_degree, foot, linestring_wkb(ends, line_reference.has_z, line_reference.has_m)
+
+def perpendicular_batch(task):
+    """
+    Worker function for parallel processing: task is (lines, points) with lines being a dictionary of line id: WKB and
+    points a list of (x, y, line length, [line ids]) tuples or None. Returns for every point the list of
+    perpendicular_line results in the order of its line ids (None for lines without vertices or of another geometry
+    type), [] for None.
+    """
+    lines, points = task
+    line_references = {}
+    results = []
+    for point in points:
+        if point is None:
+            results.append([])
+            continue
+        x, y, length, line_ids = point
+        point_results = []
+        for line_id in line_ids:
+            if line_id not in line_references:
+                line_references[line_id] = wkb_linear_reference(lines[line_id])
+            line_reference = line_references[line_id]
+            point_results.append(None if line_reference is None else perpendicular_line(line_reference, x, y, length))
+        results.append(point_results)
+    return results
\ No newline at end of file
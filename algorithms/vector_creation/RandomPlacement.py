@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Author: Mario Königbauer (mkoenigb@gmx.de)
+(C) 2022 - today by Mario Koenigbauer
+License: GNU General Public License v3.0
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 3 of the License, or     *
+ *   any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+# Placement sampling for Randomly Redistribute Features inside Polygon.
+# The area a feature may be moved to is triangulated once; new positions are then drawn area weighted from the
+# triangles, so every position is inside the area without any trial and error. This module intentionally does not
+# depend on QGIS, so it can be used by worker processes.
+
+import bisect
+import random
+from ..tools.LinearReferencing import wkb_linear_reference
+
+class TriangleSampler():
+    """Draws uniformly distributed points from a list of triangles given as (x1, y1, x2, y2, x3, y3) tuples."""
+    def __init__(self, triangles):
+        self.triangles = []
+        self.cumulative_areas = []
+        self.area = 0.0
+        for triangle in triangles:
+            x1, y1, x2, y2, x3, y3 = triangle
+            area = abs((x2 - x1) * (y3 - y1) - (x3 - x1) * (y2 - y1)) / 2
+            if area > 0:
+                self.area += area
+                self.triangles.append(triangle)
+                self.cumulative_areas.append(self.area)
+
+    def sample(self, rng):
+        """Returns a random point (x, y); rng is a random.Random instance or the random module."""
+        i = min(bisect.bisect_right(self.cumulative_areas, rng.random() * self.area), len(self.triangles) - 1)
+        x1, y1, x2, y2, x3, y3 = self.triangles[i]
+        r1 = rng.random()
+        r2 = rng.random()
+        if r1 + r2 > 1: # mirror points of the parallelogram back into the triangle
+            r1 = 1 - r1
+            r2 = 1 - r2
+        return x1 + r1 * (x2 - x1) + r2 * (x3 - x1), y1 + r1 * (y2 - y1) + r2 * (y3 - y1)
+
+class BoundaryGrid():
+    """Uniform grid of the segments of the rings of a polygon, answering whether a circle reaches the rings."""
+    GRID_CELLS = 64 # cells along the longer side of the bbox of the rings
+
+    def __init__(self, rings):
+        # rings is a list of parallel coordinate lists [x, y, ...] per ring, e.g. the parts of wkb_linear_reference
+        self.segments = []
+        for ring in rings:
+            xs, ys = ring[0], ring[1]
+            self.segments.extend(zip(xs, ys, xs[1:], ys[1:]))
+        xs = [c for segment in self.segments for c in (segment[0], segment[2])] or [0.0]
+        ys = [c for segment in self.segments for c in (segment[1], segment[3])] or [0.0]
+        self.x_min, self.y_min = min(xs), min(ys)
+        self.cell = max(max(xs) - self.x_min, max(ys) - self.y_min) / self.GRID_CELLS or 1.0
+        self.cells = {}
+        for i, (x1, y1, x2, y2) in enumerate(self.segments):
+            for ci in range(self.cell_index(min(x1, x2), self.x_min), self.cell_index(max(x1, x2), self.x_min) + 1):
+                for cj in range(self.cell_index(min(y1, y2), self.y_min), self.cell_index(max(y1, y2), self.y_min) + 1):
+                    self.cells.setdefault((ci, cj), []).append(i)
+
+    def cell_index(self, value, minimum):
+        return int((value - minimum) // self.cell)
+
+    def reaches(self, x, y, radius):
+        """Returns True if a segment of the rings is closer than radius to (x, y)."""
+        r2 = radius * radius
+        for ci in range(self.cell_index(x - radius, self.x_min), self.cell_index(x + radius, self.x_min) + 1):
+            for cj in range(self.cell_index(y - radius, self.y_min), self.cell_index(y + radius, self.y_min) + 1):
+                for i in self.cells.get((ci, cj), ()):
+                    x1, y1, x2, y2 = self.segments[i]
+                    dx, dy = x2 - x1, y2 - y1
+                    l2 = dx * dx + dy * dy
+                    t = min(max(((x - x1) * dx + (y - y1) * dy) / l2, 0.0), 1.0) if l2 > 0 else 0.0
+                    fx, fy = x1 + dx * t - x, y1 + dy * t - y
+                    if fx * fx + fy * fy < r2:
+                        return True
+        return False
+
+def footprint_radius(vertices, anchor_x, anchor_y):
+    """Returns the largest distance of the given (x, y) vertices to the anchor, i.e. the radius of the circle the feature covers in any rotation."""
+    return max([((x - anchor_x) ** 2 + (y - anchor_y) ** 2) ** 0.5 for x, y in vertices] or [0.0])
+
+def feature_rng(seed, feature_id, purpose = 'placement'):
+    """Returns a random.Random instance for one feature; equal arguments always give the same random numbers."""
+    return random.Random(str(seed) + ':' + str(feature_id) + ':' + purpose)
+
+def placement_candidates(rng, sampler, rotate):
+    """Yields candidate placements (x, y, rotation) drawn from the sampler; rotation is 0 if rotate is False."""
+    while True:
+        x, y = sampler.sample(rng)
+        yield x, y, rng.uniform(0, 360) if rotate else 0.0
+
+def placement_batch(task):
+    """
+    Worker function for parallel processing: task is (seed, rotate, max_try, samplers, boundaries, features) with
+    samplers and boundaries being dictionaries of key: TriangleSampler and key: WKB of the overlay rings, and features
+    a list of (feature id, sampler key, boundary key, radius) tuples or None. A candidate is taken as soon as the circle
+    of the radius around it does not cross the rings, so the feature fits there in any rotation. Returns for every
+    feature (attempts, (x, y, rotation) or None if no candidate was taken within max_try attempts), None for None.
+    """
+    seed, rotate, max_try, samplers, boundaries, features = task
+    boundary_grids = {}
+    results = []
+    for feature in features:
+        if feature is None:
+            results.append(None)
+            continue
+        feature_id, sampler_key, boundary_key, radius = feature
+        candidates = placement_candidates(feature_rng(seed, feature_id), samplers[sampler_key], rotate)
+        placement = None
+        attempts = 0
+        while placement is None and attempts < max_try:
+            attempts += 1
+            candidate = next(candidates)
+            if radius == 0: # points can not leave the sampled area
+                placement = candidate
+                continue
+            if boundary_key not in boundary_grids:
+                boundary_reference = wkb_linear_reference(boundaries[boundary_key])
+                boundary_grids[boundary_key] = BoundaryGrid([] if boundary_reference is None else [part.coordinates for part in boundary_reference.parts])
+            if not boundary_grids[boundary_key].reaches(candidate[0], candidate[1], radius):
+                placement = candidate
+        results.append((attempts, placement))
+    return results
\ No newline at end of file
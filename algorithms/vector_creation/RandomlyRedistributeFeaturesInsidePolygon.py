@@ -14,11 +14,13 @@ License: GNU General Public License v3.0
  ***************************************************************************/
 """
 
-import processing, random, math
+import processing, random, math, collections
 from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFields, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPoint, QgsPointXY, QgsWkbTypes,
-                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm,
+from qgis.core import (QgsField, QgsFields, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsPoint, QgsPointXY, QgsWkbTypes, QgsTessellator,
+                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsProcessingParameterDefinition,
                        QgsProcessingParameterFeatureSink, QgsProcessingParameterFeatureSource, QgsProcessingParameterExpression, QgsProcessingParameterNumber, QgsProcessingParameterEnum, QgsProcessingParameterBoolean)
+from .RandomPlacement import TriangleSampler, footprint_radius, feature_rng, placement_batch
+from ..tools.WorkerPool import WorkerPool
 
 class RandomlyRedistributeFeaturesInsidePolygon(QgsProcessingAlgorithm):
     SOURCE_LYR = 'SOURCE_LYR'
@@ -28,9 +30,16 @@ class RandomlyRedistributeFeaturesInsidePolygon(QgsProcessingAlgorithm):
     ROTATE = 'ROTATE'
     MAX_TRY = 'MAX_TRY'
     HANDLE_MULTIPLE_OVERLAYS = 'HANDLE_MULTIPLE_OVERLAYS'
+    SEED = 'SEED'
+    WORKERS = 'WORKERS'
     OUTPUT = 'OUTPUT'
     OUTPUT_POLYGONS = 'OUTPUT_POLYGONS'
     
+    BUFFER_SEGMENTS = 8 # segments per quarter circle of the inner buffer
+    BATCH_SIZE = 1000 # features per task of a worker process
+    CACHE_SIZE = 256 # overlay geometries and samplers kept prepared
+    PLACEMENT_MAX_TRY = 10000 # candidates drawn from the sampler before falling back to trial and error
+    RADIUS_STEPS = 1000 # radii of the samplers are rounded up to this fraction of the size of the overlay
 
     def initAlgorithm(self, config=None):
         self.addParameter(
@@ -58,6 +67,13 @@ class RandomlyRedistributeFeaturesInsidePolygon(QgsProcessingAlgorithm):
                                                                                      'Build a uniary union polygon of all overlays',
                                                                                      'Build an intersection polygon of all overlays that intersect with the centroid'
                                                                                      ], defaultValue = 1, allowMultiple = False))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.SEED, self.tr('Seed for the random numbers (leave empty for a random seed)'), type = QgsProcessingParameterNumber.Integer, defaultValue = None, optional = True, minValue = 0))
+        parameter_workers = QgsProcessingParameterNumber(
+                self.WORKERS, self.tr('Number of worker processes placing the features in parallel (1 means no parallel processing)'), minValue = 1, maxValue = 256, defaultValue = 1, type = QgsProcessingParameterNumber.Integer)
+        parameter_workers.setFlags(parameter_workers.flags() | QgsProcessingParameterDefinition.FlagAdvanced)
+        self.addParameter(parameter_workers)
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT, self.tr('Redistributed')))
@@ -78,6 +94,8 @@ class RandomlyRedistributeFeaturesInsidePolygon(QgsProcessingAlgorithm):
         rotate = self.parameterAsBool(parameters, self.ROTATE, context)
         max_try = self.parameterAsInt(parameters, self.MAX_TRY, context)
         handle_multiple_overlays = self.parameterAsInt(parameters, self.HANDLE_MULTIPLE_OVERLAYS, context)
+        seed = None if parameters.get(self.SEED) in (None, '') else self.parameterAsInt(parameters, self.SEED, context)
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
         
         (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
                                                source_layer.fields(), source_layer.wkbType(),
@@ -98,91 +116,231 @@ class RandomlyRedistributeFeaturesInsidePolygon(QgsProcessingAlgorithm):
         feedback.setProgressText('Building spatial index...')
         overlay_layer_idx = QgsSpatialIndex(overlay_layer.getFeatures(), flags=QgsSpatialIndex.FlagStoreFeatureGeometries, feedback=feedback)
         
+        if seed is None:
+            seed = random.randrange(2**31)
+        feedback.pushInfo('Seed: ' + str(seed) + ' (use it to reproduce this result)')
+        
         feedback.setProgressText('Start processing...')
-        for current, source_feat in enumerate(source_layer.getFeatures()):
+        # the overlays and samplers of the features are prepared here and sent in batches to placement_batch, which draws
+        # the positions from the samplers (in parallel if workers > 1). Every feature has its own random stream derived from
+        # the seed and its id, so the result is reproducible and does not depend on the number of workers.
+        # Features which do not fit into the shrunk overlay are translated by trial and error here, as before.
+        pending_features = collections.deque()
+        overlay_cache = collections.OrderedDict()
+        sampler_cache = collections.OrderedDict()
+        boundary_cache = collections.OrderedDict()
+        placement_max_try = min(max_try, self.PLACEMENT_MAX_TRY) if max_try > 0 else self.PLACEMENT_MAX_TRY
+        def feature_batches():
+            samplers = {}
+            boundaries = {}
+            batch = []
+            for source_feat in source_layer.getFeatures():
+                if feedback.isCanceled():
+                    break
+                source_geom = source_feat.geometry()
+                overlay_ids = self.overlay_ids(source_geom, overlay_layer_idx, overlay_cache, handle_multiple_overlays, feature_rng(seed, source_feat.id(), 'overlay'), feedback)
+                overlay_geom = QgsGeometry()
+                overlay_geometryengine = None
+                sampler = None
+                source_anchor = None
+                if overlay_ids:
+                    # features within the same overlays share the combined geometry, its prepared engine and, for radii in the same step, the sampler
+                    overlay_geom, overlay_geometryengine = self.cached(overlay_cache, overlay_ids, lambda: self.overlay_entry(overlay_ids, overlay_layer_idx, overlay_cache, handle_multiple_overlays))
+                if overlay_geometryengine is not None:
+                    source_anchor = source_geom.centroid().asPoint()
+                    source_radius = footprint_radius([(v.x(), v.y()) for v in source_geom.vertices()], source_anchor.x(), source_anchor.y())
+                    # positions are drawn from the overlay shrunk by the radius of the feature, so the feature fits there in any rotation;
+                    # if the feature does not fit anywhere this way, fall back to trial and error translating inside the bbox of the overlay
+                    sampler_radius = self.sampler_radius(overlay_geom, source_radius)
+                    sampler_key = (overlay_ids, sampler_radius)
+                    sampler = self.cached(sampler_cache, sampler_key, lambda: self.placement_sampler(overlay_geom, sampler_radius))
+                pending_features.append((source_feat, overlay_geom, overlay_geometryengine, source_anchor))
+                if sampler is not None:
+                    samplers[sampler_key] = sampler
+                    if source_radius > 0:
+                        boundaries[overlay_ids] = self.cached(boundary_cache, overlay_ids, lambda: self.boundary_wkb(overlay_geom))
+                    batch.append((source_feat.id(), sampler_key, overlay_ids, source_radius))
+                else:
+                    batch.append(None)
+                if len(batch) >= self.BATCH_SIZE:
+                    yield seed, rotate, placement_max_try, samplers, boundaries, batch
+                    samplers = {}
+                    boundaries = {}
+                    batch = []
+            if batch:
+                yield seed, rotate, placement_max_try, samplers, boundaries, batch
+        
+        current = 0
+        with WorkerPool(workers, feedback) as pool:
+            for results in pool.imap(placement_batch, feature_batches()):
+                for result in results:
+                    source_feat, overlay_geom, overlay_geometryengine, source_anchor = pending_features.popleft()
+                    new_feat = source_feat
+                    new_geom = source_feat.geometry()
+                    aborted = False
+                    attempts, placement = result or (0, None)
+                    if placement is not None:
+                        x, y, rotation = placement
+                        new_geom.translate(dx=x - source_anchor.x(),dy=y - source_anchor.y())
+                        if rotate:
+                            new_geom.rotate(rotation=rotation,center=QgsPointXY(x, y))
+                    elif max_try > 0 and attempts >= max_try:
+                        aborted = True
+                    elif overlay_geometryengine is not None:
+                        new_geom, aborted = self.translate_randomly(source_feat, overlay_geom, overlay_geometryengine, source_anchor, rotate, max_try, attempts, feature_rng(seed, source_feat.id(), 'translation'), feedback)
+                    
+                    if aborted:
+                        new_geom = source_feat.geometry()
+                    new_feat.setGeometry(new_geom)
+                    sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
+                    
+                    new_polygon_feat = source_feat
+                    overlay_geom = QgsGeometry(overlay_geom) # do not modify the cached geometry
+                    overlay_geom.convertToMultiType()
+                    new_polygon_feat.setGeometry(overlay_geom)
+                    try: # There is no documentation on how to check if an output is optional, so we just use try except to prevent errors if its set to skip
+                        sink2.addFeature(new_polygon_feat, QgsFeatureSink.FastInsert)
+                    except:
+                        pass
+                    
+                    current += 1
+                    feedback.setProgress(int(current * total))
+            
+        return {self.OUTPUT: dest_id}
+
+    def translate_randomly(self, source_feat, overlay_geom, overlay_geometryengine, source_anchor, rotate, max_try, whilecount, rng, feedback):
+        """Translates (and rotates) the feature randomly inside the bbox of the overlay until it is inside; returns (geometry, aborted)."""
+        overlay_geom_bbox = overlay_geom.boundingBox()
+        overlay_width = overlay_geom_bbox.width()
+        overlay_height = overlay_geom_bbox.height()
+        overlay_max = math.sqrt((overlay_width**2) + (overlay_height**2))
+        new_geom = source_feat.geometry()
+        while True:
+            if feedback.isCanceled():
+                return new_geom, False
+            if whilecount > max_try and max_try > 0:
+                return new_geom, True
+            whilecount += 1
+            if whilecount % 10000 == 0:
+                feedback.pushWarning('Trying to redistribute feature ' + str(source_feat.id()) + ' in attempt #' + str(whilecount) + ' now with still no match. Consider cancelling the process or keep waiting.')
+            new_geom = source_feat.geometry()
+            new_geom.translate(dx=rng.uniform(overlay_max*-1,overlay_max),dy=rng.uniform(overlay_max*-1,overlay_max))
+            if rotate:
+                new_geom.rotate(rotation=rng.uniform(0,360),center=QgsPointXY(source_anchor))
+            if overlay_geometryengine.contains(new_geom.constGet()):
+                return new_geom, False
+
+    def overlay_ids(self, source_geom, overlay_layer_idx, overlay_cache, handle_multiple_overlays, rng, feedback):
+        """Returns the sorted tuple of the ids of the overlays the source geometry is redistributed in; empty if it is not within any overlay."""
+        overlays = overlay_layer_idx.intersects(source_geom.boundingBox())
+        intersecting_ids = []
+        
+        for overlay_id in overlays:
             if feedback.isCanceled():
                 break
+            current_overlay_geom, current_overlay_geometryengine = self.cached(overlay_cache, (overlay_id,), lambda: self.overlay_entry((overlay_id,), overlay_layer_idx, overlay_cache, handle_multiple_overlays))
+            if current_overlay_geometryengine is not None:
+                if not current_overlay_geometryengine.contains(source_geom.constGet()):
+                    continue
+            elif not source_geom.within(current_overlay_geom):
+                continue
                 
-            new_feat = source_feat
-            new_geom = source_feat.geometry()
-            overlays = overlay_layer_idx.intersects(source_feat.geometry().boundingBox())
-            intersecting_geoms = []
-            aborted = False
-            overlay_geom = QgsGeometry()
+            if handle_multiple_overlays == 0:
+                return (overlay_id,)
+            elif handle_multiple_overlays == 3:
+                if current_overlay_geom.intersects(source_geom.centroid()):
+                    intersecting_ids.append(overlay_id)
+            else:
+                intersecting_ids.append(overlay_id)
             
-            if overlays:
-                for overlay_id in overlays:
-                    if feedback.isCanceled():
-                        break
-                    current_overlay_geom = overlay_layer_idx.geometry(overlay_id)
-                    if not source_feat.geometry().within(current_overlay_geom):
-                        continue
-                        
-                    if handle_multiple_overlays == 0:
-                        overlay_geom = current_overlay_geom
-                        break
-                    elif handle_multiple_overlays == 3:
-                        if current_overlay_geom.intersects(source_feat.geometry().centroid()):
-                            intersecting_geoms.append(current_overlay_geom)
+        if handle_multiple_overlays == 1 and intersecting_ids:
+            return (rng.choice(intersecting_ids),)
+        return tuple(sorted(intersecting_ids))
+
+    def overlay_entry(self, overlay_ids, overlay_layer_idx, overlay_cache, handle_multiple_overlays):
+        """Returns (geometry, prepared engine) of the combined overlays; the engine is None if the geometry is not valid."""
+        if len(overlay_ids) == 1:
+            overlay_geom = overlay_layer_idx.geometry(overlay_ids[0])
+        else:
+            intersecting_geoms = [self.cached(overlay_cache, (overlay_id,), lambda: self.overlay_entry((overlay_id,), overlay_layer_idx, overlay_cache, handle_multiple_overlays))[0] for overlay_id in overlay_ids]
+            if handle_multiple_overlays == 2:
+                overlay_geom = QgsGeometry().unaryUnion(intersecting_geoms)
+            else:
+                for i, intersecting_geom in enumerate(intersecting_geoms):
+                    if i == 0:
+                        overlay_geom = intersecting_geoms[0]
                     else:
-                        intersecting_geoms.append(current_overlay_geom)
-                    
-                if handle_multiple_overlays != 0 and intersecting_geoms:
-                    if handle_multiple_overlays == 1:
-                        overlay_geom = random.choice(intersecting_geoms)
-                    if handle_multiple_overlays == 2:
-                        overlay_geom = QgsGeometry().unaryUnion(intersecting_geoms)
-                    if handle_multiple_overlays == 3:
-                        if len(intersecting_geoms) == 1:
-                            overlay_geom = intersecting_geoms[0]
-                        else:
-                            for i, intersecting_geom in enumerate(intersecting_geoms):
-                                if i == 0:
-                                    overlay_geom = intersecting_geoms[0]
-                                else:
-                                    overlay_geom = overlay_geom.intersection(intersecting_geom)
-                        
-                if (not overlay_geom.isNull() or not overlay_geom.isEmpty()) and overlay_geom.isGeosValid():
-                    overlay_geom_bbox = overlay_geom.boundingBox()
-                    overlay_width = overlay_geom_bbox.width()
-                    overlay_height = overlay_geom_bbox.height()
-                    overlay_max = math.sqrt((overlay_width**2) + (overlay_height**2))
-                    overlay_geometryengine = QgsGeometry.createGeometryEngine(overlay_geom.constGet())
-                    overlay_geometryengine.prepareGeometry()
-                    inside = False
-                    whilecount = 0
-                    while inside is False:
-                        if feedback.isCanceled():
-                            break
-                        if whilecount > max_try and max_try > 0:
-                            aborted = True
-                            break
-                        whilecount += 1
-                        if whilecount % 10000 == 0:
-                            feedback.pushWarning('Trying to redistribute feature ' + str(source_feat.id()) + ' in attempt #' + str(whilecount) + ' now with still no match. Consider cancelling the process or keep waiting.')
-                        new_geom = source_feat.geometry()
-                        new_geom.translate(dx=random.uniform(overlay_max*-1,overlay_max),dy=random.uniform(overlay_max*-1,overlay_max))
-                        if rotate:
-                            new_geom.rotate(rotation=random.uniform(0,360),center=QgsPointXY(source_feat.geometry().centroid().asPoint()))
-                        if overlay_geometryengine.contains(new_geom.constGet()):
-                            inside = True
-                            
-            if aborted:
-                new_geom = source_feat.geometry()
-            new_feat.setGeometry(new_geom)
-            sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
-            
-            new_polygon_feat = source_feat
-            overlay_geom.convertToMultiType()
-            new_polygon_feat.setGeometry(overlay_geom)
-            try: # There is no documentation on how to check if an output is optional, so we just use try except to prevent errors if its set to skip
-                sink2.addFeature(new_polygon_feat, QgsFeatureSink.FastInsert)
-            except:
-                pass
-            
-            feedback.setProgress(int(current * total))
-            
-        return {self.OUTPUT: dest_id}
+                        overlay_geom = overlay_geom.intersection(intersecting_geom)
+        if overlay_geom.isNull() or overlay_geom.isEmpty() or not overlay_geom.isGeosValid():
+            return overlay_geom, None
+        overlay_geometryengine = QgsGeometry.createGeometryEngine(overlay_geom.constGet())
+        overlay_geometryengine.prepareGeometry()
+        return overlay_geom, overlay_geometryengine
+
+    def cached(self, cache, key, build):
+        # least recently used cache on an OrderedDict: returns the cached value of key or stores and returns build()
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        value = build()
+        cache[key] = value
+        if len(cache) > self.CACHE_SIZE:
+            cache.popitem(last = False)
+        return value
+
+    def boundary_wkb(self, overlay_geom):
+        # WKB of the rings of the overlay for placement_batch; curves are segmentized before
+        if QgsWkbTypes.isCurvedType(overlay_geom.wkbType()):
+            overlay_geom = QgsGeometry(overlay_geom.constGet().segmentize())
+        return bytes(QgsGeometry(overlay_geom.constGet().boundary()).asWkb())
+
+    def sampler_radius(self, overlay_geom, radius):
+        # rounds the radius up to the next step, so features of similar size share a sampler; a larger radius only shrinks the area a little more
+        if radius == 0:
+            return 0.0
+        overlay_bbox = overlay_geom.boundingBox()
+        step = max(overlay_bbox.width(), overlay_bbox.height()) / self.RADIUS_STEPS
+        return math.ceil(radius / step) * step if step > 0 else radius
+
+    def placement_sampler(self, overlay_geom, radius):
+        """Returns a TriangleSampler for the positions of a feature's anchor inside the overlay, or None if there are none."""
+        overlay_bbox = overlay_geom.boundingBox()
+        tolerance = max(overlay_bbox.width(), overlay_bbox.height()) * 1e-6 # the tessellation uses single precision coordinates
+        region = overlay_geom.buffer(-(radius + tolerance), self.BUFFER_SEGMENTS)
+        if region.isNull() or region.isEmpty():
+            return None
+        triangles = self.triangulate(region)
+        if not triangles:
+            return None
+        sampler = TriangleSampler(triangles)
+        if abs(sampler.area - region.area()) > region.area() * 1e-3:
+            return None
+        return sampler
+
+    def triangulate(self, geometry):
+        """Returns the triangles of a polygon geometry as (x1, y1, x2, y2, x3, y3) tuples or None if the tessellation does not match the geometry."""
+        bbox = geometry.boundingBox()
+        dx = bbox.xMinimum()
+        dy = bbox.yMinimum()
+        # the tessellator uses single precision coordinates, so the geometry is moved to the origin before; with an origin
+        # of (0, 0) the tessellator itself does not move the triangles, whether or not the QGIS version moves them back
+        geometry = QgsGeometry(geometry)
+        geometry.translate(-dx, -dy)
+        triangles = []
+        for part in geometry.constParts():
+            tessellator = QgsTessellator(0, 0, False)
+            tessellator.addPolygon(part, 0)
+            for triangle in QgsGeometry(tessellator.asMultiPolygon()).asMultiPolygon():
+                (x1, y1), (x2, y2), (x3, y3) = [(p.x() + dx, p.y() + dy) for p in triangle[0][:3]]
+                triangles.append((x1, y1, x2, y2, x3, y3))
+        if not triangles:
+            return None
+        x_max = max(max(t[0], t[2], t[4]) for t in triangles)
+        y_max = max(max(t[1], t[3], t[5]) for t in triangles)
+        tolerance = max(bbox.width(), bbox.height()) * 1e-4
+        if abs(x_max - bbox.xMaximum()) > tolerance or abs(y_max - bbox.yMaximum()) > tolerance:
+            return None
+        return triangles
 
 
     def tr(self, string):
@@ -206,9 +364,13 @@ class RandomlyRedistributeFeaturesInsidePolygon(QgsProcessingAlgorithm):
     def shortHelpString(self):
         return self.tr(
         'This algorithm redistributes features randomly inside a given polygon by using translate in x and y direction. You can also choose to rotate the features randomly. '
+        'New positions are drawn uniformly from the polygon shrunk by the size of the feature, so points and features that are small compared to the polygon are placed without retries, also in thin or concave polygons. '
+        'Only if a feature does not fit into the shrunk polygon, random translations are tried until the feature is inside the polygon.\n'
         'z and m values are not considered. The source layer can be of multi- or singletype and contain points, lines or polygons.\n'
         'You can choose between different methods on how to handle the overlay / polygon features, if the source feature is within multiple overlay polygons.\n'
         'You can also add these polygons used for redistributing the source features as an optional output. This output is set to skip by default.\n'
         'If a feature is not within at least one polygon, its geometry will not be modified.\n'
+        'Every feature gets its own random numbers derived from the seed and the feature id, so with the same seed the result is reproducible. The seed is printed to the log if none is given.\n'
+        'For large layers the features can be placed by several worker processes in parallel (advanced parameter); the result is the same as without.\n'
         'You can also set a limit for the maximum tries of randomly translating the source feature. If no match is found before this limit is exceeded, the source features geometry remain unchanged.\n'
         )
\ No newline at end of file
@@ -13,9 +13,9 @@ License: GNU General Public License v3.0
  ***************************************************************************/
 """
 
-import processing, random
-from PyQt5.QtCore import QCoreApplication, QVariant
-from qgis.core import (QgsField, QgsFields, QgsFeature, QgsProcessing, QgsExpression, QgsSpatialIndex, QgsGeometry, QgsWkbTypes,
+import processing, random, json
+from PyQt5.QtCore import Qt, QCoreApplication, QVariant, QDate, QTime, QDateTime
+from qgis.core import (QgsField, QgsFields, QgsFeature, QgsProcessing, QgsExpression, QgsGeometry, QgsWkbTypes,
                        QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsExpressionContext, QgsExpressionContextUtils,
                        QgsProcessingParameterVectorLayer, QgsProcessingParameterFeatureSink, QgsProcessingParameterFeatureSource, 
                        QgsProcessingParameterEnum, QgsProcessingParameterField, QgsProcessingParameterExpression, QgsProcessingParameterBoolean)
@@ -29,6 +29,10 @@ class TranslateDuplicateFeaturesToColumns(QgsProcessingAlgorithm):
     OUTPUT_STRUCTURE = 'OUTPUT_STRUCTURE'
     FIELDS_TO_TRANSLATE = 'FIELDS_TO_TRANSLATE'
     OUTPUT = 'OUTPUT'
+    LONG_TABLE = 'LONG_TABLE'
+
+    # expression results of these types are grouped by their hash, all others (e.g. arrays or maps) by comparing them
+    HASHABLE_TYPES = (str, int, float, bool, bytes, type(None), QDate, QTime, QDateTime)
 
     def initAlgorithm(self, config=None):
         self.addParameter(
@@ -56,7 +60,9 @@ class TranslateDuplicateFeaturesToColumns(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterEnum(
                 self.OUTPUT_STRUCTURE, self.tr('Choose the desired structure for the output'), ['Create new field for each duplicate feature field',
-                                                                                                'Create one dictionary string-field for each duplicate feature'], 
+                                                                                                'Create one dictionary string-field for each duplicate feature',
+                                                                                                'Create one JSON string-field containing all duplicate features',
+                                                                                                'Do not translate fields (write them to the long table only)'], 
                                                                                                 defaultValue = 0, allowMultiple = False))
         self.addParameter(
             QgsProcessingParameterField(
@@ -64,6 +70,9 @@ class TranslateDuplicateFeaturesToColumns(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT, self.tr('Translated')))
+        self.addParameter(
+            QgsProcessingParameterFeatureSink(
+                self.LONG_TABLE, self.tr('Duplicates as long table (group id, rank, field, value)'), QgsProcessing.TypeVector, optional = True, createByDefault = False))
 
     def processAlgorithm(self, parameters, context, feedback):
         feedback.setProgressText('Prepare processing...')
@@ -96,70 +105,55 @@ class TranslateDuplicateFeaturesToColumns(QgsProcessingAlgorithm):
             order_by = QgsFeatureRequest.OrderBy([QgsFeatureRequest.OrderByClause(source_orderby_expression)])
             source_orderby_request.setOrderBy(order_by)
                 
-        source_layer_attr_dict = {}
         source_layer_expression_context = QgsExpressionContext()
         source_layer_expression_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
-        duplicate_geom_dict = {}
-        if duplicate_method in (1,2,3):
-            feedback.setProgressText('Building spatial index...')
-            source_layer_idx = QgsSpatialIndex(source_layer.getFeatures(), flags=QgsSpatialIndex.FlagStoreFeatureGeometries, feedback=feedback)
+        translate_field_indices = [source_layer.fields().indexFromName(field_name) for field_name in fields_to_translate]
+        feat_positions = {} # position of each feature in order-by iteration
+        duplicate_cache = {} # attributes to translate and geometry of each feature, so duplicates do not need to be requested again
+        attr_groups = {} # expression result: list of feature ids
+        attr_groups_unhashable = [] # [(expression result, list of feature ids)]
+        geom_groups = {} # hash of normalized wkb: [(geometry, list of feature ids)]
+        pair_groups = {} # (id of attribute group, id of geometry group): list of feature ids
+        feat_attr_group = {} # feature id: list of feature ids with the same expression result
+        feat_geom_group = {} # feature id: list of feature ids with an equal geometry
+        feat_pair_group = {} # feature id: list of feature ids with the same expression result and an equal geometry
         feedback.setProgressText('Evaluating geometries/expressions...')
         for source_feat in source_layer.getFeatures(source_orderby_request):
             current += 1
             if feedback.isCanceled():
                 break
+            source_feat_id = source_feat.id()
+            feat_positions[source_feat_id] = current
+            duplicate_cache[source_feat_id] = ([source_feat.attribute(field_index) for field_index in translate_field_indices],
+                                               source_feat.geometry() if preserve_geometry in (1,2) else None)
             if duplicate_method in (0,2,3):
                 source_layer_expression_context.setFeature(source_feat)
                 source_layer_expression_result = duplicate_expression.evaluate(source_layer_expression_context)
-                source_layer_attr_dict[source_feat.id()] = source_layer_expression_result 
+                feat_attr_group[source_feat_id] = self.group_by_value(attr_groups, attr_groups_unhashable, source_layer_expression_result, source_feat_id)
             if duplicate_method in (1,2,3):
-                duplicate_geom_dict[source_feat.id()] = []
-                bbox_intersecting = source_layer_idx.intersects(source_feat.geometry().boundingBox())
-                try:
-                    bbox_intersecting.remove(source_feat.id())
-                except:
-                    pass
-                source_feat_geometryengine = QgsGeometry.createGeometryEngine(source_feat.geometry().constGet())
-                source_feat_geometryengine.prepareGeometry()
-                for overlay_feat_id in bbox_intersecting:
-                    overlay_feat_geom = source_layer_idx.geometry(overlay_feat_id).constGet()
-                    if source_feat_geometryengine.isEqual(overlay_feat_geom):
-                        duplicate_geom_dict[source_feat.id()].append(overlay_feat_id)
+                feat_geom_group[source_feat_id] = self.group_by_geometry(geom_groups, source_feat.geometry(), source_feat_id)
+            if duplicate_method in (2,3):
+                pair_group = pair_groups.setdefault((id(feat_attr_group[source_feat_id]), id(feat_geom_group[source_feat_id])), [])
+                pair_group.append(source_feat_id)
+                feat_pair_group[source_feat_id] = pair_group
             feedback.setProgress(int(current * total))
-                
+        attr_groups = attr_groups_unhashable = geom_groups = pair_groups = None # lookup tables are not needed anymore
+
         feedback.setProgressText('Setting up output structure...')
-        duplicate_attr_dict = {}
-        if duplicate_method in (0,2,3):
-            for source_feat_id, value in source_layer_attr_dict.items():
-                duplicate_attr_dict[source_feat_id] = [id for id, val in source_layer_attr_dict.items() if val == value]
-                try:
-                    duplicate_attr_dict[source_feat_id].remove(source_feat_id)
-                except:
-                    pass
-        
-        duplicate_dict = {}
-        if duplicate_method in (2,3):
-            # merge attr and geom dict: https://stackoverflow.com/a/59279514/8947209
-            duplicate_dict = {k: list(d[k] for d in (duplicate_attr_dict, duplicate_geom_dict) if k in d) for k in set(duplicate_attr_dict.keys()) | set(duplicate_geom_dict.keys())}
-            if duplicate_method == 2: # attr or geom duplicate
-                # combine lists to one list and remove duplicates
-                for k, v in duplicate_dict.items():
-                    duplicate_dict[k] = list(set([item for sublist in v for item in sublist]))
-            elif duplicate_method == 3: # attr and geom duplicate
-                # combine lists to one list only if fid is in all sublists and remove duplicates
-                for k, v in duplicate_dict.items():
-                    duplicate_dict[k] = list(set.intersection(*[set(sublist) for sublist in v]))
-        elif duplicate_method == 0:
-            duplicate_dict = duplicate_attr_dict
+        duplicate_groups = {}
+        if duplicate_method == 0:
+            duplicate_groups = feat_attr_group
         elif duplicate_method == 1:
-            duplicate_dict = duplicate_geom_dict
+            duplicate_groups = feat_geom_group
+        elif duplicate_method == 2: # attr or geom duplicate: the union of both groups, counted without building it
+            max_duplicate_fields = max((len(feat_attr_group[k]) + len(feat_geom_group[k]) - len(v) for k, v in feat_pair_group.items()), default = 0)
+        elif duplicate_method == 3: # attr and geom duplicate
+            duplicate_groups = feat_pair_group
         else:
             feedback.reportError('Undefined duplicate method!', fatalError = True)
-        
-        try:
-            max_duplicate_fields = len(max(duplicate_dict.values(), key=len)) +1
-        except:
-            max_duplicate_fields = 0
+
+        if duplicate_method != 2:
+            max_duplicate_fields = max((len(v) for v in duplicate_groups.values()), default = 0)
         
         if max_duplicate_fields == 0:
             feedback.pushWarning('Could not find any duplicates!')
@@ -180,7 +174,24 @@ class TranslateDuplicateFeaturesToColumns(QgsProcessingAlgorithm):
             dict_fieldname = 'feature_dictionary'
             for i in range(0,max_duplicate_fields):
                 output_layer_fields.append(QgsField(dict_fieldname + '_' + str(i), QVariant.String))
-                
+
+        elif output_structure == 2: # Create one json field
+            json_fieldname = 'feature_json'
+            output_layer_fields.append(QgsField(json_fieldname, QVariant.String))
+
+        long_table_fields = QgsFields()
+        long_table_fields.append(QgsField('duplicate_group_id', QVariant.Int))
+        long_table_fields.append(QgsField('rank', QVariant.Int))
+        long_table_fields.append(QgsField('field', QVariant.String))
+        long_table_fields.append(QgsField('value', QVariant.String))
+        (long_table_sink, long_table_dest_id) = self.parameterAsSink(parameters, self.LONG_TABLE, context,
+                                                                     long_table_fields, QgsWkbTypes.NoGeometry,
+                                                                     source_layer.sourceCrs())
+        if long_table_sink is not None or output_structure == 3: # the group id links the output to the long table
+            output_layer_fields.append(QgsField('duplicate_group_id', QVariant.Int))
+        if long_table_sink is None and output_structure == 3:
+            feedback.pushWarning('You chose to write the fields only to the long table but did not set an output for it!')
+
         cl = output_layer_fields.count()
         if cl > 250:
             feedback.pushWarning('WARNING: Output layer will have more than ' + str(cl) + ' fields. Expect QGIS to crash when you open the attribute table of the result!')
@@ -199,7 +210,8 @@ class TranslateDuplicateFeaturesToColumns(QgsProcessingAlgorithm):
         feedback.setProgressText('Start processing...')
         duplicate_expression_context = QgsExpressionContext()
         duplicate_expression_context.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(source_layer_vl))
-        skip_feats = []
+        skip_feats = set()
+        duplicate_group_id = 0
         for source_feat in source_layer.getFeatures(source_orderby_request):
             current += 1
             feedback.setProgress(int(current * total))
@@ -207,26 +219,23 @@ class TranslateDuplicateFeaturesToColumns(QgsProcessingAlgorithm):
                 break
             if source_feat.id() in skip_feats:
                 continue
+            if source_feat.id() not in feat_positions: # feature was added after evaluating the duplicates
+                continue
             
             new_feat = QgsFeature(output_layer_fields)
             new_feat_geom = QgsGeometry()
             duplicate_geoms = [source_feat.geometry()]
-            duplicate_attrs = {}
-            
+            duplicate_rows = [[source_feat.attribute(field_index) for field_index in translate_field_indices]] # rank 0 is the source feat
+            duplicate_group_id += 1
+
             for source_feat_field in source_feat.fields():
                 if source_feat_field.name() not in fields_to_translate:
                     new_feat[source_feat_field.name()] = source_feat.attribute(source_feat_field.name())
-            
-            if output_structure == 0: # Create a field
-                for field_name in fields_to_translate:
-                    new_feat[field_name + '_' + str(0)] = source_feat.attribute(field_name)
-            if output_structure == 1: # Create one dictionary
-                for field_name in fields_to_translate:
-                    duplicate_attrs[field_name] = source_feat.attribute(field_name)
-                new_feat[dict_fieldname + '_' + str(0)] = str(duplicate_attrs)
-            
-            duplicate_feature_ids = duplicate_dict[source_feat.id()]
-            duplicate_cnt = 0
+
+            if duplicate_method == 2: # attr or geom duplicate
+                duplicate_feature_ids = sorted(set(feat_attr_group[source_feat.id()]) | set(feat_geom_group[source_feat.id()]), key = feat_positions.get)
+            else:
+                duplicate_feature_ids = duplicate_groups[source_feat.id()]
             for duplicate_feat_id in duplicate_feature_ids:
                 if feedback.isCanceled():
                     break
@@ -234,28 +243,41 @@ class TranslateDuplicateFeaturesToColumns(QgsProcessingAlgorithm):
                     continue
                 if duplicate_feat_id in skip_feats:
                     continue
-                duplicate_cnt += 1 # 0 is the source feat
-                
-                duplicate_request = QgsFeatureRequest()
-                duplicate_request.setSubsetOfAttributes(fields_to_translate, source_layer.fields())
-                duplicate_request.setFilterFid(duplicate_feat_id)
-                duplicate_feat = next(source_layer.getFeatures(duplicate_request))
-                
-                duplicate_attrs = {}
-                if output_structure == 0: # Create a field
-                    for field_name in fields_to_translate:
-                        new_feat[field_name + '_' + str(duplicate_cnt)] = duplicate_feat.attribute(field_name)
-                if output_structure == 1: # Create one dictionary
-                    for field_name in fields_to_translate:
-                        duplicate_attrs[field_name] = duplicate_feat.attribute(field_name)
-                    new_feat[dict_fieldname + '_' + str(duplicate_cnt)] = str(duplicate_attrs)
-                duplicate_geoms.append(duplicate_feat.geometry())
-                
-                if len(str(duplicate_attrs)) > 1000:
+                duplicate_feat_attrs, duplicate_feat_geom = duplicate_cache.pop(duplicate_feat_id)
+                duplicate_rows.append(duplicate_feat_attrs)
+                duplicate_geoms.append(duplicate_feat_geom)
+                skip_feats.add(duplicate_feat_id)
+            skip_feats.add(source_feat.id())
+            duplicate_cache.pop(source_feat.id(), None)
+
+            if output_structure == 0: # Create a field
+                for duplicate_cnt, duplicate_row in enumerate(duplicate_rows):
+                    for field_name, field_value in zip(fields_to_translate, duplicate_row):
+                        new_feat[field_name + '_' + str(duplicate_cnt)] = field_value
+            elif output_structure == 1: # Create one dictionary
+                for duplicate_cnt, duplicate_row in enumerate(duplicate_rows):
+                    duplicate_attrs = str(dict(zip(fields_to_translate, duplicate_row)))
+                    new_feat[dict_fieldname + '_' + str(duplicate_cnt)] = duplicate_attrs
+                    if len(duplicate_attrs) > 1000:
+                        maxstrlengthexceeded = True
+            elif output_structure == 2: # Create one json field
+                duplicate_attrs = json.dumps([dict(zip(fields_to_translate, duplicate_row)) for duplicate_row in duplicate_rows],
+                                             separators = (',', ':'), ensure_ascii = False, default = self.json_value)
+                new_feat[json_fieldname] = duplicate_attrs
+                if len(duplicate_attrs) > 1000:
                     maxstrlengthexceeded = True
-                    
-                skip_feats.append(duplicate_feat_id)
-            skip_feats.append(source_feat.id())
+
+            if long_table_sink is not None:
+                new_feat['duplicate_group_id'] = duplicate_group_id
+                long_table_feats = []
+                for duplicate_cnt, duplicate_row in enumerate(duplicate_rows):
+                    for field_name, field_value in zip(fields_to_translate, duplicate_row):
+                        long_table_feat = QgsFeature(long_table_fields)
+                        long_table_feat.setAttributes([duplicate_group_id, duplicate_cnt, field_name, self.text_value(field_value)])
+                        long_table_feats.append(long_table_feat)
+                long_table_sink.addFeatures(long_table_feats, QgsFeatureSink.FastInsert)
+            elif output_structure == 3:
+                new_feat['duplicate_group_id'] = duplicate_group_id
             
             if preserve_geometry == 0: # Keep first geometry of order-by expression
                 new_feat_geom = duplicate_geoms[0]
@@ -267,11 +289,59 @@ class TranslateDuplicateFeaturesToColumns(QgsProcessingAlgorithm):
             
             sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
         
-        if output_structure == 1:
+        if output_structure in (1,2):
             if maxstrlengthexceeded:
                 feedback.pushWarning('WARNING: At least one output attribute will have more than ' + str(1000) + ' characters. Open the attribute table of the result carefully and expect QGIS to crash!')
         
-        return {self.OUTPUT: dest_id}
+        return {self.OUTPUT: dest_id, self.LONG_TABLE: long_table_dest_id}
+
+    def json_value(self, value):
+        # converts attribute values the json encoder does not know
+        if isinstance(value, QVariant): # NULL
+            return None if value.isNull() else value.value()
+        if isinstance(value, (QDate, QTime, QDateTime)):
+            return value.toString(Qt.ISODate)
+        return str(value)
+
+    def text_value(self, value):
+        # attribute value for the long table: NULL stays NULL, strings are kept, everything else is written as json
+        if not isinstance(value, (str, int, float, bool, list, dict, type(None))):
+            value = self.json_value(value)
+        if value is None or isinstance(value, str):
+            return value
+        return json.dumps(value, separators = (',', ':'), ensure_ascii = False, default = self.json_value)
+
+    def group_by_value(self, groups, unhashable_groups, value, feat_id):
+        # appends the feature id to the group of features with the same value and returns the group
+        if isinstance(value, QVariant): # NULL
+            value = None if value.isNull() else value.value()
+        if isinstance(value, self.HASHABLE_TYPES):
+            group = groups.setdefault(value, [])
+        else:
+            for other_value, group in unhashable_groups:
+                if other_value == value:
+                    break
+            else:
+                group = []
+                unhashable_groups.append((value, group))
+        group.append(feat_id)
+        return group
+
+    def group_by_geometry(self, groups, geometry, feat_id):
+        # appends the feature id to the group of features with an equal geometry and returns the group
+        # geometries are hashed by their normalized wkb; GEOS only compares geometries with the same hash
+        if geometry.isNull() or geometry.isEmpty():
+            return [feat_id]
+        normalized_geometry = QgsGeometry(geometry)
+        normalized_geometry.normalize()
+        candidates = groups.setdefault(hash(bytes(normalized_geometry.asWkb())), [])
+        for candidate_geometry, group in candidates:
+            if candidate_geometry.isGeosEqual(geometry):
+                group.append(feat_id)
+                return group
+        group = [feat_id]
+        candidates.append((geometry, group))
+        return group
 
 
     def tr(self, string):
@@ -295,6 +365,7 @@ class TranslateDuplicateFeaturesToColumns(QgsProcessingAlgorithm):
     def shortHelpString(self):
         return self.tr(
             'This algorithm translates features (rows) to columns by an duplicate-identifier, which can be an expression, a field or geometry. \n'
+            'Geometries are duplicates if they are equal and have the same vertices; the start vertex and orientation of rings do not matter.\n'
             'You can choose which geometry of these duplicates you want to keep; either the first one in order-by expression or feature id, a random one or a unary union multipart geometry.\n'
             'You may also set up the output structure yourself. Duplicated fields ending with a 0 as postfix (original_fieldname_0) contain the information of the first feature. '
             '<b>Create new field for each duplicate feature field</b> creates a copy for each field per duplicate with a number as postfix in its name (original_fieldname_n) containing the attributes of the duplicate. '
@@ -302,6 +373,10 @@ class TranslateDuplicateFeaturesToColumns(QgsProcessingAlgorithm):
             '<b>Create one dictionary string-field for each duplicate feature</b> creates one new string field with a number as postfix in its name (feature_dictionary_n) for each duplicate feature. '
             'This field contains a Python dictionary as string with the fieldnames as keys and its attributes as values. For example: <i>{\'field_one\':1,\'field_two\':\'some_attribute\',\'field_three\':42}</i>. '
             '<b>Warning:</b> If the number of fields exceed the limit of maximum fields possible, or the string length of its attributes exceeds the maximum string length possible, this can lead to an overflow and cause QGIS to crash, especially when opening the attribute table!\n'
+            '<b>Create one JSON string-field containing all duplicate features</b> creates a single field (feature_json) with a JSON array of one object per duplicate feature, the first one being the first feature. '
+            '<b>Do not translate fields</b> only keeps the fields not to translate and is meant to be used together with the long table.\n'
+            'The optional long table output contains one row per duplicate feature and translated field with the columns duplicate_group_id, rank (0 for the first feature), field and value. '
+            'It can be saved e.g. to a GeoPackage or Parquet file and is linked to the translated output by the additional field duplicate_group_id.\n'
             'In fields to translate you can choose the fields you want to translate. These will be copied as <i>original_fieldname_n</i> as explained above. '
             'The fields you do not choose here, will not be translated and kept as they are: <i>original_fieldname</i> having only the attribute information of the first feature in iteration order (you can set up individually in order-by expression).'
             )
\ No newline at end of file
@@ -17,21 +17,35 @@ import processing
 import math
 from PyQt5.QtCore import QCoreApplication, QVariant, QDateTime
 from qgis.core import (QgsField, QgsFeature, QgsProcessing, QgsExpression,
-                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsExpressionContext, QgsExpressionContextUtils, QgsGeometry, QgsPointXY,
-                       QgsProcessingParameterVectorLayer, QgsProcessingParameterFeatureSink, QgsProcessingParameterFeatureSource, QgsProcessingParameterExpression)
+                       QgsFeatureSink, QgsFeatureRequest, QgsProcessingAlgorithm, QgsExpressionContext, QgsExpressionContextUtils, QgsGeometry, QgsPoint, QgsPointXY, QgsLineString, QgsFields, QgsWkbTypes,
+                       QgsProcessingParameterVectorLayer, QgsProcessingParameterFeatureSink, QgsProcessingParameterFeatureSource, QgsProcessingParameterExpression,
+                       QgsProcessingParameterEnum, QgsProcessingParameterNumber, QgsProcessingParameterField)
+from ..tools.LinearReferencing import LinearReference
 
 class InterpolateDateTimeAlongLine(QgsProcessingAlgorithm):
     METHOD = 'METHOD'
     SOURCE_LYR = 'SOURCE_LYR'
+    TIMING = 'TIMING'
     SOURCE_START_TIME_EXPR = 'SOURCE_START_TIME_EXPR'
     SOURCE_END_TIME_EXPR = 'SOURCE_END_TIME_EXPR'
     SOURCE_INTERPOLATION_DENSITY_EXPR = 'SOURCE_INTERPOLATION_DENSITY_EXPR'
+    OUTPUT_MODE = 'OUTPUT_MODE'
+    POINT_TIME_STEP = 'POINT_TIME_STEP'
+    POINT_FIELDS = 'POINT_FIELDS'
     OUTPUT = 'OUTPUT'
 
+    POINT_BATCH_SIZE = 10000 # points written to the sink at once
+
     def initAlgorithm(self, config=None):
         self.addParameter(
             QgsProcessingParameterFeatureSource(
                 self.SOURCE_LYR, self.tr('Source Layer (must be in metric CRS!)'),[QgsProcessing.TypeVectorLine]))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.TIMING, self.tr('Timing'), ['Constant speed between start-datetime and end-datetime',
+                                                 'M values of the vertices (seconds since start-datetime)',
+                                                 'M values of the vertices (seconds since 1970-01-01, unix time)'
+                                                 ], defaultValue = 0, allowMultiple = False))
         self.addParameter(
             QgsProcessingParameterExpression(
                 self.SOURCE_START_TIME_EXPR, self.tr('Expression, field or datetime representing start-datetime of features (must be in datetime format!)'), parentLayerParameterName = 'SOURCE_LYR', optional = False, defaultValue = 'now()'))
@@ -41,6 +55,18 @@ class InterpolateDateTimeAlongLine(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterExpression(
                 self.SOURCE_INTERPOLATION_DENSITY_EXPR, self.tr('Expression, field or number representing maximum length of segments (integer or double; must be in meters!)'), parentLayerParameterName = 'SOURCE_LYR', optional = False, defaultValue = 'length($geometry) / 10'))
+        self.addParameter(
+            QgsProcessingParameterEnum(
+                self.OUTPUT_MODE, self.tr('Output'), ['Line segments with all source attributes',
+                                                      'Points at fixed time steps',
+                                                      'Points at fixed distances (using the maximum length of segments)'
+                                                      ], defaultValue = 0, allowMultiple = False))
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.POINT_TIME_STEP, self.tr('Time step between points in seconds (only for points at fixed time steps)'), type = QgsProcessingParameterNumber.Double, defaultValue = 60, minValue = 0.001))
+        self.addParameter(
+            QgsProcessingParameterField(
+                self.POINT_FIELDS, self.tr('Source attributes to add to the points (only for point output)'), parentLayerParameterName = 'SOURCE_LYR', allowMultiple = True, optional = True))
         self.addParameter(
             QgsProcessingParameterFeatureSink(
                 self.OUTPUT, self.tr('Interpolated DateTime Along Line')))
@@ -49,16 +75,23 @@ class InterpolateDateTimeAlongLine(QgsProcessingAlgorithm):
         feedback.setProgressText('Prepare processing...')
         source_layer = self.parameterAsSource(parameters, self.SOURCE_LYR, context)
         source_layer_vl = self.parameterAsLayer(parameters, self.SOURCE_LYR, context)
+        timing = self.parameterAsInt(parameters, self.TIMING, context)
         source_start_time_expr = self.parameterAsExpression(parameters, self.SOURCE_START_TIME_EXPR, context)
         source_start_time_expr = QgsExpression(source_start_time_expr)
         source_end_time_expr = self.parameterAsExpression(parameters, self.SOURCE_END_TIME_EXPR, context)
         source_end_time_expr = QgsExpression(source_end_time_expr)
         source_interpolation_density_expr = self.parameterAsExpression(parameters, self.SOURCE_INTERPOLATION_DENSITY_EXPR, context)
         source_interpolation_density_expr = QgsExpression(source_interpolation_density_expr)
+        output_mode = self.parameterAsInt(parameters, self.OUTPUT_MODE, context)
+        point_time_step = self.parameterAsDouble(parameters, self.POINT_TIME_STEP, context)
+        point_fields = self.parameterAsFields(parameters, self.POINT_FIELDS, context)
         
         if source_layer_vl.crs().mapUnits() != 0:
             #feedback.pushWarning('Layer is not in a metric CRS! Calculations will be incorrect! Reproject your layer to a metric CRS and retry!')
             feedback.reportError('Layer is not in a metric CRS! Calculations will be incorrect! Reproject your layer to a metric CRS and retry!', fatalError=True)
+        if timing != 0 and not QgsWkbTypes.hasM(source_layer.wkbType()):
+            feedback.reportError('Timing by M values needs a layer with M values!', fatalError=True)
+            return {}
             
         source_layer_fields = source_layer.fields()
         output_layer_fields = source_layer_fields
@@ -72,7 +105,8 @@ class InterpolateDateTimeAlongLine(QgsProcessingAlgorithm):
             'seconds_from_linestart_field_name' : 'seconds_from_line_start',
             'distance_from_partstart_field_name' : 'distance_meters_from_part_start',
             'distance_from_linestart_field_name' : 'distance_meters_from_line_start',
-            'segment_length_field_name' : 'segment_length_meters'
+            'segment_length_field_name' : 'segment_length_meters',
+            'interpolated_time_field_name' : 'interpolated_datetime'
             }
         whilecounter = 0
         while any(elem in field_name_dict.values() for elem in output_layer_fields.names()):
@@ -93,10 +127,27 @@ class InterpolateDateTimeAlongLine(QgsProcessingAlgorithm):
         output_layer_fields.append(QgsField(field_name_dict['distance_from_linestart_field_name'], QVariant.Double, len = 20, prec = 8))
         output_layer_fields.append(QgsField(field_name_dict['segment_length_field_name'], QVariant.Double, len = 20, prec = 8))
         
-        (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
-                                               output_layer_fields, source_layer.wkbType(),
-                                               source_layer.sourceCrs())
-        
+        if output_mode == 0:
+            (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                                   output_layer_fields, source_layer.wkbType(),
+                                                   source_layer.sourceCrs())
+        else:
+            # compact output: the chosen attributes, the line id and the timestamp only
+            point_field_indices = [source_layer_fields.indexOf(field_name) for field_name in point_fields]
+            point_layer_fields = QgsFields()
+            for field_index in point_field_indices:
+                point_layer_fields.append(source_layer_fields.at(field_index))
+            point_layer_fields.append(QgsField(field_name_dict['line_id_field_name'], QVariant.Int))
+            point_layer_fields.append(QgsField(field_name_dict['interpolated_time_field_name'], QVariant.DateTime))
+            point_wkb_type = QgsWkbTypes.Point
+            if QgsWkbTypes.hasZ(source_layer.wkbType()):
+                point_wkb_type = QgsWkbTypes.addZ(point_wkb_type)
+            if QgsWkbTypes.hasM(source_layer.wkbType()):
+                point_wkb_type = QgsWkbTypes.addM(point_wkb_type)
+            (sink, dest_id) = self.parameterAsSink(parameters, self.OUTPUT, context,
+                                                   point_layer_fields, point_wkb_type,
+                                                   source_layer.sourceCrs())
+            point_feats = []
         
         total = 100.0 / source_layer_vl.featureCount() if source_layer_vl.featureCount() else 0
         
@@ -121,70 +172,167 @@ class InterpolateDateTimeAlongLine(QgsProcessingAlgorithm):
             source_end_time_expr_context.setFeature(source_feat)
             source_end_time_expr_result = source_end_time_expr.evaluate(source_end_time_expr_context)
             
-            if not 'QDateTime' in str(type(source_start_time_expr_result)) or not 'QDateTime' in str(type(source_end_time_expr_result)):
+            # unix time M values need no datetimes, M values relative to the start need the start-datetime only
+            checked_time_expr_results = [source_start_time_expr_result, source_end_time_expr_result][:[2, 1, 0][timing]]
+            if not all('QDateTime' in str(type(time_expr_result)) for time_expr_result in checked_time_expr_results):
                 feedback.pushWarning('Given start-datetime or end-datetime of Feature ' + str(source_feat.id()) + ' is not in QDateTime format! Skipping feature...')
                 continue
-            if not source_start_time_expr_result.isValid() or not source_end_time_expr_result.isValid():
+            if not all(time_expr_result.isValid() for time_expr_result in checked_time_expr_results):
                 feedback.pushWarning('Feature ' + str(source_feat.id()) + ' does not have a valid QDateTime! Skipping feature...')
                 continue
             
             source_interpolation_density_expr_context.setFeature(source_feat)
             source_interpolation_density_expr_result = source_interpolation_density_expr.evaluate(source_interpolation_density_expr_context)
             
-            seconds_needed = source_start_time_expr_result.secsTo(source_end_time_expr_result)
-            speed_m_per_s = source_length / seconds_needed
-            #speed_km_per_h = speed_m_per_s * 3.6
+            part_references = [self.part_reference(source_part) for source_part in source_geom.constParts()]
+            if timing == 0:
+                seconds_needed = source_start_time_expr_result.secsTo(source_end_time_expr_result)
+                if seconds_needed == 0 or source_length == 0:
+                    feedback.pushWarning('Feature ' + str(source_feat.id()) + ' has no length or the same start-datetime and end-datetime! Skipping feature...')
+                    continue
+                speed_m_per_s = source_length / seconds_needed
+                #speed_km_per_h = speed_m_per_s * 3.6
+            else:
+                line_start_m = part_references[0].coordinates[-1][0] if part_references and part_references[0].cumulative else 0
+                line_end_m = part_references[-1].coordinates[-1][-1] if part_references and part_references[-1].cumulative else 0
+            
+            if output_mode != 0:
+                if output_mode == 1 and timing == 0:
+                    point_distances = [step * point_time_step * speed_m_per_s for step in range(0, math.floor(seconds_needed / point_time_step) + 1)]
+                elif output_mode == 1:
+                    point_distances = self.m_distances(part_references, [line_start_m + step * point_time_step for step in range(0, math.floor((line_end_m - line_start_m) / point_time_step) + 1)])
+                else:
+                    point_distances = [step * source_interpolation_density_expr_result for step in range(0, math.floor(source_length / source_interpolation_density_expr_result) + 1)]
+                if not point_distances or point_distances[-1] < source_length: # the end of the line is always part of the output
+                    point_distances.append(source_length)
+                point_attributes = [source_feat[field_index] for field_index in point_field_indices] + [source_feat.id()]
+                for point_distance, point in self.points_along_line(source_geom, part_references, point_distances):
+                    if timing == 0:
+                        point_time = source_start_time_expr_result.addMSecs(round(point_distance / speed_m_per_s * 1000))
+                    else:
+                        point_time = self.m_datetime(timing, source_start_time_expr_result, point.m())
+                    point_feat = QgsFeature(point_layer_fields)
+                    point_feat.setGeometry(QgsGeometry(point))
+                    point_feat.setAttributes(point_attributes + [point_time])
+                    point_feats.append(point_feat)
+                if len(point_feats) >= self.POINT_BATCH_SIZE:
+                    sink.addFeatures(point_feats, QgsFeatureSink.FastInsert)
+                    point_feats = []
+                feedback.setProgress(int(current * total))
+                continue
             
-            for source_part in source_geom.parts():
+            new_feats = []
+            part_startdistance = 0 # distance of the current part from the start of the line
+            for source_part, source_part_line in zip(source_geom.constParts(), part_references):
                 if feedback.isCanceled():
                     break
                 part_id += 1
-                source_part_geom = QgsGeometry.fromPolyline(source_part)
-                source_part_length = source_part_geom.length()
+                source_part_length = source_part_line.length
                 nsegments = math.ceil(source_part_length / source_interpolation_density_expr_result)
-                segment_startdistance = 0
-                segment_enddistance = source_interpolation_density_expr_result
-                for segment in range(0,nsegments):
+                # all segments of the part are cut in one pass along its vertices
+                segment_breaks = [min(segment * source_interpolation_density_expr_result, source_part_length) for segment in range(0,nsegments + 1)]
+                for segment_startdistance, segment_enddistance, segment_coordinates in zip(segment_breaks, segment_breaks[1:], source_part_line.substrings(segment_breaks)):
                     if feedback.isCanceled():
                         break
                     segment_id += 1
-                    segment_linestring = source_part.curveSubstring(segment_startdistance,segment_enddistance)
-                    segment_geom = QgsGeometry.fromPolyline(segment_linestring)
+                    segment_geom = QgsGeometry(self.segment_linestring(source_part, segment_coordinates))
                     
-                    segment_startpoint = QgsGeometry.fromWkt(segment_linestring[0].asWkt()) # QgsGeometry.fromPointXY(QgsPointXY(segment_linestring[0]))
-                    segment_endpoint = QgsGeometry.fromWkt(segment_linestring[-1].asWkt()) # QgsGeometry.fromPointXY(QgsPointXY(segment_linestring[-1]))
-                    segment_start_distance_from_line_start = source_geom.lineLocatePoint(segment_startpoint)
-                    segment_end_distance_from_line_start = source_geom.lineLocatePoint(segment_endpoint)
-                    interpolated_starttime = source_start_time_expr_result.addSecs(segment_start_distance_from_line_start / speed_m_per_s)
-                    interpolated_endtime = source_start_time_expr_result.addSecs(segment_end_distance_from_line_start / speed_m_per_s)
+                    segment_start_distance_from_line_start = part_startdistance + segment_startdistance
+                    segment_end_distance_from_line_start = part_startdistance + segment_enddistance
+                    if timing == 0:
+                        interpolated_starttime = source_start_time_expr_result.addMSecs(round(segment_start_distance_from_line_start / speed_m_per_s * 1000))
+                        interpolated_endtime = source_start_time_expr_result.addMSecs(round(segment_end_distance_from_line_start / speed_m_per_s * 1000))
+                        segment_speed_m_per_s = speed_m_per_s
+                        seconds_from_line_start = segment_start_distance_from_line_start / speed_m_per_s
+                    else: # the M values are interpolated along with the coordinates of the segment
+                        segment_start_m = segment_coordinates[-1][0]
+                        segment_end_m = segment_coordinates[-1][-1]
+                        interpolated_starttime = self.m_datetime(timing, source_start_time_expr_result, segment_start_m)
+                        interpolated_endtime = self.m_datetime(timing, source_start_time_expr_result, segment_end_m)
+                        segment_speed_m_per_s = (segment_enddistance - segment_startdistance) / (segment_end_m - segment_start_m) if segment_end_m > segment_start_m else None
+                        seconds_from_line_start = segment_start_m - line_start_m
 
                     new_feat = QgsFeature(output_layer_fields)
                     new_feat.setGeometry(segment_geom)
-                    attridx = 0
-                    for attr in source_feat.attributes():
-                        new_feat[attridx] = attr
-                        attridx += 1
-                    new_feat[field_name_dict['line_id_field_name']] = source_feat.id()
-                    new_feat[field_name_dict['part_id_field_name']] = part_id
-                    new_feat[field_name_dict['segment_id_field_name']] = segment_id
-                    new_feat[field_name_dict['interpolated_starttime_field_name']] = interpolated_starttime
-                    new_feat[field_name_dict['interpolated_endtime_field_name']] = interpolated_endtime
-                    new_feat[field_name_dict['interpolated_speed_field_name']] = speed_m_per_s
-                    new_feat[field_name_dict['seconds_from_linestart_field_name']] = segment_start_distance_from_line_start / speed_m_per_s
-                    new_feat[field_name_dict['distance_from_partstart_field_name']] = segment_startdistance
-                    new_feat[field_name_dict['distance_from_linestart_field_name']] = segment_start_distance_from_line_start
-                    new_feat[field_name_dict['segment_length_field_name']] = segment_geom.length()
-                    
-                    segment_startdistance += source_interpolation_density_expr_result
-                    segment_enddistance += source_interpolation_density_expr_result
+                    new_feat.setAttributes(source_feat.attributes() + [
+                        source_feat.id(),
+                        part_id,
+                        segment_id,
+                        interpolated_starttime,
+                        interpolated_endtime,
+                        segment_speed_m_per_s,
+                        seconds_from_line_start,
+                        segment_startdistance,
+                        segment_start_distance_from_line_start,
+                        segment_enddistance - segment_startdistance
+                        ])
+                    new_feats.append(new_feat)
                     
-                    sink.addFeature(new_feat, QgsFeatureSink.FastInsert)
+                part_startdistance += source_part_length
+            sink.addFeatures(new_feats, QgsFeatureSink.FastInsert)
                     
             feedback.setProgress(int(current * total))
             
+        if output_mode != 0 and point_feats:
+            sink.addFeatures(point_feats, QgsFeatureSink.FastInsert)
 
         return {self.OUTPUT: dest_id}
 
+    def part_reference(self, part):
+        # LinearReference on the vertex arrays of a line part including its z and m values; curves are segmentized first
+        if not isinstance(part, QgsLineString):
+            part = part.curveToLine()
+        coordinates = [part.xVector(), part.yVector()]
+        if part.is3D():
+            coordinates.append(part.zVector())
+        if part.isMeasure():
+            coordinates.append(part.mVector())
+        return LinearReference(coordinates)
+
+    def m_datetime(self, timing, start_datetime, m):
+        # datetime of an M value of the given timing method
+        if timing == 1:
+            return start_datetime.addMSecs(round(m * 1000))
+        return QDateTime.fromMSecsSinceEpoch(round(m * 1000))
+
+    def m_distances(self, part_references, m_values):
+        # ascending distances from the start of the line where the M values are reached; values between parts are skipped
+        distances = []
+        part_startdistance = 0
+        remaining = m_values
+        for part_reference in part_references:
+            part_distances = part_reference.distances_at(remaining)
+            found = [d for d in part_distances if d is not None]
+            distances.extend(part_startdistance + d for d in found)
+            if found: # values of this part are not searched again in the following parts
+                last_found = max(i for i, d in enumerate(part_distances) if d is not None)
+                remaining = remaining[last_found + 1:]
+            part_startdistance += part_reference.length
+        return distances
+
+    def points_along_line(self, geom, part_references, distances):
+        # yields (distance, QgsPoint) for the ascending distances from the start of the line; parts follow each other without gap
+        distances = iter(distances)
+        distance = next(distances, None)
+        part_startdistance = 0
+        for part_number, part_reference in enumerate(part_references):
+            part_distances = []
+            is_last_part = part_number == len(part_references) - 1
+            while distance is not None and (distance <= part_startdistance + part_reference.length or is_last_part):
+                part_distances.append(distance)
+                distance = next(distances, None)
+            for point_distance, vertex in zip(part_distances, part_reference.vertices_at([d - part_startdistance for d in part_distances])):
+                yield point_distance, QgsPoint(vertex[0], vertex[1],
+                                               vertex[2] if geom.constGet().is3D() else math.nan,
+                                               vertex[-1] if geom.constGet().isMeasure() else math.nan)
+            part_startdistance += part_reference.length
+
+    def segment_linestring(self, part, coordinates):
+        # QgsLineString from the coordinate lists of a LinearReference created by part_reference
+        z = coordinates[2] if part.is3D() else []
+        m = coordinates[-1] if part.isMeasure() else []
+        return QgsLineString(coordinates[0], coordinates[1], z, m)
+
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -209,4 +357,8 @@ class InterpolateDateTimeAlongLine(QgsProcessingAlgorithm):
                        'The layer <b>must be in a metric CRS</b> and needs attributes for start-datetime and end-datetime in QDateTime format where both datetime attributes must be in the same timezone. \n'
                        'You can use <i>to_datetime()</i>, <i>datetime_from_epoch()</i> or <i>make_datetime()</i> expressions to use datetimes stored e.g. as string or unixtime for usage in this algorithm. \n'
                        'This algorithm is designed for animating lines with Temporal Controller. \n'
+                       'Instead of line segments, the output can also be points at fixed time steps or at fixed distances along the lines (the maximum length of segments is used as distance). '
+                       'If the vertices of the lines carry timestamps as M values, the datetimes can be interpolated from these instead of assuming a constant speed between start-datetime and end-datetime. '
+                       'M values can be seconds since the start-datetime or unix timestamps (then the start-datetime and end-datetime expressions are not used). The speed is then calculated per segment. \n'
+                       'Points only get the line id, the interpolated datetime and the chosen source attributes, so the output is much smaller, and the end of every line is always added as last point. \n'
                        )
\ No newline at end of file
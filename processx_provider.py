@@ -52,6 +52,7 @@ from .algorithms.vector_conditionals.ExtendLinesToNearestPointsByCondition impor
 # Vector - Creation
 from .algorithms.vector_creation.CreateTimepolygonsWithPointcount import *
 from .algorithms.vector_creation.GeometryLayerFromGeojsonStringField import *
+from .algorithms.vector_creation.GeometryLayerFromGeojsonSequenceFile import *
 from .algorithms.vector_creation.CreateNestedGrid import *
 from .algorithms.vector_creation.NearestPointsToPath import *
 from .algorithms.vector_creation.CreatePolygonFromExtent import *
@@ -103,6 +104,7 @@ class ProcessXProvider(QgsProcessingProvider):
         # Vector - Creation
         self.addAlgorithm(CreateTimepolygonsWithPointcount())
         self.addAlgorithm(GeometryLayerFromGeojsonStringField())
+        self.addAlgorithm(GeometryLayerFromGeojsonSequenceFile())
         self.addAlgorithm(CreateNestedGrid())
         self.addAlgorithm(NearestPointsToPath())
         self.addAlgorithm(CreatePolygonFromExtent())